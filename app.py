@@ -1,24 +1,60 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, Response, current_app, g, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import os
+import json
 import uuid
-from datetime import datetime
+import queue
+import threading
+import hashlib
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 import logging
-from model_pipeline import ObjectCounter
+from model_pipeline import ObjectCounter, PipelineCancelled, DEFAULT_SAM_PRESET
+from jobs import JobQueue, JobQueueFull, JobCancelled
+from upload_writer import UploadWriter
+from metrics import REGISTRY, Counter, Gauge, Histogram
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class UploadRequest(Request):
+    """Request that allows larger uploads for the batch counting endpoint."""
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'count_objects_batch':
+            return current_app.config['BATCH_MAX_CONTENT_LENGTH']
+        return super().max_content_length
+
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///object_counting.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['RESULT_CACHE_ENABLED'] = True
+app.config['RESULT_CACHE_MAX_ENTRIES'] = 10000
+app.config['RESULT_CACHE_MAX_AGE'] = 7 * 24 * 3600  # seconds
+app.config['MODEL_RETRY_AFTER'] = 10  # seconds clients should wait while models load
+app.config['MODEL_LOAD_RETRY_INTERVAL'] = 60  # seconds before a failed model load is retried
+app.config['JOB_WORKERS'] = 2  # pipeline runs executed concurrently for async requests
+app.config['JOB_MAX_PENDING'] = 100
+app.config['JOB_MAX_AGE'] = 3600  # seconds finished jobs are kept
+app.config['STREAM_KEEPALIVE'] = 15  # seconds between keep-alive comments on progress streams
+app.config['BATCH_MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024  # 512MB max batch upload
+app.config['BATCH_MAX_IMAGES'] = 500
+app.config['BATCH_WORKERS'] = 2  # images of a batch processed concurrently
+app.config['UPLOAD_WRITE_MAX_PENDING'] = 256 * 1024 * 1024  # bytes of uploads queued for writing
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -27,20 +63,148 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 CORS(app)
 db = SQLAlchemy(app)
 
-# Initialize AI model pipeline
-object_counter = ObjectCounter()
+# Initialize AI model pipeline. SAM resizes its input to 1024 pixels anyway,
+# so segmenting at that size avoids full-resolution mask post-processing.
+# Models are loaded on a background thread so the server starts instantly.
+# Cross-request batching of ResNet-50 forward passes (batch_wait_ms) stays
+# off until a benchmark shows the wait pays off on the target hardware.
+object_counter = ObjectCounter(max_side=1024, batch_wait_ms=0, lazy=True)
+model_loader_lock = threading.Lock()
+model_loader_thread = None
+model_load_failed_at = None
+
+# Worker pool for asynchronous /api/count requests
+job_queue = JobQueue(
+    max_workers=app.config['JOB_WORKERS'],
+    max_pending=app.config['JOB_MAX_PENDING'],
+    max_age=app.config['JOB_MAX_AGE']
+)
+
+# Uploads are counted from memory and written to the upload folder in the background
+upload_writer = UploadWriter(max_pending_bytes=app.config['UPLOAD_WRITE_MAX_PENDING'])
+
+# Makes the dedup check in save_upload() and release_upload() atomic (within
+# a process; stored uploads are never deleted while a request may use them)
+uploads_lock = threading.Lock()
+
+# Prometheus metrics (per process; scrape every worker when running under serve.py)
+HTTP_REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests by endpoint, method and status code',
+    labelnames=('endpoint', 'method', 'status')
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by endpoint', labelnames=('endpoint',)
+)
+UPLOADS_STORED = Counter(
+    'uploads_stored_total', 'Uploads stored as new files or deduplicated against stored ones',
+    labelnames=('result',)
+)
+RESULT_CACHE_REQUESTS = Counter(
+    'result_cache_requests_total', 'Result cache lookups by outcome', labelnames=('result',)
+)
+Gauge(
+    'counting_jobs', 'Asynchronous counting jobs by status', labelnames=('status',),
+    function=lambda: {
+        status: count for status, count in job_queue.stats().items()
+        if status not in ('max_workers', 'max_pending')
+    }
+)
+Gauge(
+    'models_ready', 'Whether the AI models are loaded (1) or not (0)',
+    function=lambda: object_counter.is_ready()
+)
+Counter(
+    'sam_cache_lookups_total', 'SAM cache lookups by kind and outcome', labelnames=('kind', 'result'),
+    function=lambda: {
+        (kind, result): count
+        for kind, counters in object_counter.get_cache_stats().items() if isinstance(counters, dict)
+        for result, count in counters.items()
+    }
+)
+Gauge(
+    'upload_writes_pending', 'Uploads waiting to be written to the upload folder',
+    function=lambda: upload_writer.stats()['pending']
+)
+Gauge(
+    'upload_writes_failed', 'Uploads that could not be written to the upload folder',
+    function=lambda: upload_writer.stats()['failed']
+)
+Gauge(
+    'sam_cache_bytes', 'Memory used by the SAM cache',
+    function=lambda: object_counter.get_cache_stats()['bytes']
+)
+
+def load_models():
+    """Load and warm up the AI models (runs on the model loader thread)."""
+    global model_loader_thread, model_load_failed_at
+    try:
+        logger.info("Loading AI models...")
+        object_counter.load(warm_up=True)
+        logger.info(f"AI models ready: {object_counter.get_load_status()}")
+    except Exception as e:
+        logger.error(f"Error loading AI models: {str(e)}")
+        # Let a later request retry; /api/ready shows the error meanwhile
+        with model_loader_lock:
+            model_loader_thread = None
+            model_load_failed_at = time.monotonic()
+
+def start_model_loading():
+    """
+    Start loading the AI models in the background.
+    
+    Only one load runs at a time, and a failed load is retried no sooner
+    than MODEL_LOAD_RETRY_INTERVAL seconds later.
+    """
+    global model_loader_thread
+    with model_loader_lock:
+        if model_loader_thread is not None or object_counter.is_ready():
+            return
+        if (model_load_failed_at is not None
+                and time.monotonic() - model_load_failed_at < app.config['MODEL_LOAD_RETRY_INTERVAL']):
+            return
+        model_loader_thread = threading.Thread(
+            target=load_models, name='model-loader', daemon=True
+        )
+        model_loader_thread.start()
+
+@app.before_request
+def ensure_models_loading():
+    g.request_start_time = time.perf_counter()
+    # Covers servers that import the app instead of wsgi.py, and retries failed loads
+    if not app.config['TESTING']:
+        start_model_loading()
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are timed until their headers are sent
+    endpoint = request.endpoint or 'unmatched'
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if 'request_start_time' in g:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start_time, endpoint=endpoint)
+    return response
+
+def models_not_ready_response():
+    """503 response telling clients to retry once the models are loaded."""
+    response = jsonify({
+        'error': 'AI models are still loading. Please retry shortly.',
+        'models': object_counter.get_load_status()
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['MODEL_RETRY_AFTER'])
+    return response
 
 # Database Models
 class CountingResult(db.Model):
     id = db.Column(db.String(36), primary_key=True)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    image_path = db.Column(db.String(255), nullable=False)
+    image_path = db.Column(db.String(255), nullable=False, index=True)
     item_type = db.Column(db.String(100), nullable=False)
     predicted_count = db.Column(db.Integer, nullable=False)
     corrected_count = db.Column(db.Integer, nullable=True)
     confidence_score = db.Column(db.Float, nullable=True)
     processing_time = db.Column(db.Float, nullable=True)
     user_feedback = db.Column(db.Text, nullable=True)
+    preset = db.Column(db.String(20), nullable=True)
     
     def to_dict(self):
         return {
@@ -52,9 +216,178 @@ class CountingResult(db.Model):
             'corrected_count': self.corrected_count,
             'confidence_score': self.confidence_score,
             'processing_time': self.processing_time,
-            'user_feedback': self.user_feedback
+            'user_feedback': self.user_feedback,
+            'preset': self.preset
         }
 
+class CachedResult(db.Model):
+    """Pipeline result keyed by image hash, item type and pipeline configuration."""
+    cache_key = db.Column(db.String(64), primary_key=True)
+    image_hash = db.Column(db.String(64), nullable=False, index=True)
+    item_type = db.Column(db.String(100), nullable=False)
+    config_fingerprint = db.Column(db.String(64), nullable=False)
+    result = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_accessed = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+
+def upgrade_database(engine):
+    """
+    Create the database tables and bring tables of older versions up to date.
+    
+    db.create_all() skips tables that already exist, so columns and indexes
+    added to a model later are added here. Added columns are nullable.
+    
+    Args:
+        engine: SQLAlchemy engine of the database
+    """
+    db.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                    logger.info(f"Added column {table.name}.{column.name}")
+            
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    logger.info(f"Created index {index.name}")
+
+def result_cache_key(image_hash, item_type, fingerprint):
+    return hashlib.sha256(f"{image_hash}:{item_type}:{fingerprint}".encode('utf-8')).hexdigest()
+
+def get_cached_result(image_hash, item_type, preset=None, tiled=False):
+    """
+    Look up a stored pipeline result.
+    
+    Returns:
+    - The stored result dict, or None on a miss (or when caching is disabled)
+    """
+    return get_cached_results([(image_hash, item_type)], preset, tiled)[(image_hash, item_type)]
+
+def get_cached_results(keys, preset=None, tiled=False):
+    """
+    Look up the stored pipeline results of several images and item types.
+    
+    All entries are read with one query and their access times updated
+    in one transaction.
+    
+    Args:
+        keys (list): (image hash, item type) pairs
+        preset (str): SAM speed/quality preset
+        tiled (bool): Results of tiled runs
+        
+    Returns:
+    - dict mapping every pair to its stored result dict, or to None on a
+      miss (or when caching is disabled)
+    """
+    results = {key: None for key in keys}
+    if not app.config['RESULT_CACHE_ENABLED'] or not keys:
+        return results
+    
+    try:
+        fingerprint = object_counter.get_config_fingerprint(preset, tiled)
+        cache_keys = {
+            result_cache_key(image_hash, item_type, fingerprint): (image_hash, item_type)
+            for image_hash, item_type in results
+        }
+        entries = CachedResult.query.filter(CachedResult.cache_key.in_(list(cache_keys))).all()
+        
+        now = datetime.utcnow()
+        max_age = timedelta(seconds=app.config['RESULT_CACHE_MAX_AGE'])
+        for entry in entries:
+            if now - entry.created_at > max_age:
+                db.session.delete(entry)
+                RESULT_CACHE_REQUESTS.inc(result='expired')
+                continue
+            entry.last_accessed = now
+            entry.hit_count += 1
+            results[cache_keys[entry.cache_key]] = json.loads(entry.result)
+            RESULT_CACHE_REQUESTS.inc(result='hit')
+        if entries:
+            db.session.commit()
+        if len(entries) < len(cache_keys):
+            RESULT_CACHE_REQUESTS.inc(len(cache_keys) - len(entries), result='miss')
+        return results
+        
+    except Exception as e:
+        logger.warning(f"Result cache lookup failed: {str(e)}")
+        db.session.rollback()
+        return {key: None for key in keys}
+
+def cached_result_entry(image_hash, item_type, result, preset=None, tiled=False):
+    """
+    Build the result cache row of a pipeline result.
+    
+    Returns:
+    - A CachedResult, or None if the result must not be cached
+    """
+    if not app.config['RESULT_CACHE_ENABLED']:
+        return None
+    
+    # Never cache the mock results of fallback mode
+    if result.get('details', {}).get('fallback_mode'):
+        return None
+    
+    fingerprint = object_counter.get_config_fingerprint(preset, tiled)
+    return CachedResult(
+        cache_key=result_cache_key(image_hash, item_type, fingerprint),
+        image_hash=image_hash,
+        item_type=item_type,
+        config_fingerprint=fingerprint,
+        result=json.dumps(result)
+    )
+
+def add_cached_results(entries):
+    """
+    Add result cache rows to the current transaction, replacing stored rows
+    with the same keys, and evict expired or least recently used entries.
+    
+    The caller commits.
+    """
+    if not entries:
+        return
+    # The same image may appear twice in a batch
+    entries = list({entry.cache_key: entry for entry in entries}.values())
+    CachedResult.query.filter(
+        CachedResult.cache_key.in_([entry.cache_key for entry in entries])
+    ).delete(synchronize_session=False)
+    db.session.add_all(entries)
+    db.session.flush()
+    evict_cached_results()
+
+def store_cached_result(image_hash, item_type, result, preset=None, tiled=False):
+    """Store a pipeline result and evict expired or least recently used entries."""
+    try:
+        entry = cached_result_entry(image_hash, item_type, result, preset, tiled)
+        if entry is None:
+            return
+        add_cached_results([entry])
+        db.session.commit()
+        
+    except Exception as e:
+        logger.warning(f"Could not store result in cache: {str(e)}")
+        db.session.rollback()
+
+def evict_cached_results():
+    """Delete expired entries and trim the cache to its maximum size."""
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['RESULT_CACHE_MAX_AGE'])
+    CachedResult.query.filter(CachedResult.created_at < cutoff).delete(synchronize_session=False)
+    
+    excess = CachedResult.query.count() - app.config['RESULT_CACHE_MAX_ENTRIES']
+    if excess > 0:
+        oldest = db.session.query(CachedResult.cache_key).order_by(
+            CachedResult.last_accessed.asc()
+        ).limit(excess).all()
+        CachedResult.query.filter(
+            CachedResult.cache_key.in_([cache_key for (cache_key,) in oldest])
+        ).delete(synchronize_session=False)
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
@@ -67,6 +400,215 @@ OBJECT_TYPES = [
     "person", "sky", "ground", "hardware"
 ]
 
+def parse_item_types(values):
+    """
+    Parse requested item types from form values.
+    
+    Each value may hold a single type, a comma-separated list of types or
+    "*" for all predefined types. Duplicates are dropped, order is kept.
+    """
+    item_types = []
+    for value in values:
+        for item_type in value.split(','):
+            item_type = item_type.strip()
+            expanded = OBJECT_TYPES if item_type == '*' else [item_type]
+            for expanded_type in expanded:
+                if expanded_type and expanded_type not in item_types:
+                    item_types.append(expanded_type)
+    return item_types
+
+def parse_count_options():
+    """
+    Validate the item types, preset and tiling option of a counting request.
+    
+    Returns:
+    - (options, None) with the item types, preset and whether several types
+      were requested, or (None, response) with the error response to return
+    """
+    # Check if item_type is provided
+    item_types = parse_item_types(request.form.getlist('item_type'))
+    if not item_types:
+        return None, (jsonify({'error': 'No item type specified'}), 400)
+    
+    # Validate item_type
+    if any(item_type not in OBJECT_TYPES for item_type in item_types):
+        return None, (jsonify({
+            'error': f'Invalid item type. Must be one of: {OBJECT_TYPES}'
+        }), 400)
+    
+    # Validate the speed/quality preset
+    preset = request.form.get('preset') or DEFAULT_SAM_PRESET
+    presets = object_counter.get_presets()
+    if preset not in presets:
+        return None, (jsonify({
+            'error': f'Invalid preset. Must be one of: {presets}'
+        }), 400)
+    
+    # Large images can be segmented in overlapping tiles
+    tiled = request.form.get('tiled', '').lower() in ('1', 'true', 'yes')
+    
+    # Several types (or "*") are counted from a single pipeline run
+    multi_target = len(item_types) > 1 or any('*' in value for value in request.form.getlist('item_type'))
+    
+    return {
+        'item_types': item_types,
+        'preset': preset,
+        'tiled': tiled,
+        'multi_target': multi_target
+    }, None
+
+def upload_path(image_hash, filename):
+    """
+    Get the content-addressed path of an upload.
+    
+    Files are stored by SHA-256 digest in two levels of shard directories,
+    e.g. uploads/3f/a2/3fa2...e1.jpg, so identical uploads share one file.
+    
+    Args:
+        image_hash (str): SHA-256 hex digest of the file content
+        filename (str): Original file name (for the extension)
+        
+    Returns:
+    - Path of the stored file
+    """
+    file_extension = filename.rsplit('.', 1)[1].lower()
+    return os.path.join(
+        app.config['UPLOAD_FOLDER'], image_hash[:2], image_hash[2:4], f"{image_hash}.{file_extension}"
+    )
+
+def find_upload(image_hash):
+    """
+    Find a stored upload with the given content, under any extension.
+    
+    Returns:
+    - Path of the stored file, or None
+    """
+    shard = os.path.dirname(upload_path(image_hash, 'upload.bin'))
+    try:
+        for name in os.listdir(shard):
+            if name.split('.', 1)[0] == image_hash and not name.endswith('.tmp'):
+                return os.path.join(shard, name)
+    except FileNotFoundError:
+        pass
+    return None
+
+def save_upload(data, filename, background=False, image_hash=None):
+    """
+    Store an uploaded image in the content-addressed upload folder.
+    
+    Nothing is written if a file with the same content is already stored
+    (or being written).
+    
+    Args:
+        data (bytes): The image bytes
+        filename (str): Original file name (for the extension)
+        background (bool): Write the image bytes on the upload writer thread;
+            the file appears once written
+        image_hash (str): SHA-256 hex digest of ``data``, if already known
+    
+    Returns:
+    - (path of the stored file, whether this call created it)
+    """
+    image_hash = image_hash or hashlib.sha256(data).hexdigest()
+    with uploads_lock:
+        file_path = find_upload(image_hash) or upload_path(image_hash, filename)
+        if os.path.exists(file_path) or upload_writer.is_pending(file_path):
+            UPLOADS_STORED.inc(result='duplicate')
+            logger.info(f"Image already stored: {file_path}")
+            return file_path, False
+        
+        UPLOADS_STORED.inc(result='new')
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        queued = background and upload_writer.queue(file_path, data)
+    
+    # Write outside the lock, so other uploads are not held up by slow storage
+    if background:
+        if not queued:
+            upload_writer.write_sync(file_path, data)
+        return file_path, True
+    
+    upload_writer.write_now(file_path, data)
+    return file_path, True
+
+def count_upload_references(file_path):
+    """Get the number of counting results that reference a stored upload."""
+    return CountingResult.query.filter_by(image_path=file_path).count()
+
+def release_upload(file_path):
+    """
+    Delete a stored upload unless a counting result references it.
+    
+    Only call this for uploads the caller created.
+    """
+    with uploads_lock:
+        if count_upload_references(file_path) > 0:
+            return
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logger.info(f"Image deleted: {file_path}")
+
+def prepare_count_request():
+    """
+    Validate a counting request and save its upload.
+    
+    Returns:
+    - (count_request, None) with the image bytes, their file path, image hash,
+      item types, preset and whether several types were requested, or
+      (None, response) with the error response to return
+    """
+    # Check if image file is present
+    if 'image' not in request.files:
+        return None, (jsonify({'error': 'No image file provided'}), 400)
+    
+    file = request.files['image']
+    if file.filename == '':
+        return None, (jsonify({'error': 'No image file selected'}), 400)
+    
+    options, error_response = parse_count_options()
+    if error_response is not None:
+        return None, error_response
+    
+    # Validate file type
+    if not allowed_file(file.filename):
+        return None, (jsonify({
+            'error': f'Invalid file type. Allowed types: {list(ALLOWED_EXTENSIONS)}'
+        }), 400)
+    
+    # Models are loaded in the background after startup
+    if not object_counter.is_ready():
+        return None, models_not_ready_response()
+    
+    # The pipeline reads the upload from memory; the file is written off the request path
+    image_data = file.read()
+    image_hash = hashlib.sha256(image_data).hexdigest()
+    file_path, _ = save_upload(image_data, file.filename, background=True, image_hash=image_hash)
+    
+    return dict(options, file_path=file_path, image_hash=image_hash, image_data=image_data), None
+
+def run_count_request(count_request, progress_callback=None):
+    """
+    Run the AI pipeline for a prepared counting request.
+    
+    Args:
+        count_request (dict): Request returned by prepare_count_request()
+        progress_callback (callable): Optional pipeline progress callback
+        
+    Returns:
+    - dict with the count result(s)
+    """
+    start_time = datetime.now()
+    if count_request['multi_target']:
+        return count_multiple_objects(
+            count_request['file_path'], count_request['item_types'], count_request['image_hash'],
+            count_request['preset'], start_time, progress_callback, count_request['tiled'],
+            count_request['image_data']
+        )
+    return count_single_object(
+        count_request['file_path'], count_request['item_types'][0], count_request['image_hash'],
+        count_request['preset'], start_time, progress_callback, count_request['tiled'],
+        count_request['image_data']
+    )
+
 @app.route('/api/count', methods=['POST'])
 def count_objects():
     """
@@ -74,88 +616,625 @@ def count_objects():
     
     Expected input:
     - image: image file (multipart/form-data)
-    - item_type: string from predefined list
+    - item_type: string from predefined list, a comma-separated list of
+      types, or "*" for all types (may also be repeated)
+    - preset: SAM speed/quality preset, "fast", "balanced" or "accurate",
+      or "classical" for fast model-free segmentation (optional, default
+      "balanced")
+    - tiled: "true" to segment large images in overlapping tiles at full
+      resolution, so small objects are not lost (optional)
+    - async: "true" to queue the request and return immediately (optional)
     
     Returns:
-    - JSON response with count results
+    - JSON response with count results (one entry per type in "results"
+      when several types are requested), or with async, a 202 response
+      with the job ID to poll at /api/jobs/<job_id>
     """
     try:
-        # Check if image file is present
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image file provided'}), 400
-        
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No image file selected'}), 400
-        
-        # Check if item_type is provided
-        item_type = request.form.get('item_type')
-        if not item_type:
-            return jsonify({'error': 'No item type specified'}), 400
-        
-        # Validate item_type
-        if item_type not in OBJECT_TYPES:
-            return jsonify({
-                'error': f'Invalid item type. Must be one of: {OBJECT_TYPES}'
-            }), 400
-        
-        # Validate file type
-        if not allowed_file(file.filename):
-            return jsonify({
-                'error': f'Invalid file type. Allowed types: {list(ALLOWED_EXTENSIONS)}'
-            }), 400
-        
-        # Generate unique filename
-        file_extension = file.filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        count_request, error_response = prepare_count_request()
+        if error_response is not None:
+            return error_response
         
-        # Save file
-        file.save(file_path)
-        logger.info(f"Image saved: {file_path}")
+        if request.values.get('async', '').lower() in ('1', 'true', 'yes'):
+            return submit_count_job(count_request)
         
         # Process image with AI pipeline
-        start_time = datetime.now()
         try:
-            result = object_counter.count_objects(file_path, item_type)
-            processing_time = (datetime.now() - start_time).total_seconds()
-            
-            # Create database record
-            result_id = str(uuid.uuid4())
-            db_result = CountingResult(
-                id=result_id,
-                image_path=file_path,
-                item_type=item_type,
-                predicted_count=result['count'],
-                confidence_score=result.get('confidence', 0.0),
-                processing_time=processing_time
-            )
-            
-            db.session.add(db_result)
-            db.session.commit()
-            
-            # Return response
-            response = {
-                'id': result_id,
-                'count': result['count'],
-                'confidence_score': result.get('confidence', 0.0),
-                'processing_time': processing_time,
-                'item_type': item_type,
-                'image_path': file_path,
-                'details': result.get('details', {})
-            }
-            
-            logger.info(f"Object counting completed: {response}")
+            response = run_count_request(count_request)
             return jsonify(response), 200
             
         except Exception as e:
             logger.error(f"Error processing image: {str(e)}")
             return jsonify({'error': f'Error processing image: {str(e)}'}), 500
             
+    except RequestEntityTooLarge:
+        # Answered by the 413 handler
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def jobs_full_response(error):
+    """503 response for requests rejected because the job queue is full."""
+    logger.warning(f"Rejecting counting job: {str(error)}")
+    response = jsonify({'error': 'Too many pending jobs. Please retry shortly.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['MODEL_RETRY_AFTER'])
+    return response
+
+def submit_count_job(count_request):
+    """
+    Queue a counting request on the job worker pool.
+    
+    Returns:
+    - 202 response with the job ID and status URL, or 503 if the queue is full
+    """
+    def run_job(progress):
+        with app.app_context():
+            return run_count_request(count_request, progress)
+    
+    try:
+        job = job_queue.submit(
+            run_job, item_types=count_request['item_types'], preset=count_request['preset'],
+            tiled=count_request['tiled']
+        )
+    except JobQueueFull as e:
+        return jobs_full_response(e)
+    
+    status_url = f"/api/jobs/{job['id']}"
+    logger.info(f"Counting job queued: {job['id']}")
+    response = jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': status_url
+    })
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+@app.route('/api/count/stream', methods=['POST'])
+def count_objects_stream():
+    """
+    API endpoint to count objects while streaming pipeline progress.
+    
+    Takes the same input as /api/count. The response is a Server-Sent
+    Events stream with these events:
+    - queued: the job ID, once the request is queued
+    - progress: the current pipeline stage ("decoding", "segmenting",
+      "classifying", "refining", "counting"); during classification it
+      includes the labels of the segments classified so far
+    - result: the same result /api/count returns
+    - error: the error message if processing failed
+    
+    Closing the connection cancels the pipeline run.
+    """
+    try:
+        count_request, error_response = prepare_count_request()
+        if error_response is not None:
+            return error_response
+        
+        events = queue.Queue()
+        cancelled = threading.Event()
+        
+        def run_job(progress):
+            def stream_progress(stage, info):
+                if cancelled.is_set():
+                    raise PipelineCancelled('Cancelled by client')
+                progress(stage, info)
+                events.put(('progress', dict(info, stage=stage)))
+            
+            try:
+                with app.app_context():
+                    result = run_count_request(count_request, stream_progress)
+            except PipelineCancelled as e:
+                raise JobCancelled(str(e))
+            except Exception as e:
+                events.put(('error', {'error': f'Error processing image: {str(e)}'}))
+                raise
+            events.put(('result', result))
+            return result
+        
+        try:
+            job = job_queue.submit(
+                run_job, item_types=count_request['item_types'], preset=count_request['preset'],
+                tiled=count_request['tiled']
+            )
+        except JobQueueFull as e:
+            return jobs_full_response(e)
+        
+        def generate():
+            try:
+                yield format_sse('queued', {'job_id': job['id']})
+                while True:
+                    try:
+                        event, data = events.get(timeout=app.config['STREAM_KEEPALIVE'])
+                    except queue.Empty:
+                        # Comment line; also detects clients that went away
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield format_sse(event, data)
+                    if event in ('result', 'error'):
+                        break
+            finally:
+                # Runs when the client disconnects, stopping the pipeline at
+                # its next stage
+                cancelled.set()
+        
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        
+    except RequestEntityTooLarge:
+        # Answered by the 413 handler
+        raise
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def format_sse(event, data):
+    """Format a Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def collect_batch_images():
+    """
+    Save the images of a batch counting request, extracting zip archives.
+    
+    The whole batch is validated first (file types, number of images and
+    the contents of every archive), and images are only stored once it is
+    accepted. A rejected batch so never has to delete stored uploads, which
+    other requests, also in other worker processes, may have deduplicated
+    onto in the meantime.
+    
+    Returns:
+    - (images, None) with a (filename, file_path, image_hash, image) tuple
+      per image, or (None, response) with the error response to return.
+      ``image`` is the file path, or the image bytes if the image was
+      deduplicated onto an upload that another request has not finished
+      writing yet
+    """
+    uploads = [
+        file for file in
+        request.files.getlist('images') + request.files.getlist('image') + request.files.getlist('archive')
+        if file.filename != ''
+    ]
+    max_images = app.config['BATCH_MAX_IMAGES']
+    max_archive_bytes = app.config['BATCH_MAX_CONTENT_LENGTH']
+    
+    def reject(message):
+        return None, (jsonify({'error': message}), 400)
+    
+    def archive_members(archive):
+        return [
+            member for member in archive.infolist()
+            if not member.is_dir() and allowed_file(member.filename)
+        ]
+    
+    # Validate the whole batch before anything is stored
+    image_count = 0
+    for file in uploads:
+        if file.filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = archive_members(archive)
+                    image_count += len(members)
+                    if image_count > max_images:
+                        return reject(f'Too many images. Maximum is {max_images} per batch')
+                    if sum(member.file_size for member in members) > max_archive_bytes:
+                        return reject('Archive too large when extracted')
+                    # Reading a member checks its CRC
+                    for member in members:
+                        archive.read(member)
+            except (zipfile.BadZipFile, EOFError, zlib.error):
+                return reject(f'Invalid zip archive: {file.filename}')
+            except (RuntimeError, NotImplementedError) as e:
+                # Encrypted members or unsupported compression methods
+                return reject(f'Unsupported zip archive: {file.filename} ({str(e)})')
+            continue
+        
+        if not allowed_file(file.filename):
+            return reject(f'Invalid file type: {file.filename}. Allowed types: {list(ALLOWED_EXTENSIONS)}')
+        image_count += 1
+        if image_count > max_images:
+            return reject(f'Too many images. Maximum is {max_images} per batch')
+    
+    if not image_count:
+        return reject('No image files provided')
+    
+    images = []
+    
+    def save(data, filename):
+        image_hash = hashlib.sha256(data).hexdigest()
+        file_path, _ = save_upload(data, filename, image_hash=image_hash)
+        # Stored files are replaced atomically, so once the file exists it is complete
+        image = file_path if os.path.exists(file_path) else data
+        images.append((filename, file_path, image_hash, image))
+    
+    for file in uploads:
+        if file.filename.lower().endswith('.zip'):
+            file.stream.seek(0)
+            with zipfile.ZipFile(file.stream) as archive:
+                for member in archive_members(archive):
+                    save(archive.read(member), member.filename)
+        else:
+            save(file.read(), file.filename)
+    return images, None
+
+@app.route('/api/count/batch', methods=['POST'])
+def count_objects_batch():
+    """
+    API endpoint to count objects in many images with one request.
+    
+    Expected input:
+    - images: image files and/or zip archives of images (may be repeated)
+    - item_type, preset: as for /api/count
+    
+    Images are processed concurrently on BATCH_WORKERS threads (their
+    segments share ResNet-50 forward passes when the classifier's
+    batch_wait_ms is set). Images with stored results are served from the
+    result cache.
+    
+    Returns:
+    - NDJSON stream with one line per image, in completion order, and a
+      final summary line; the CountingResult rows are written in bulk
+    """
+    try:
+        options, error_response = parse_count_options()
+        if error_response is not None:
+            return error_response
+        
+        # Models are loaded in the background after startup
+        if not object_counter.is_ready():
+            return models_not_ready_response()
+        
+        images, error_response = collect_batch_images()
+        if error_response is not None:
+            return error_response
+        
+        logger.info(f"Batch counting started for {len(images)} images")
+        return Response(
+            stream_with_context(generate_batch_results(images, options)),
+            mimetype='application/x-ndjson'
+        )
+        
+    except RequestEntityTooLarge:
+        # Answered by the 413 handler
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def count_batch_image(image, item_types, options):
+    """
+    Run the AI pipeline for one image of a batch (on a batch worker thread).
+    
+    ``image`` is the path of the stored upload, or the image bytes (see
+    collect_batch_images()).
+    
+    Returns:
+    - (result per item type, pipeline details, processing time in seconds)
+    """
+    start_time = datetime.now()
+    if options['multi_target']:
+        result = object_counter.count_all_objects(
+            image, item_types, preset=options['preset'], tiled=options['tiled']
+        )
+        results = {
+            item_type: {
+                'count': result['counts'][item_type],
+                'confidence': result['confidences'].get(item_type, 0.0),
+                'details': result.get('details', {})
+            }
+            for item_type in item_types
+        }
+    else:
+        result = object_counter.count_objects(
+            image, item_types[0], preset=options['preset'], tiled=options['tiled']
+        )
+        results = {item_types[0]: result}
+    return results, result.get('details', {}), (datetime.now() - start_time).total_seconds()
+
+def generate_batch_results(images, options):
+    """
+    Process batch images and yield one NDJSON line per image as it completes.
+    
+    Images whose results are all in the result cache are answered first;
+    the pipeline only runs for the remaining images and item types, and
+    their results are stored in the cache. The cache is read with one
+    query, and the result and cache rows are collected and written in one
+    transaction at the end, or when the client disconnects.
+    """
+    preset = options['preset']
+    tiled = options['tiled']
+    item_types = options['item_types']
+    executor = ThreadPoolExecutor(max_workers=app.config['BATCH_WORKERS'], thread_name_prefix='count-batch')
+    futures = {}
+    db_results = []
+    cache_entries = []
+    failed = 0
+    saved = False
+    
+    def save_results():
+        nonlocal saved
+        saved = True
+        try:
+            add_cached_results(cache_entries)
+            db.session.add_all(db_results)
+            db.session.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error saving batch results: {str(e)}")
+            db.session.rollback()
+            return False
+    
+    def result_line(filename, file_path, results, details, processing_time, cache_hit):
+        rows = [
+            CountingResult(
+                id=str(uuid.uuid4()),
+                image_path=file_path,
+                item_type=item_type,
+                predicted_count=results[item_type]['count'],
+                confidence_score=results[item_type].get('confidence', 0.0),
+                processing_time=processing_time,
+                preset=preset
+            )
+            for item_type in item_types
+        ]
+        db_results.extend(rows)
+        if options['multi_target']:
+            line = {
+                'filename': filename,
+                'results': [
+                    {
+                        'id': row.id,
+                        'count': row.predicted_count,
+                        'confidence_score': row.confidence_score,
+                        'item_type': row.item_type
+                    }
+                    for row in rows
+                ],
+                'counts': {row.item_type: row.predicted_count for row in rows}
+            }
+        else:
+            line = {
+                'filename': filename,
+                'id': rows[0].id,
+                'count': rows[0].predicted_count,
+                'confidence_score': rows[0].confidence_score,
+                'item_type': rows[0].item_type
+            }
+        line.update({
+            'preset': preset,
+            'tiled': tiled,
+            'processing_time': processing_time,
+            'image_path': file_path,
+            'cached': cache_hit,
+            'details': details
+        })
+        return ndjson_line(line)
+    
+    try:
+        # Look up stored results on the request thread, which has the database session
+        cached_lines = []
+        start_time = datetime.now()
+        cached = get_cached_results(
+            [(image_hash, item_type) for _, _, image_hash, _ in images for item_type in item_types],
+            preset, tiled
+        )
+        lookup_time = (datetime.now() - start_time).total_seconds() / max(1, len(images))
+        for filename, file_path, image_hash, image in images:
+            results = {item_type: cached[(image_hash, item_type)] for item_type in item_types}
+            missing_types = [item_type for item_type in item_types if results[item_type] is None]
+            if missing_types:
+                future = executor.submit(count_batch_image, image, missing_types, options)
+                futures[future] = (filename, file_path, image_hash, results, missing_types)
+            else:
+                cached_lines.append((filename, file_path, results, lookup_time))
+        
+        for filename, file_path, results, processing_time in cached_lines:
+            details = results[item_types[0]].get('details', {})
+            yield result_line(filename, file_path, results, details, processing_time, True)
+        
+        for future in as_completed(futures):
+            filename, file_path, image_hash, results, missing_types = futures[future]
+            try:
+                pipeline_results, details, processing_time = future.result()
+            except Exception as e:
+                logger.error(f"Error processing batch image {filename}: {str(e)}")
+                failed += 1
+                yield ndjson_line({
+                    'filename': filename,
+                    'image_path': file_path,
+                    'error': f'Error processing image: {str(e)}'
+                })
+                continue
+            
+            for item_type in missing_types:
+                results[item_type] = pipeline_results[item_type]
+                entry = cached_result_entry(image_hash, item_type, results[item_type], preset, tiled)
+                if entry is not None:
+                    cache_entries.append(entry)
+            yield result_line(filename, file_path, results, details, processing_time, False)
+        
+        stored = save_results()
+        logger.info(f"Batch counting completed: {len(images) - failed} images, {failed} failed")
+        yield ndjson_line({
+            'summary': {
+                'images': len(images),
+                'completed': len(images) - failed,
+                'failed': failed,
+                'saved': stored
+            }
+        })
+        
+    finally:
+        # Stop queued images if the client went away, but keep finished results
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        if not saved and db_results:
+            save_results()
+
+def ndjson_line(data):
+    """Format one line of a newline-delimited JSON stream."""
+    return json.dumps(data) + '\n'
+
+def count_single_object(file_path, item_type, image_hash, preset, start_time, progress_callback=None,
+                        tiled=False, image_data=None):
+    """
+    Count one item type in a saved upload and store the result.
+    
+    Args:
+        file_path (str): Path of the saved upload
+        item_type (str): Validated item type to count
+        image_hash (str): SHA-256 digest of the upload
+        preset (str): SAM speed/quality preset
+        start_time (datetime): Start of request processing
+        progress_callback (callable): Optional pipeline progress callback
+        tiled (bool): Segment the image in overlapping tiles
+        image_data (bytes): The upload, counted instead of reading ``file_path``
+        
+    Returns:
+    - dict with the count result
+    """
+    # Reuse the stored result for a previously processed image
+    result = get_cached_result(image_hash, item_type, preset, tiled)
+    cache_hit = result is not None
+    if not cache_hit:
+        result = object_counter.count_objects(
+            file_path if image_data is None else image_data, item_type,
+            preset=preset, progress_callback=progress_callback, tiled=tiled
+        )
+        store_cached_result(image_hash, item_type, result, preset, tiled)
+    processing_time = (datetime.now() - start_time).total_seconds()
+    
+    # Create database record
+    result_id = str(uuid.uuid4())
+    db_result = CountingResult(
+        id=result_id,
+        image_path=file_path,
+        item_type=item_type,
+        predicted_count=result['count'],
+        confidence_score=result.get('confidence', 0.0),
+        processing_time=processing_time,
+        preset=preset
+    )
+    
+    db.session.add(db_result)
+    db.session.commit()
+    
+    response = {
+        'id': result_id,
+        'count': result['count'],
+        'confidence_score': result.get('confidence', 0.0),
+        'processing_time': processing_time,
+        'item_type': item_type,
+        'preset': preset,
+        'tiled': tiled,
+        'image_path': file_path,
+        'cached': cache_hit,
+        'details': result.get('details', {})
+    }
+    
+    logger.info(f"Object counting completed: {response}")
+    return response
+
+def count_multiple_objects(file_path, item_types, image_hash, preset, start_time, progress_callback=None,
+                           tiled=False, image_data=None):
+    """
+    Count several item types from one pipeline run and store one result per type.
+    
+    Types with a stored result are served from the result cache; the
+    pipeline only runs for the remaining types.
+    
+    Args:
+        file_path (str): Path of the saved upload
+        item_types (list): Validated item types to count
+        image_hash (str): SHA-256 digest of the upload
+        preset (str): SAM speed/quality preset
+        start_time (datetime): Start of request processing
+        progress_callback (callable): Optional pipeline progress callback
+        tiled (bool): Segment the image in overlapping tiles
+        image_data (bytes): The upload, counted instead of reading ``file_path``
+        
+    Returns:
+    - dict with per-type results
+    """
+    cached = get_cached_results([(image_hash, item_type) for item_type in item_types], preset, tiled)
+    results = {item_type: cached[(image_hash, item_type)] for item_type in item_types}
+    missing_types = [item_type for item_type in item_types if results[item_type] is None]
+    
+    if missing_types:
+        pipeline_result = object_counter.count_all_objects(
+            file_path if image_data is None else image_data, missing_types,
+            preset=preset, progress_callback=progress_callback, tiled=tiled
+        )
+        details = pipeline_result.get('details', {})
+        for item_type in missing_types:
+            results[item_type] = {
+                'count': pipeline_result['counts'][item_type],
+                'confidence': pipeline_result['confidences'].get(item_type, 0.0),
+                'details': details
+            }
+            store_cached_result(image_hash, item_type, results[item_type], preset, tiled)
+    else:
+        details = results[item_types[0]].get('details', {})
+    
+    counts = {item_type: results[item_type]['count'] for item_type in item_types}
+    processing_time = (datetime.now() - start_time).total_seconds()
+    
+    db_results = [
+        CountingResult(
+            id=str(uuid.uuid4()),
+            image_path=file_path,
+            item_type=item_type,
+            predicted_count=results[item_type]['count'],
+            confidence_score=results[item_type].get('confidence', 0.0),
+            processing_time=processing_time,
+            preset=preset
+        )
+        for item_type in item_types
+    ]
+    db.session.add_all(db_results)
+    db.session.commit()
+    
+    response = {
+        'results': [
+            {
+                'id': db_result.id,
+                'count': db_result.predicted_count,
+                'confidence_score': db_result.confidence_score,
+                'item_type': db_result.item_type
+            }
+            for db_result in db_results
+        ],
+        'counts': counts,
+        'preset': preset,
+        'tiled': tiled,
+        'processing_time': processing_time,
+        'image_path': file_path,
+        'cached': not missing_types,
+        'details': details
+    }
+    
+    logger.info(f"Multi-type object counting completed: {counts}")
+    return response
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    API endpoint to poll an asynchronous counting job.
+    
+    Returns:
+    - JSON response with the job status ("queued", "running", "completed",
+      "failed" or "cancelled"), the current pipeline stage and, once
+      completed, the same result /api/count returns
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job), 200
+
 @app.route('/api/correct', methods=['POST'])
 def correct_count():
     """
@@ -279,9 +1358,41 @@ def status_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.utcnow().isoformat(),
-        'service': 'AI Object Counting API (Real AI)'
+        'service': 'AI Object Counting API (Real AI)',
+        'models_ready': object_counter.is_ready(),
+        'sam_cache': object_counter.get_cache_stats(),
+        'jobs': job_queue.stats(),
+        'upload_writes': upload_writer.stats()
     }), 200
 
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """
+    Readiness check endpoint reporting the load state of each AI model.
+    
+    Returns 200 once all models are loaded, 503 (with Retry-After) before.
+    """
+    ready = object_counter.is_ready()
+    response = jsonify({
+        'ready': ready,
+        'models': object_counter.get_load_status(),
+        'timestamp': datetime.utcnow().isoformat()
+    })
+    if not ready:
+        response.status_code = 503
+        response.headers['Retry-After'] = str(app.config['MODEL_RETRY_AFTER'])
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """
+    Metrics endpoint in the Prometheus text format.
+    
+    Includes per-stage pipeline latencies, request counts and latencies,
+    job queue depth, cache lookups and model load times of this process.
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/history', methods=['GET'])
 def get_history():
     """
@@ -310,7 +1421,7 @@ def get_history():
         logger.error(f"Error in get_history: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/uploads/<filename>')
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     """
     Serve uploaded files (for development purposes).
@@ -320,7 +1431,9 @@ def uploaded_file(filename):
 
 @app.errorhandler(413)
 def too_large(e):
-    return jsonify({'error': 'File too large. Maximum size is 16MB'}), 413
+    # The batch endpoint has its own, larger limit (see UploadRequest)
+    max_mb = request.max_content_length // (1024 * 1024)
+    return jsonify({'error': f'File too large. Maximum size is {max_mb}MB'}), 413
 
 @app.errorhandler(404)
 def not_found(e):
@@ -331,10 +1444,15 @@ def internal_error(e):
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
-    # Create database tables
+    # Create database tables and upgrade the ones of older versions
     with app.app_context():
-        db.create_all()
+        upgrade_database(db.engine)
         logger.info("Database tables created")
     
+    # Load models in the background; with the debug reloader only the
+    # serving child process loads them
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_model_loading()
+    
     # Run the application
     app.run(debug=True, host='0.0.0.0', port=5001)
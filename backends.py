@@ -0,0 +1,875 @@
+import os
+import json
+import hashlib
+import threading
+import urllib.request
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers import AutoImageProcessor, AutoModelForImageClassification, pipeline
+from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+
+from sam_cache import CachingSamPredictor
+from batching import MicroBatcher
+from classifier_export import EXPORT_FORMATS, load_checked_classifier
+from precision import (
+    autocast, autocast_forward, quantize_linear_layers, module_size_mb, compare_logits, compare_masks
+)
+
+logger = logging.getLogger(__name__)
+
+RESNET_MODEL_NAME = "microsoft/resnet-50"
+LABEL_MODEL_NAME = "typeform/distilbert-base-uncased-mnli"
+
+# Bump when the way the label table is computed changes
+LABEL_TABLE_VERSION = 1
+
+# Speed/quality presets for the SAM automatic mask generator. Areas are in
+# pixels of the image SAM is given, i.e. after ObjectCounter downscales it to
+# max_side (1024 in the server): 500 pixels are about 0.06% of a 1024x768
+# image, whatever the resolution of the upload.
+SAM_PRESETS = {
+    'fast': {
+        'points_per_side': 8,
+        'pred_iou_thresh': 0.7,
+        'stability_score_thresh': 0.85,
+        'min_mask_region_area': 0,
+    },
+    'balanced': {
+        'points_per_side': 16,
+        'pred_iou_thresh': 0.7,
+        'stability_score_thresh': 0.85,
+        'min_mask_region_area': 500,
+    },
+    'accurate': {
+        'points_per_side': 32,
+        'pred_iou_thresh': 0.86,
+        'stability_score_thresh': 0.92,
+        'min_mask_region_area': 500,
+    },
+}
+DEFAULT_SAM_PRESET = 'balanced'
+
+# Parameters of the classical (thresholding + watershed) segmenter
+CLASSICAL_PARAMS = {
+    'work_side': 384,  # longest image side segmentation runs at
+    'smoothing_sigma': 1.0,  # Gaussian blur (work pixels) before thresholding
+    'min_contrast': 20.0,  # minimum colour distance from the background
+    'min_area_fraction': 0.0005,  # smaller objects are dropped
+    'max_area_fraction': 0.9,  # larger "objects" are background
+    'split_touching': True,  # separate touching objects with a watershed
+    'min_peak_distance': 4,  # work pixels between object centres
+}
+
+# Presets that run a dedicated segmenter instead of the configured one
+SEGMENTER_PRESETS = {'classical': 'classical'}
+
+# Inference runtimes for the ResNet-50 classifier
+CLASSIFIER_BACKENDS = ('eager',) + EXPORT_FORMATS
+
+
+class Segmenter:
+    """
+    Pipeline stage 1: split an image into candidate object masks.
+    
+    Backends are created with the pipeline options as keyword arguments
+    (``device``, ``precision``, ``sam_cache``, ``batch_size``, ``batch_wait_ms``,
+    ``runtime``, ``candidate_labels``) and ignore the ones they do not use.
+    """
+    
+    name = None
+    
+    def __init__(self, **options):
+        pass
+    
+    def load(self):
+        """Load the models (called once by ObjectCounter.load)."""
+    
+    def segment(self, image_array, preset):
+        """
+        Segment an image.
+        
+        May be called from several threads at once (async jobs, batch and
+        tile pools); backends that keep per-image state must serialize it.
+        
+        Args:
+            image_array (np.ndarray): RGB image (H, W, 3)
+            preset (str): Speed/quality preset name (see SAM_PRESETS)
+        
+        Returns:
+            list: Mask dicts with a boolean ``segmentation`` (H, W), its
+                ``bbox`` (XYWH) and ``area`` in pixels
+        """
+        raise NotImplementedError
+    
+    def get_config(self, preset):
+        """
+        Get the settings that determine the masks for a preset.
+        
+        Returns:
+            dict: JSON-serializable settings, part of the result cache key
+        """
+        return {'segmenter': self.name}
+    
+    def get_info(self):
+        """
+        Get information about the backend for /api/status and model info.
+        
+        Returns:
+            dict: Backend information
+        """
+        return {'name': self.name}
+    
+    def share_memory(self):
+        """Move model weights into shared memory before forking workers."""
+
+
+class Classifier:
+    """Pipeline stage 2: assign a class name to every segment crop."""
+    
+    name = None
+    
+    def __init__(self, **options):
+        pass
+    
+    def load(self, cache_dir):
+        """
+        Load the models (called once by ObjectCounter.load).
+        
+        Args:
+            cache_dir (str): Directory for downloaded and exported models
+        """
+    
+    def classify(self, crops):
+        """
+        Classify a batch of segment crops.
+        
+        Args:
+            crops (list): Masked segment tensors (C, H, W), uint8
+        
+        Returns:
+            list: Class name for each crop
+        """
+        raise NotImplementedError
+    
+    def get_class_names(self):
+        """
+        Get every class name classify() can return.
+        
+        Returns:
+            list: Class names
+        """
+        raise NotImplementedError
+    
+    def get_config(self):
+        return {'classifier': self.name}
+    
+    def get_info(self):
+        return {'name': self.name}
+    
+    def share_memory(self):
+        pass
+
+
+class Refiner:
+    """Pipeline stage 3: map classifier class names to the countable item types."""
+    
+    name = None
+    
+    def __init__(self, **options):
+        pass
+    
+    def load(self, class_names, cache_dir):
+        """
+        Prepare the mapping (called once by ObjectCounter.load).
+        
+        Args:
+            class_names (list): Every class name the classifier can return
+            cache_dir (str): Directory for downloaded models and lookup tables
+        """
+    
+    def refine(self, predicted_classes):
+        """
+        Map class names to item types.
+        
+        Args:
+            predicted_classes (list): Class name for each segment
+        
+        Returns:
+            list: Item type (or "unknown") for each segment
+        """
+        raise NotImplementedError
+    
+    def get_config(self):
+        return {'refiner': self.name}
+    
+    def get_info(self):
+        return {'name': self.name}
+
+
+class SamSegmenter(Segmenter):
+    """Segment Anything (ViT-B) automatic mask generation."""
+    
+    name = 'sam'
+    
+    def __init__(self, device='cpu', precision='fp32', sam_cache=None, **options):
+        """
+        Args:
+            device (str): Torch device
+            precision (str): "fp32", "bf16" or "int8-dynamic"
+            sam_cache (SamCache): Optional cache for image embeddings
+        """
+        self.device = device
+        self.precision = precision
+        self.sam_cache = sam_cache
+        self.sam = None
+        self.mask_generators = {}
+        self.precision_report = {}
+        # A mask generator's predictor keeps the current image's embedding
+        # between set_image() and predict(), so one image at a time per preset
+        self.generate_locks = {preset: threading.Lock() for preset in SAM_PRESETS}
+    
+    def load(self):
+        # Download SAM checkpoint if not exists
+        checkpoint_path = "sam_vit_b_01ec64.pth"
+        if not os.path.exists(checkpoint_path):
+            logger.info("Downloading SAM checkpoint...")
+            url = "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth"
+            urllib.request.urlretrieve(url, checkpoint_path)
+            logger.info("SAM checkpoint downloaded successfully")
+        
+        # Load SAM model
+        self.sam = sam_model_registry["vit_b"](checkpoint_path)
+        self.sam.to(self.device)
+        self._initialize_precision()
+        
+        # Initialize one mask generator per preset, all sharing the loaded
+        # SAM model and reusing image embeddings of previously seen images
+        self.mask_generators = {}
+        for preset, params in SAM_PRESETS.items():
+            generator = SamAutomaticMaskGenerator(model=self.sam, **params)
+            if self.sam_cache is not None:
+                generator.predictor = CachingSamPredictor(self.sam, self.sam_cache)
+            self.mask_generators[preset] = generator
+        
+        logger.info("SAM model initialized successfully")
+    
+    def segment(self, image_array, preset):
+        with self.generate_locks[preset]:
+            return self.mask_generators[preset].generate(image_array)
+    
+    def get_config(self, preset):
+        return {
+            'segmenter': self.name,
+            'sam_model': 'vit_b',
+            'sam_preset': preset,
+            'sam_params': SAM_PRESETS[preset]
+        }
+    
+    def get_info(self):
+        return {
+            'name': self.name,
+            'model': 'Segment Anything Model (ViT-B)',
+            'precision_report': self.precision_report
+        }
+    
+    def share_memory(self):
+        if self.sam is not None:
+            self.sam.share_memory()
+    
+    def _initialize_precision(self):
+        """
+        Convert SAM to the configured precision and record the accuracy delta.
+        
+        "int8-dynamic" quantizes the linear layers of the image encoder (its
+        attention and MLP layers hold nearly all of its weights) and of the
+        mask decoder, "bf16" runs both under bfloat16 autocast. Both are
+        compared against float32 on fixed synthetic inputs.
+        """
+        if self.precision == 'fp32':
+            return
+        
+        generator = torch.Generator().manual_seed(0)
+        encoder = self.sam.image_encoder
+        embedding_size = self.sam.prompt_encoder.image_embedding_size
+        image_embeddings = torch.randn(
+            1, self.sam.prompt_encoder.embed_dim, *embedding_size, generator=generator
+        ).to(self.device)
+        points = (
+            (torch.rand(16, 1, 2, generator=generator) * encoder.img_size).to(self.device),
+            torch.ones(16, 1, dtype=torch.int, device=self.device)
+        )
+        report = {'size_mb_fp32': module_size_mb(self.sam.mask_decoder)}
+        
+        reference_masks = self._run_mask_decoder(image_embeddings, points)
+        encoder_input = torch.randn(1, 3, encoder.img_size, encoder.img_size, generator=generator).to(self.device)
+        encoder_size_mb_fp32 = module_size_mb(encoder)
+        with torch.inference_mode():
+            reference_embeddings = encoder(encoder_input)
+        if self.precision == 'bf16':
+            autocast_forward(encoder, self.precision, self.device)
+            autocast_forward(self.sam.mask_decoder, self.precision, self.device)
+        else:
+            self.sam.image_encoder = encoder = quantize_linear_layers(encoder)
+            self.sam.mask_decoder = quantize_linear_layers(self.sam.mask_decoder)
+        with torch.inference_mode():
+            embeddings = encoder(encoder_input)
+        self.precision_report['sam_image_encoder'] = {
+            'max_abs_diff': round((reference_embeddings - embeddings).abs().max().item(), 5),
+            'cosine_similarity': round(
+                F.cosine_similarity(reference_embeddings.flatten(), embeddings.flatten(), dim=0).item(), 5
+            ),
+            'size_mb_fp32': encoder_size_mb_fp32,
+            'size_mb': module_size_mb(encoder)
+        }
+        
+        report.update(compare_masks(reference_masks, self._run_mask_decoder(image_embeddings, points)))
+        report['size_mb'] = module_size_mb(self.sam.mask_decoder)
+        self.precision_report['sam_mask_decoder'] = report
+        logger.info(f"SAM running in {self.precision}: {self.precision_report}")
+    
+    def _run_mask_decoder(self, image_embeddings, points):
+        """
+        Predict masks for point prompts from precomputed image embeddings.
+        
+        Args:
+            image_embeddings (torch.Tensor): Image encoder output (1, C, H, W)
+            points (tuple): Point coordinates (N, 1, 2) and labels (N, 1)
+        
+        Returns:
+            torch.Tensor: Low resolution mask logits (N, 3, 4H, 4W)
+        """
+        with torch.inference_mode():
+            sparse_embeddings, dense_embeddings = self.sam.prompt_encoder(
+                points=points, boxes=None, masks=None
+            )
+            masks, _ = self.sam.mask_decoder(
+                image_embeddings=image_embeddings,
+                image_pe=self.sam.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=True
+            )
+        return masks
+
+
+class ResNetClassifier(Classifier):
+    """ResNet-50 ImageNet classifier, optionally exported to TorchScript/ONNX."""
+    
+    name = 'resnet'
+    
+    def __init__(self, device='cpu', precision='fp32', batch_size=16, batch_wait_ms=0,
+                 runtime='eager', model_name=RESNET_MODEL_NAME, **options):
+        """
+        Args:
+            device (str): Torch device
+            precision (str): "fp32", "bf16" or "int8-dynamic" (eager runtime only;
+                int8 only applies to the fc head)
+            batch_size (int): Maximum number of crops per forward pass
+            batch_wait_ms (float): Time to wait for crops of concurrent requests
+                to share a forward pass (0 disables cross-request batching)
+            runtime (str): "eager" PyTorch, or an exported "torchscript" /
+                "onnx" (ONNX Runtime) model
+            model_name (str): HuggingFace model name
+        """
+        if runtime not in CLASSIFIER_BACKENDS:
+            raise ValueError(
+                f"Unknown classifier backend: {runtime}. "
+                f"Must be one of: {list(CLASSIFIER_BACKENDS)}"
+            )
+        self.device = device
+        self.precision = precision
+        self.runtime = runtime
+        self.model_name = model_name
+        self.image_processor = None
+        self.model = None
+        self.active_runtime = 'eager'
+        self.runner = self._run_eager
+        self.parity = None
+        self.precision_report = {}
+        self.batcher = None
+        if batch_wait_ms > 0:
+            self.batcher = MicroBatcher(
+                lambda pixel_values: self.runner(pixel_values),
+                max_batch_size=batch_size,
+                max_wait_ms=batch_wait_ms
+            )
+    
+    def load(self, cache_dir):
+        self.image_processor, self.model = self._load_model(cache_dir)
+        self._initialize_runtime(cache_dir)
+        self._initialize_precision()
+    
+    def classify(self, crops):
+        inputs = self.image_processor(images=crops, return_tensors="pt")
+        if self.batcher is not None:
+            logits = self.batcher.run(inputs['pixel_values'])
+        else:
+            logits = self.runner(inputs['pixel_values'])
+        return [self.model.config.id2label[idx] for idx in logits.argmax(-1).tolist()]
+    
+    def get_class_names(self):
+        return sorted(set(self.model.config.id2label.values()))
+    
+    def get_config(self):
+        return {'classifier': self.name, 'classification_model': self.model_name}
+    
+    def get_info(self):
+        return {
+            'name': self.name,
+            'model': self.model_name,
+            'runtime': self.active_runtime,
+            'runtime_parity': self.parity,
+            'batching': self.batcher.stats() if self.batcher is not None else None,
+            'precision_report': self.precision_report
+        }
+    
+    def share_memory(self):
+        if self.model is not None:
+            self.model.share_memory()
+    
+    def _load_model(self, cache_dir):
+        """
+        Load the image processor and the eager model.
+        
+        Args:
+            cache_dir (str): HuggingFace cache directory
+        
+        Returns:
+            tuple: (image_processor, model)
+        """
+        image_processor = AutoImageProcessor.from_pretrained(self.model_name, cache_dir=cache_dir)
+        model = AutoModelForImageClassification.from_pretrained(self.model_name, cache_dir=cache_dir)
+        return image_processor, model.eval()
+    
+    def _initialize_runtime(self, cache_dir):
+        """
+        Switch to an exported TorchScript/ONNX model if configured.
+        
+        The export is cached in ``cache_dir`` and checked against the eager
+        model (a cached export that fails the check is exported again); on
+        any failure the eager model stays in use.
+        
+        Args:
+            cache_dir (str): Directory for exported models
+        """
+        self.runner = self._run_eager
+        self.active_runtime = 'eager'
+        if self.runtime == 'eager':
+            return
+        
+        try:
+            example_input = self._example_input(2)
+            runner, self.parity = load_checked_classifier(
+                self.model, self._run_eager, self.runtime, cache_dir, self.model_name, example_input
+            )
+            
+            self.runner = runner
+            self.active_runtime = self.runtime
+            logger.info(
+                f"Using {self.runtime} classifier backend "
+                f"(max abs logit difference {self.parity:.2e})"
+            )
+        except Exception as e:
+            logger.warning(
+                f"Could not use {self.runtime} classifier backend, "
+                f"falling back to eager PyTorch: {str(e)}"
+            )
+    
+    def _initialize_precision(self):
+        """
+        Convert the eager model to the configured precision and record the
+        accuracy delta against float32.
+        
+        ResNet-50 is convolutional; "int8-dynamic" only quantizes its final
+        fc layer, so it shrinks the model a little but barely speeds it up.
+        Exported TorchScript/ONNX classifiers keep running in float32.
+        """
+        if self.precision == 'fp32':
+            return
+        if self.active_runtime != 'eager':
+            logger.info(
+                f"Precision {self.precision} does not apply to the "
+                f"{self.active_runtime} classifier backend"
+            )
+            return
+        
+        example_input = self._example_input(8)
+        size_mb_fp32 = module_size_mb(self.model)
+        with torch.inference_mode():
+            reference_logits = self.model(pixel_values=example_input).logits
+        
+        # bf16 is applied by autocast in _run_eager
+        if self.precision == 'int8-dynamic':
+            self.model = quantize_linear_layers(self.model)
+        
+        report = {'size_mb_fp32': size_mb_fp32}
+        report.update(compare_logits(reference_logits, self._run_eager(example_input)))
+        report['size_mb'] = module_size_mb(self.model)
+        self.precision_report['resnet'] = report
+        logger.info(f"ResNet-50 running in {self.precision}: {report}")
+    
+    def _example_input(self, batch_size):
+        """
+        Create a random input batch of the image processor's size.
+        
+        Args:
+            batch_size (int): Number of images in the batch
+        
+        Returns:
+            torch.Tensor: Pixel values (batch_size, 3, H, W)
+        """
+        dummy_crop = np.zeros((32, 32, 3), dtype=np.uint8)
+        input_size = self.image_processor(images=[dummy_crop], return_tensors="pt")['pixel_values'].shape[-2:]
+        generator = torch.Generator().manual_seed(0)
+        return torch.randn(batch_size, 3, *input_size, generator=generator)
+    
+    def _run_eager(self, pixel_values):
+        """
+        Run the eager model.
+        
+        Args:
+            pixel_values (torch.Tensor): Preprocessed batch (N, 3, H, W)
+        
+        Returns:
+            torch.Tensor: Logits (N, num_classes)
+        """
+        with torch.inference_mode(), autocast(self.precision, self.device):
+            return self.model(pixel_values=pixel_values).logits.float()
+
+
+class LabelTableRefiner(Refiner):
+    """
+    Zero-shot DistilBERT label refinement through a precomputed lookup table.
+    
+    Every classifier class name is mapped to a candidate label once, and the
+    table is cached on disk, so DistilBERT is not needed at request time.
+    """
+    
+    name = 'label_table'
+    
+    def __init__(self, candidate_labels=(), table=None, label_model=LABEL_MODEL_NAME, **options):
+        """
+        Args:
+            candidate_labels (list): Item types to map class names to
+            table (dict): Optional ready-made class name -> label table
+            label_model (str): HuggingFace zero-shot classification model
+        """
+        self.candidate_labels = list(candidate_labels)
+        self.table = table
+        self.label_model = label_model
+    
+    def load(self, class_names, cache_dir):
+        if self.table is None:
+            self.table = self._load_table(class_names, cache_dir)
+    
+    def refine(self, predicted_classes):
+        return [self.table.get(c, "unknown") for c in predicted_classes]
+    
+    def get_config(self):
+        return {
+            'refiner': self.name,
+            'label_model': self.label_model,
+            'label_table_version': LABEL_TABLE_VERSION
+        }
+    
+    def get_info(self):
+        return {'name': self.name, 'model': f'{self.label_model} (zero-shot)'}
+    
+    def _load_table(self, class_names, cache_dir):
+        """
+        Load or build the class name -> candidate label lookup table.
+        
+        The table is stored on disk under a key derived from the class names,
+        the label model and the candidate labels. DistilBERT is only loaded
+        when no cached table exists, and is released again once the table
+        has been built.
+        
+        Args:
+            class_names (list): Class names to map
+            cache_dir (str): Directory for the cached table
+        
+        Returns:
+            dict: Candidate label for each class name
+        """
+        class_names = sorted(set(class_names))
+        key_source = json.dumps({
+            'version': LABEL_TABLE_VERSION,
+            'class_names': hashlib.sha256('\n'.join(class_names).encode('utf-8')).hexdigest(),
+            'label_model': self.label_model,
+            'candidate_labels': self.candidate_labels
+        }, sort_keys=True)
+        table_key = hashlib.sha256(key_source.encode('utf-8')).hexdigest()[:16]
+        table_path = os.path.join(cache_dir, f"label_table_{table_key}.json")
+        
+        if os.path.exists(table_path):
+            try:
+                with open(table_path, 'r') as f:
+                    label_table = json.load(f)['table']
+                logger.info(f"Loaded label table from {table_path}")
+                return label_table
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring unreadable label table {table_path}: {str(e)}")
+        
+        # Initialize DistilBERT zero-shot classifier
+        logger.info("Building label table with DistilBERT...")
+        label_classifier = pipeline(
+            "zero-shot-classification",
+            model=self.label_model,
+            model_kwargs={"cache_dir": cache_dir}
+        )
+        
+        results = label_classifier(class_names, self.candidate_labels, batch_size=32)
+        label_table = {
+            class_name: result['labels'][0]
+            for class_name, result in zip(class_names, results)
+        }
+        del label_classifier
+        
+        try:
+            tmp_path = f"{table_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'key': json.loads(key_source), 'table': label_table}, f)
+            os.replace(tmp_path, table_path)
+            logger.info(f"Label table saved to {table_path}")
+        except OSError as e:
+            logger.warning(f"Could not save label table: {str(e)}")
+        
+        return label_table
+
+
+class IdentityRefiner(Refiner):
+    """Use the classifier's class names as item types unchanged."""
+    
+    name = 'identity'
+    
+    def refine(self, predicted_classes):
+        return list(predicted_classes)
+
+
+class ClassicalSegmenter(Segmenter):
+    """
+    Model-free segmentation for simple, uniform backgrounds.
+    
+    Separates foreground from the background colour (estimated from the
+    image border) with an Otsu threshold, splits touching objects with a
+    distance-transform watershed and returns one mask per connected object.
+    Runs in tens of milliseconds on the CPU instead of seconds for SAM.
+    """
+    
+    name = 'classical'
+    
+    def __init__(self, params=None, **options):
+        """
+        Args:
+            params (dict): Overrides for CLASSICAL_PARAMS
+        """
+        self.params = dict(CLASSICAL_PARAMS, **(params or {}))
+        self.ndimage = None
+    
+    def load(self):
+        from scipy import ndimage
+        self.ndimage = ndimage
+    
+    def segment(self, image_array, preset):
+        ndimage = self.ndimage
+        params = self.params
+        height, width = image_array.shape[:2]
+        
+        # Segment a downscaled copy; labels are mapped back at the end
+        factor = min(1.0, params['work_side'] / max(height, width))
+        work = image_array[..., :3]
+        if factor < 1.0:
+            size = (max(1, round(width * factor)), max(1, round(height * factor)))
+            work = np.asarray(Image.fromarray(np.ascontiguousarray(work)).resize(size, Image.BILINEAR))
+        work = work.astype(np.float32)
+        
+        # Foreground: pixels far enough from the median border colour
+        border = np.concatenate([work[0], work[-1], work[:, 0], work[:, -1]])
+        distance = np.sqrt(((work - np.median(border, axis=0)) ** 2).sum(axis=-1))
+        if params['smoothing_sigma']:
+            distance = ndimage.gaussian_filter(distance, params['smoothing_sigma'])
+        threshold = max(_otsu_threshold(distance), params['min_contrast'])
+        foreground = ndimage.binary_opening(distance > threshold)
+        foreground = ndimage.binary_fill_holes(foreground)
+        
+        if params['split_touching']:
+            labels = self._split_touching(foreground)
+        else:
+            labels, _ = ndimage.label(foreground)
+        
+        if factor < 1.0:
+            rows = np.minimum(((np.arange(height) + 0.5) * labels.shape[0] / height).astype(np.intp), labels.shape[0] - 1)
+            cols = np.minimum(((np.arange(width) + 0.5) * labels.shape[1] / width).astype(np.intp), labels.shape[1] - 1)
+            labels = labels[rows[:, None], cols]
+        
+        areas = np.bincount(labels.ravel())
+        min_area = params['min_area_fraction'] * height * width
+        max_area = params['max_area_fraction'] * height * width
+        masks = []
+        for label, box in enumerate(ndimage.find_objects(labels), start=1):
+            if box is None or not min_area <= areas[label] <= max_area:
+                continue
+            segmentation = np.zeros((height, width), dtype=bool)
+            segmentation[box] = labels[box] == label
+            y_slice, x_slice = box
+            masks.append({
+                'segmentation': segmentation,
+                'bbox': [x_slice.start, y_slice.start, x_slice.stop - 1 - x_slice.start, y_slice.stop - 1 - y_slice.start],
+                'area': int(areas[label])
+            })
+        return masks
+    
+    def get_config(self, preset):
+        return {'segmenter': self.name, 'classical_params': self.params}
+    
+    def get_info(self):
+        return {'name': self.name, 'params': self.params}
+    
+    def _split_touching(self, foreground):
+        """
+        Label foreground objects, splitting touching ones between their centres.
+        
+        Args:
+            foreground (np.ndarray): Boolean foreground mask
+            
+        Returns:
+            np.ndarray: Object labels (0 is background)
+        """
+        ndimage = self.ndimage
+        min_distance = self.params['min_peak_distance']
+        distance = ndimage.distance_transform_edt(foreground)
+        
+        # One marker per distance maximum (object centre)
+        peaks = (distance == ndimage.maximum_filter(distance, size=2 * min_distance + 1)) & (distance >= min_distance / 2)
+        markers, marker_count = ndimage.label(peaks)
+        
+        components, _ = ndimage.label(foreground)
+        if marker_count == 0:
+            return components
+        
+        # Give every pixel the marker nearest to it, which cuts touching
+        # objects along the line halfway between their centres
+        _, (rows, cols) = ndimage.distance_transform_edt(markers == 0, return_indices=True)
+        labels = markers[rows, cols]
+        
+        # Pixels whose nearest marker lies in another object (e.g. objects
+        # too thin to have a peak) keep their connected component instead
+        marker_components = np.zeros(marker_count + 1, dtype=components.dtype)
+        marker_components[markers[peaks]] = components[peaks]
+        labels = np.where(marker_components[labels] == components, labels, marker_count + components)
+        labels[~foreground] = 0
+        
+        # Renumber to consecutive labels
+        used = np.unique(labels)
+        used = used[used > 0]
+        lookup = np.zeros(labels.max() + 1, dtype=np.int32)
+        lookup[used] = np.arange(1, len(used) + 1)
+        return lookup[labels]
+
+
+def _otsu_threshold(values, bins=256):
+    """
+    Otsu's threshold, maximizing the between-class variance.
+    
+    Args:
+        values (np.ndarray): Values to split
+        bins (int): Histogram bins
+        
+    Returns:
+        float: Threshold value
+    """
+    histogram, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(histogram)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(histogram * centers)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return float(centers[np.argmax(variance)])
+
+
+class StubSegmenter(Segmenter):
+    """
+    Deterministic, model-free stand-in segmenter for tests and load tests.
+    
+    Splits the image into a ``grid`` x ``grid`` layout of rectangular masks.
+    """
+    
+    name = 'stub'
+    
+    def __init__(self, grid=3, **options):
+        self.grid = grid
+    
+    def segment(self, image_array, preset):
+        height, width = image_array.shape[:2]
+        rows = np.linspace(0, height, self.grid + 1).astype(int)
+        cols = np.linspace(0, width, self.grid + 1).astype(int)
+        masks = []
+        for y_start, y_end in zip(rows[:-1], rows[1:]):
+            for x_start, x_end in zip(cols[:-1], cols[1:]):
+                if y_end <= y_start or x_end <= x_start:
+                    continue
+                segmentation = np.zeros((height, width), dtype=bool)
+                segmentation[y_start:y_end, x_start:x_end] = True
+                masks.append({
+                    'segmentation': segmentation,
+                    'bbox': [int(x_start), int(y_start), int(x_end - x_start - 1), int(y_end - y_start - 1)],
+                    'area': int((y_end - y_start) * (x_end - x_start))
+                })
+        return masks
+    
+    def get_config(self, preset):
+        return {'segmenter': self.name, 'grid': self.grid}
+
+
+class StubClassifier(Classifier):
+    """
+    Deterministic, model-free stand-in classifier for tests and load tests.
+    
+    Picks a candidate label from the mean brightness of each crop, so equal
+    images always get equal labels.
+    """
+    
+    name = 'stub'
+    
+    def __init__(self, candidate_labels=(), **options):
+        self.candidate_labels = list(candidate_labels)
+    
+    def classify(self, crops):
+        return [
+            self.candidate_labels[int(crop.float().mean().item()) % len(self.candidate_labels)]
+            for crop in crops
+        ]
+    
+    def get_class_names(self):
+        return list(self.candidate_labels)
+
+
+# Backends selectable by name, per pipeline stage
+SEGMENTERS = {'sam': SamSegmenter, 'classical': ClassicalSegmenter, 'stub': StubSegmenter}
+CLASSIFIERS = {'resnet': ResNetClassifier, 'stub': StubClassifier}
+REFINERS = {'label_table': LabelTableRefiner, 'identity': IdentityRefiner}
+
+
+def create_backend(registry, backend, **options):
+    """
+    Create a pipeline stage backend.
+    
+    Args:
+        registry (dict): SEGMENTERS, CLASSIFIERS or REFINERS
+        backend: Backend name in ``registry``, or a ready backend instance
+        **options: Pipeline options passed to the backend class
+    
+    Returns:
+        The backend instance
+    """
+    if not isinstance(backend, str):
+        return backend
+    if backend not in registry:
+        raise ValueError(f"Unknown backend: {backend}. Must be one of: {list(registry)}")
+    return registry[backend](**options)
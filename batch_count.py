@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Offline batch counter for directories of images.
+
+Runs the object counting pipeline over every image below a directory with
+a pool of worker processes (each holding its own copy of the models) and
+appends one result per image to a JSONL or CSV file as soon as it is done.
+Re-running the same command after an interruption skips the images that
+already have a result in the output file.
+
+Usage:
+    python batch_count.py photos/ results.jsonl --item-type car,tree --workers 4
+    python batch_count.py photos/ results.csv --item-type '*' --preset fast
+    python batch_count.py aerial/ results.jsonl --item-type car --tiled
+"""
+
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+
+# Per-process ObjectCounter, created by init_worker()
+worker_counter = None
+worker_options = None
+worker_error = None
+
+
+def parse_args(argv=None):
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Count objects in a directory tree of images')
+    parser.add_argument('input_dir', help='Directory to search for images (recursively)')
+    parser.add_argument('output', help='Output file; .csv for CSV, anything else for JSONL')
+    parser.add_argument('--item-type', default='*',
+                        help='Item type(s) to count: a comma-separated list or "*" for all (default: *)')
+    parser.add_argument('--preset', default=None, help='SAM speed/quality preset, or "classical" for fast model-free '
+                             'segmentation (default: balanced)')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), default=None,
+                        help='Output format (default: from the output file extension)')
+    parser.add_argument('--workers', type=int, default=max(1, cpu_count // 2),
+                        help='Number of worker processes (default: half the CPU cores)')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='Torch intra-op threads per worker (default: CPU cores / workers)')
+    parser.add_argument('--max-side', type=int, default=1024,
+                        help='Downscale images to this longest side before segmentation (default: 1024)')
+    parser.add_argument('--tiled', action='store_true',
+                        help='Segment images in overlapping tiles at full resolution, for small objects in large images')
+    parser.add_argument('--tile-size', type=int, default=1024,
+                        help='Tile side length with --tiled (default: 1024)')
+    args = parser.parse_args(argv)
+    
+    args.workers = max(1, args.workers)
+    if args.threads_per_worker is None:
+        args.threads_per_worker = max(1, cpu_count // args.workers)
+    if args.format is None:
+        args.format = 'csv' if args.output.lower().endswith('.csv') else 'jsonl'
+    return args
+
+
+def find_images(input_dir):
+    """
+    Find all image files below a directory.
+    
+    Args:
+        input_dir (str): Root directory
+    
+    Returns:
+        list: Image paths relative to ``input_dir``, sorted
+    """
+    images = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in files:
+            if '.' in name and name.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS:
+                images.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(images)
+
+
+def load_processed(output_path, output_format):
+    """
+    Read the images that already have a successful result in the output file.
+    
+    Failed images, a last line without a line break (cut off by an
+    interrupted run) and CSV rows that lack columns are ignored, so those
+    images are processed again.
+    
+    Args:
+        output_path (str): Output file
+        output_format (str): "jsonl" or "csv"
+    
+    Returns:
+        set: Relative paths of processed images
+    """
+    processed = set()
+    if not os.path.exists(output_path):
+        return processed
+    
+    with open(output_path, 'r', newline='') as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        lines.pop()
+    
+    if output_format == 'csv':
+        records = [
+            record for record in csv.DictReader(lines)
+            if None not in record and None not in record.values()
+        ]
+    else:
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    
+    for record in records:
+        if record.get('path') and not record.get('error'):
+            processed.add(record['path'])
+    return processed
+
+
+def drop_partial_line(output_path):
+    """
+    Remove a last line without a line break, left by an interrupted run.
+    
+    Args:
+        output_path (str): Output file
+    """
+    with open(output_path, 'rb+') as f:
+        position = f.seek(0, os.SEEK_END)
+        if position == 0:
+            return
+        f.seek(position - 1)
+        if f.read(1) == b'\n':
+            return
+        
+        # Search backwards for the end of the last complete line
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            line_end = f.read(position - start).rfind(b'\n')
+            if line_end >= 0:
+                f.truncate(start + line_end + 1)
+                return
+            position = start
+        f.truncate(0)
+
+
+class ResultWriter:
+    """Append results to a JSONL or CSV file, flushing after every record."""
+    
+    def __init__(self, output_path, output_format, item_types):
+        self.output_format = output_format
+        self.item_types = item_types
+        self.fieldnames = ['path', 'processing_time', 'total_segments', 'error'] + [
+            f'count_{item_type}' for item_type in item_types
+        ]
+        
+        if os.path.exists(output_path):
+            drop_partial_line(output_path)
+        is_new = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+        if not is_new and output_format == 'csv':
+            with open(output_path, 'r', newline='') as f:
+                header = next(csv.reader(f), None)
+            if header != self.fieldnames:
+                raise ValueError(
+                    f"{output_path} has columns {header}, expected {self.fieldnames}. "
+                    f"Use the same item types to resume, or a new output file."
+                )
+        
+        self._file = open(output_path, 'a', newline='')
+        
+        if output_format == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=self.fieldnames)
+            if is_new:
+                self._csv.writeheader()
+    
+    def write(self, record):
+        if self.output_format == 'csv':
+            row = {key: record.get(key) for key in ('path', 'processing_time', 'total_segments', 'error')}
+            for item_type in self.item_types:
+                row[f'count_{item_type}'] = record.get('counts', {}).get(item_type)
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+    
+    def close(self):
+        self._file.close()
+
+
+def init_worker(options):
+    """Load the models in a worker process."""
+    global worker_counter, worker_options, worker_error
+    from model_pipeline import ObjectCounter, limit_torch_threads
+    
+    limit_torch_threads(options['threads_per_worker'])
+    
+    logging.basicConfig(level=logging.WARNING)
+    worker_options = options
+    try:
+        worker_counter = ObjectCounter(
+            max_side=options['max_side'], cache_size_mb=0, tile_size=options['tile_size']
+        )
+    except Exception as e:
+        # Raising here would make the pool restart the worker forever
+        worker_error = f"Could not load AI models: {str(e)}"
+
+
+def count_image(relative_path):
+    """
+    Count objects in one image (runs in a worker process).
+    
+    Args:
+        relative_path (str): Image path relative to the input directory
+    
+    Returns:
+        dict: Result record
+    """
+    record = {'path': relative_path}
+    start_time = time.perf_counter()
+    try:
+        if worker_counter is None:
+            raise RuntimeError(worker_error)
+        result = worker_counter.count_all_objects(
+            os.path.join(worker_options['input_dir'], relative_path),
+            worker_options['item_types'],
+            preset=worker_options['preset'],
+            tiled=worker_options['tiled']
+        )
+        if result['details'].get('fallback_mode'):
+            raise RuntimeError('AI models are not available (fallback mode)')
+        record.update(
+            counts=result['counts'],
+            confidences=result['confidences'],
+            total_segments=result['details'].get('total_segments'),
+            label_histogram=result['details'].get('label_histogram')
+        )
+    except Exception as e:
+        record['error'] = str(e)
+    record['processing_time'] = round(time.perf_counter() - start_time, 3)
+    return record
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    
+    from model_pipeline import DEFAULT_SAM_PRESET, ObjectCounter
+    
+    counter = ObjectCounter(lazy=True)
+    supported_types = counter.get_supported_item_types()
+    item_types = []
+    for item_type in args.item_type.split(','):
+        item_type = item_type.strip()
+        for expanded_type in (supported_types if item_type == '*' else [item_type]):
+            if expanded_type and expanded_type not in item_types:
+                item_types.append(expanded_type)
+    unknown_types = [item_type for item_type in item_types if item_type not in supported_types]
+    if not item_types or unknown_types:
+        logger.error(f"Invalid item type(s) {unknown_types}. Must be one of: {supported_types}")
+        return 2
+    
+    preset = args.preset or DEFAULT_SAM_PRESET
+    if preset not in counter.get_presets():
+        logger.error(f"Invalid preset: {preset}. Must be one of: {counter.get_presets()}")
+        return 2
+    
+    if not os.path.isdir(args.input_dir):
+        logger.error(f"Input directory not found: {args.input_dir}")
+        return 2
+    
+    images = find_images(args.input_dir)
+    processed = load_processed(args.output, args.format)
+    pending = [path for path in images if path not in processed]
+    logger.info(
+        f"Found {len(images)} images, {len(images) - len(pending)} already processed, "
+        f"{len(pending)} to go"
+    )
+    if not pending:
+        return 0
+    
+    try:
+        writer = ResultWriter(args.output, args.format, item_types)
+    except ValueError as e:
+        logger.error(str(e))
+        return 2
+    
+    options = {
+        'input_dir': args.input_dir,
+        'item_types': item_types,
+        'preset': preset,
+        'max_side': args.max_side,
+        'tiled': args.tiled,
+        'tile_size': args.tile_size,
+        'threads_per_worker': args.threads_per_worker
+    }
+    
+    # Spawned workers start without the parent's torch thread pools
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(args.workers, initializer=init_worker, initargs=(options,))
+    start_time = time.perf_counter()
+    done = failed = 0
+    try:
+        for record in pool.imap_unordered(count_image, pending):
+            writer.write(record)
+            done += 1
+            if record.get('error'):
+                failed += 1
+                logger.warning(f"{record['path']}: {record['error']}")
+            if done % 10 == 0 or done == len(pending):
+                rate = done / (time.perf_counter() - start_time)
+                logger.info(f"{done}/{len(pending)} images ({failed} failed, {rate:.2f} images/s)")
+        pool.close()
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; run the same command again to resume")
+        pool.terminate()
+        return 130
+    except BaseException:
+        # join() needs a closed or terminated pool, or it hides this error
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        writer.close()
+    
+    logger.info(f"Done: {done - failed} images counted, {failed} failed, results in {args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
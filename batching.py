@@ -0,0 +1,150 @@
+import os
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import Future
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Combine model inputs from concurrent requests into shared forward passes.
+    
+    Requests submit their input batch and get a future back. A background
+    thread waits up to ``max_wait_ms`` for further requests, concatenates
+    their inputs into one batch of at most ``max_batch_size`` rows, runs the
+    model once and hands each request its slice of the output.
+    """
+    
+    def __init__(self, run_batch, max_batch_size=16, max_wait_ms=5):
+        """
+        Initialize the batcher.
+        
+        Args:
+            run_batch (callable): Maps an input tensor (N, ...) to an output
+                tensor (N, ...)
+            max_batch_size (int): Maximum number of rows per forward pass
+            max_wait_ms (float): Time to wait for more requests once the
+                first one arrived
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait_ms / 1000.0
+        
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._counters = {'batches': 0, 'requests': 0, 'rows': 0}
+    
+    def submit(self, inputs):
+        """
+        Queue an input batch for the next combined forward pass.
+        
+        Args:
+            inputs (torch.Tensor): Input batch (N, ...)
+        
+        Returns:
+            Future: Resolves to the output rows for ``inputs``
+        """
+        future = Future()
+        if len(inputs) == 0:
+            future.set_result(self.run_batch(inputs))
+            return future
+        
+        self._ensure_worker()
+        self._queue.put((inputs, future))
+        return future
+    
+    def run(self, inputs):
+        """
+        Run an input batch, blocking until its output is ready.
+        
+        Args:
+            inputs (torch.Tensor): Input batch (N, ...)
+        
+        Returns:
+            torch.Tensor: Output rows for ``inputs``
+        """
+        return self.submit(inputs).result()
+    
+    def stats(self):
+        """
+        Get batching statistics.
+        
+        Returns:
+            dict: Number of forward passes, requests and rows, and the
+                average number of requests per forward pass
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        stats['requests_per_batch'] = round(stats['requests'] / stats['batches'], 2) if stats['batches'] else 0.0
+        stats['max_batch_size'] = self.max_batch_size
+        stats['max_wait_ms'] = self.max_wait * 1000.0
+        return stats
+    
+    def _ensure_worker(self):
+        with self._lock:
+            # Threads do not survive fork, so forked workers start their own
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(
+                target=self._worker, args=(self._queue,), name='micro-batcher', daemon=True
+            )
+            self._thread.start()
+    
+    def _worker(self, requests):
+        pending = None
+        while True:
+            first = pending if pending is not None else requests.get()
+            pending = None
+            batch = [first]
+            rows = len(first[0])
+            
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if rows + len(request[0]) > self.max_batch_size:
+                    # Start the next forward pass with it
+                    pending = request
+                    break
+                batch.append(request)
+                rows += len(request[0])
+            
+            self._run(batch)
+    
+    def _run(self, batch):
+        batch = [(inputs, future) for inputs, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        
+        try:
+            inputs = torch.cat([inputs for inputs, _ in batch]) if len(batch) > 1 else batch[0][0]
+            outputs = self.run_batch(inputs)
+        except Exception as e:
+            logger.warning(f"Batched forward pass of {len(batch)} requests failed: {str(e)}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['requests'] += len(batch)
+            self._counters['rows'] += len(inputs)
+        
+        start = 0
+        for request_inputs, future in batch:
+            future.set_result(outputs[start:start + len(request_inputs)])
+            start += len(request_inputs)
@@ -0,0 +1,652 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the object counting pipeline.
+
+Runs ObjectCounter on synthetic images of several resolutions and segment
+counts and reports throughput, latency percentiles and peak memory growth
+per pipeline stage. Results are saved as a JSON baseline that a later run
+can be compared against to catch performance regressions.
+
+By default the pipeline runs with stand-in models that take and return
+tensors of the same shapes as the real ones (a SAM-like image encoder with
+synthetic masks, a randomly initialized ResNet and a fixed label table), so
+the benchmark runs offline and without downloading checkpoints.
+"--stub-size full" uses the real SAM ViT-B and ResNet-50 architectures with
+random weights, which costs the same compute as the real models.
+--segmenter/--classifier/--refiner swap single stages for other registered
+backends (see backends.py), so each stage can be measured in isolation.
+
+Usage:
+    python benchmark.py run --output baseline.json
+    python benchmark.py run --resolutions 640x480,1920x1080 --segments 8,32 --output current.json
+    python benchmark.py run --models real --output real.json
+    python benchmark.py compare baseline.json current.json --threshold 0.1
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image, ImageDraw
+
+from backends import SEGMENTERS, CLASSIFIERS, REFINERS, Segmenter, ResNetClassifier, LabelTableRefiner
+from model_pipeline import ObjectCounter, PIPELINE_STAGES, PRESETS, DEFAULT_SAM_PRESET
+
+logger = logging.getLogger(__name__)
+
+BASELINE_VERSION = 1
+
+# SAM resizes the longest image side to this many pixels
+SAM_INPUT_SIZE = 1024
+
+PERCENTILES = (50, 90, 99)
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the object counting pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    run = commands.add_parser('run', help='Run the benchmark and save the results')
+    run.add_argument('--output', help='JSON file to save the results to')
+    run.add_argument('--models', choices=('stub', 'real'), default='stub',
+                     help='Stand-in models (offline) or the real pretrained models (default: stub)')
+    run.add_argument('--stub-size', choices=('tiny', 'full'), default='tiny',
+                     help='Stand-in model size: tiny, or the real architectures with random weights (default: tiny)')
+    run.add_argument('--segmenter', choices=list(SEGMENTERS), default=None,
+                     help='Use this registered segmenter backend instead of the --models one')
+    run.add_argument('--classifier', choices=list(CLASSIFIERS), default=None,
+                     help='Use this registered classifier backend instead of the --models one')
+    run.add_argument('--refiner', choices=list(REFINERS), default=None,
+                     help='Use this registered refiner backend instead of the --models one')
+    run.add_argument('--resolutions', default='640x480,1280x960,1920x1080',
+                     help='Comma-separated image sizes WIDTHxHEIGHT (default: 640x480,1280x960,1920x1080)')
+    run.add_argument('--segments', default='4,16',
+                     help='Comma-separated numbers of segments per image (default: 4,16)')
+    run.add_argument('--repeats', type=int, default=5, help='Measured runs per scenario (default: 5)')
+    run.add_argument('--warmup', type=int, default=1, help='Unmeasured runs per scenario (default: 1)')
+    run.add_argument('--item-type', default='*',
+                     help='Item type to count, or "*" to count all types in one run (default: *)')
+    run.add_argument('--preset', default=DEFAULT_SAM_PRESET, choices=list(PRESETS),
+                     help=f'Speed/quality preset (default: {DEFAULT_SAM_PRESET})')
+    run.add_argument('--max-side', type=int, default=1024,
+                     help='Downscale images to this longest side before segmentation (default: 1024)')
+    run.add_argument('--tiled', action='store_true',
+                     help='Segment the images in overlapping tiles (--segments is then per tile)')
+    run.add_argument('--batch-size', type=int, default=16, help='Segments per ResNet forward pass (default: 16)')
+    run.add_argument('--precision', default='fp32',
+                     help='Model precision: fp32, bf16 or int8-dynamic, which quantizes the linear layers '
+                          "of SAM's image encoder and mask decoder and ResNet-50's fc head (default: fp32)")
+    run.add_argument('--classifier-backend', default='eager',
+                     help='ResNet-50 runtime for the real models (default: eager)')
+    run.add_argument('--image-format', choices=('png', 'jpeg'), default='jpeg',
+                     help='Format of the synthetic images (default: jpeg)')
+    run.add_argument('--threads', type=int, default=None, help='Torch intra-op threads (default: torch default)')
+    run.add_argument('--seed', type=int, default=0, help='Seed for images and stand-in models (default: 0)')
+    run.add_argument('--no-memory', action='store_true', help='Do not sample memory usage')
+    
+    compare = commands.add_parser('compare', help='Compare results against a baseline')
+    compare.add_argument('baseline', help='Baseline JSON file')
+    compare.add_argument('current', help='JSON file to compare')
+    compare.add_argument('--metric', default='p50_ms', help='Latency statistic to compare (default: p50_ms)')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='Relative slowdown reported as a regression (default: 0.1)')
+    compare.add_argument('--min-delta-ms', type=float, default=1.0,
+                         help='Ignore slowdowns smaller than this many milliseconds (default: 1.0)')
+    
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        args.resolutions = [parse_size(value) for value in args.resolutions.split(',') if value.strip()]
+        args.segments = [int(value) for value in args.segments.split(',') if value.strip()]
+        args.repeats = max(1, args.repeats)
+        args.warmup = max(0, args.warmup)
+    return args
+
+
+class StubImageEncoder(torch.nn.Module):
+    """Patch embedding with the input and output shapes of the SAM image encoder."""
+    
+    def __init__(self, out_channels=256, patch_size=16):
+        super().__init__()
+        self.proj = torch.nn.Conv2d(3, out_channels, kernel_size=patch_size, stride=patch_size)
+        self.neck = torch.nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=1)
+    
+    def forward(self, x):
+        return self.neck(torch.relu(self.proj(x)))
+
+
+class EncoderStubSegmenter(Segmenter):
+    """
+    Stand-in for the SAM segmenter.
+    
+    Runs an image encoder on the SAM-sized input and returns ``segments``
+    elliptical masks in the SamAutomaticMaskGenerator output format. The
+    masks only depend on the image size and the seed.
+    """
+    
+    name = 'encoder_stub'
+    
+    def __init__(self, stub_size='tiny', segments=8, seed=0, device='cpu'):
+        self.stub_size = stub_size
+        self.segments = segments
+        self.seed = seed
+        self.device = device
+        self.encoder = None
+    
+    def load(self):
+        torch.manual_seed(self.seed)
+        if self.stub_size == 'full':
+            from segment_anything import sam_model_registry
+            encoder = sam_model_registry['vit_b']().image_encoder
+        else:
+            encoder = StubImageEncoder()
+        self.encoder = encoder.to(self.device).eval()
+    
+    def segment(self, image_array, preset):
+        height, width = image_array.shape[:2]
+        scale = SAM_INPUT_SIZE / max(height, width)
+        size = (max(1, round(height * scale)), max(1, round(width * scale)))
+        with torch.inference_mode():
+            pixels = torch.from_numpy(image_array).permute(2, 0, 1)[None].float().to(self.device)
+            pixels = F.interpolate(pixels, size=size, mode='bilinear', align_corners=False)
+            pixels = F.pad(pixels, (0, SAM_INPUT_SIZE - size[1], 0, SAM_INPUT_SIZE - size[0]))
+            self.encoder(pixels)
+        
+        rng = np.random.default_rng([self.seed, height, width, self.segments])
+        rows = np.arange(height)[:, None]
+        cols = np.arange(width)[None, :]
+        masks = []
+        for _ in range(self.segments):
+            center_x, center_y = rng.uniform(0, width), rng.uniform(0, height)
+            radius_x = rng.uniform(0.03, 0.3) * width
+            radius_y = rng.uniform(0.03, 0.3) * height
+            segmentation = ((cols - center_x) / radius_x) ** 2 + ((rows - center_y) / radius_y) ** 2 <= 1
+            ys, xs = np.nonzero(segmentation)
+            if len(ys) == 0:
+                continue
+            masks.append({
+                'segmentation': segmentation,
+                'area': int(len(ys)),
+                'bbox': [int(xs.min()), int(ys.min()), int(xs.max() - xs.min()), int(ys.max() - ys.min())],
+                'predicted_iou': 1.0,
+                'stability_score': 1.0
+            })
+        return masks
+    
+    def get_config(self, preset):
+        return {'segmenter': self.name, 'stub_size': self.stub_size, 'segments': self.segments, 'seed': self.seed}
+
+
+class RandomResNetClassifier(ResNetClassifier):
+    """ResNet classifier with random weights and 1000 classes, built offline."""
+    
+    def __init__(self, stub_size='tiny', seed=0, **options):
+        super().__init__(model_name=f'random-resnet-{stub_size}', **options)
+        self.stub_size = stub_size
+        self.seed = seed
+    
+    def _load_model(self, cache_dir):
+        from transformers import ConvNextImageProcessor, ResNetConfig, ResNetForImageClassification
+        
+        torch.manual_seed(self.seed)
+        if self.stub_size == 'full':
+            config = ResNetConfig(num_labels=1000)
+        else:
+            config = ResNetConfig(
+                num_labels=1000, embedding_size=16, hidden_sizes=[32, 64, 128, 256], depths=[1, 1, 1, 1]
+            )
+        config.id2label = {i: f'class_{i}' for i in range(config.num_labels)}
+        config.label2id = {label: i for i, label in config.id2label.items()}
+        
+        # Same preprocessing as the microsoft/resnet-50 image processor
+        image_processor = ConvNextImageProcessor(
+            size={'shortest_edge': 224}, crop_pct=0.875, resample=Image.BICUBIC
+        )
+        return image_processor, ResNetForImageClassification(config).eval()
+
+
+def create_stub_backends(candidate_labels, stub_size='tiny', seed=0, **options):
+    """
+    Create offline stand-ins for the three pipeline stages.
+    
+    Args:
+        candidate_labels (list): Item types the stand-in label table maps to
+        stub_size (str): "tiny" stand-ins, or "full" for the real
+            architectures with random weights
+        seed (int): Seed for the random weights and the synthetic masks
+        **options: Classifier options (device, precision, batch_size)
+    
+    Returns:
+        dict: ``segmenter``, ``classifier`` and ``refiner`` keyword arguments
+            for ObjectCounter
+    """
+    table = {
+        f'class_{i}': candidate_labels[i % len(candidate_labels)]
+        for i in range(1000)
+    }
+    return {
+        'segmenter': EncoderStubSegmenter(stub_size, seed=seed, device=options.get('device', 'cpu')),
+        'classifier': RandomResNetClassifier(stub_size, seed, **options),
+        'refiner': LabelTableRefiner(candidate_labels, table=table)
+    }
+
+
+class MemorySampler:
+    """Sample the resident set size of this process on a background thread."""
+    
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._peak = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    @staticmethod
+    def available():
+        return os.path.exists('/proc/self/statm')
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._sample_loop, name='memory-sampler', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def reset(self):
+        """Start a new measurement window and return the current RSS in bytes."""
+        rss = self._rss()
+        with self._lock:
+            self._peak = rss
+        return rss
+    
+    def peak(self):
+        """Get the highest RSS in bytes since the last reset()."""
+        self._sample()
+        with self._lock:
+            return self._peak
+    
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+    
+    def _sample(self):
+        rss = self._rss()
+        with self._lock:
+            self._peak = max(self._peak, rss)
+    
+    def _rss(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class BenchmarkCounter(ObjectCounter):
+    """ObjectCounter that also records the peak memory growth of each stage."""
+    
+    def __init__(self, memory_sampler=None, **kwargs):
+        self.memory_sampler = memory_sampler
+        self.stage_memory = {}
+        super().__init__(**kwargs)
+    
+    @contextmanager
+    def _timed(self, timings, stage):
+        start_rss = self.memory_sampler.reset() if self.memory_sampler is not None else None
+        with super()._timed(timings, stage):
+            yield
+        if start_rss is not None:
+            growth = self.memory_sampler.peak() - start_rss
+            self.stage_memory[stage] = max(self.stage_memory.get(stage, 0), growth)
+
+
+def make_image(path, size, segments, seed):
+    """
+    Write a synthetic test image: a gradient with random ellipses and noise.
+    
+    Args:
+        path (str): Output path (the extension selects the format)
+        size (tuple): (width, height)
+        segments (int): Number of ellipses to draw
+        seed (int): Random seed
+    """
+    width, height = size
+    rng = np.random.default_rng([seed, width, height, segments])
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    pixels = np.broadcast_to(gradient, (height, width, 3)) * rng.uniform(0.3, 1.0, 3)
+    pixels = pixels + rng.normal(0, 8, (height, width, 3))
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    
+    draw = ImageDraw.Draw(image)
+    for _ in range(segments):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        radius_x, radius_y = rng.uniform(0.03, 0.3) * width, rng.uniform(0.03, 0.3) * height
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        draw.ellipse([x - radius_x, y - radius_y, x + radius_x, y + radius_y], fill=color)
+    if path.endswith('.jpg'):
+        image.save(path, quality=90)
+    else:
+        image.save(path)
+
+
+def summarize(values):
+    """
+    Summarize a list of measurements.
+    
+    Args:
+        values (list): Measurements in milliseconds
+    
+    Returns:
+        dict: Mean, min, max and percentiles, rounded to 3 decimals
+    """
+    values = np.asarray(values, dtype=np.float64)
+    summary = {
+        'mean_ms': float(values.mean()),
+        'min_ms': float(values.min()),
+        'max_ms': float(values.max())
+    }
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}_ms'] = float(np.percentile(values, percentile))
+    return {key: round(value, 3) for key, value in summary.items()}
+
+
+def run_scenario(counter, image_path, segments, args):
+    """
+    Benchmark one image/segment count combination.
+    
+    Args:
+        counter (BenchmarkCounter): Counter with loaded models
+        image_path (str): Synthetic image
+        segments (int): Number of segments to classify
+        args: Parsed command line arguments
+    
+    Returns:
+        dict: Throughput, total latency and per-stage latency/memory
+    """
+    counter.top_n = segments
+    counter.tile_top_n = segments
+    if isinstance(counter.segmenter, EncoderStubSegmenter):
+        counter.segmenter.segments = segments
+    
+    def count():
+        if args.item_type == '*':
+            return counter.count_all_objects(image_path, preset=args.preset, tiled=args.tiled)
+        return counter.count_objects(image_path, args.item_type, preset=args.preset, tiled=args.tiled)
+    
+    for _ in range(args.warmup):
+        count()
+    
+    latencies = []
+    stage_latencies = {}
+    stage_memory = {}
+    segment_counts = []
+    for _ in range(args.repeats):
+        counter.stage_memory = {}
+        start_time = time.perf_counter()
+        result = count()
+        latencies.append((time.perf_counter() - start_time) * 1000)
+        
+        details = result['details']
+        if details.get('fallback_mode'):
+            raise RuntimeError('AI models are not available (fallback mode)')
+        segment_counts.append(details['total_segments'])
+        for stage, milliseconds in details['stage_timings_ms'].items():
+            stage_latencies.setdefault(stage, []).append(milliseconds)
+        for stage, growth in counter.stage_memory.items():
+            stage_memory[stage] = max(stage_memory.get(stage, 0), growth)
+    
+    stages = {}
+    for stage in PIPELINE_STAGES:
+        if stage not in stage_latencies:
+            continue
+        stages[stage] = summarize(stage_latencies[stage])
+        if stage in stage_memory:
+            stages[stage]['peak_rss_growth_mb'] = round(stage_memory[stage] / (1024 * 1024), 2)
+    
+    return {
+        'segments_classified': max(segment_counts),
+        'throughput_images_per_s': round(len(latencies) / (sum(latencies) / 1000), 3),
+        'latency': summarize(latencies),
+        'stages': stages
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=10,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    
+    memory_sampler = None
+    if not args.no_memory and MemorySampler.available():
+        memory_sampler = MemorySampler()
+        memory_sampler.start()
+    
+    supported_types = ObjectCounter(lazy=True).get_supported_item_types()
+    if args.item_type != '*' and args.item_type not in supported_types:
+        logger.error(f"Invalid item type: {args.item_type}. Must be one of: {supported_types}")
+        return 2
+    
+    backends = {}
+    if args.models == 'stub':
+        backends = create_stub_backends(
+            supported_types, args.stub_size, args.seed,
+            device='cuda' if torch.cuda.is_available() else 'cpu',
+            precision=args.precision,
+            batch_size=args.batch_size
+        )
+    for stage in ('segmenter', 'classifier', 'refiner'):
+        if getattr(args, stage):
+            backends[stage] = getattr(args, stage)
+    counter = BenchmarkCounter(
+        memory_sampler=memory_sampler,
+        max_side=args.max_side,
+        batch_size=args.batch_size,
+        cache_size_mb=0,
+        precision=args.precision,
+        classifier_backend=args.classifier_backend,
+        fallback=False,
+        lazy=True,
+        **backends
+    )
+    
+    load_start = time.perf_counter()
+    try:
+        counter.load(warm_up=True)
+    except Exception as e:
+        logger.error(f"Could not load the models: {str(e)}")
+        return 1
+    load_time = time.perf_counter() - load_start
+    logger.info(f"Models ready in {load_time:.2f}s")
+    
+    report = {
+        'version': BASELINE_VERSION,
+        'created_at': datetime.utcnow().isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'device': counter.device,
+            'git_commit': git_commit()
+        },
+        'config': {
+            'models': args.models if args.models == 'real' else f'stub-{args.stub_size}',
+            'backends': {stage: backend.name for stage, backend in counter._stages()},
+            'item_type': args.item_type,
+            'preset': args.preset,
+            'max_side': args.max_side,
+            'tiled': args.tiled,
+            'batch_size': args.batch_size,
+            'precision': counter.precision,
+            'classifier_backend': counter.classifier.get_info().get('runtime', counter.classifier.name),
+            'image_format': args.image_format,
+            'repeats': args.repeats,
+            'warmup': args.warmup,
+            'seed': args.seed
+        },
+        'model_load_seconds': round(load_time, 3),
+        'scenarios': {}
+    }
+    
+    image_dir = tempfile.mkdtemp(prefix='benchmark-')
+    extension = 'jpg' if args.image_format == 'jpeg' else 'png'
+    try:
+        for width, height in args.resolutions:
+            for segments in args.segments:
+                name = f'{width}x{height}-{segments}seg'
+                image_path = os.path.join(image_dir, f'{name}.{extension}')
+                make_image(image_path, (width, height), segments, args.seed)
+                
+                scenario = run_scenario(counter, image_path, segments, args)
+                scenario.update(width=width, height=height, segments=segments)
+                report['scenarios'][name] = scenario
+                logger.info(
+                    f"{name}: p50 {scenario['latency']['p50_ms']:.1f} ms, "
+                    f"p99 {scenario['latency']['p99_ms']:.1f} ms, "
+                    f"{scenario['throughput_images_per_s']:.2f} images/s"
+                )
+    except Exception as e:
+        logger.error(f"Benchmark failed: {str(e)}")
+        return 1
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+        if memory_sampler is not None:
+            memory_sampler.stop()
+    
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results saved to {args.output}")
+    return 0
+
+
+def print_report(report):
+    print(f"{'scenario':<24} {'stage':<16} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'peak MB':>9}")
+    for name, scenario in report['scenarios'].items():
+        rows = list(scenario['stages'].items()) + [('total', scenario['latency'])]
+        for stage, stats in rows:
+            peak = stats.get('peak_rss_growth_mb')
+            print(
+                f"{name:<24} {stage:<16} {stats['p50_ms']:>10.2f} {stats['p90_ms']:>10.2f} "
+                f"{stats['p99_ms']:>10.2f} {'' if peak is None else f'{peak:.1f}':>9}"
+            )
+        print(f"{name:<24} {'throughput':<16} {scenario['throughput_images_per_s']:>10.3f} images/s")
+
+
+def compare_reports(baseline, current, metric='p50_ms', threshold=0.1, min_delta_ms=1.0):
+    """
+    Compare the latencies of two benchmark reports.
+    
+    Args:
+        baseline (dict): Baseline report
+        current (dict): Report to check
+        metric (str): Latency statistic to compare, e.g. "p50_ms"
+        threshold (float): Relative slowdown that counts as a regression
+        min_delta_ms (float): Slowdowns below this many milliseconds are ignored
+    
+    Returns:
+        list: One dict per scenario and stage with both values, the relative
+            change and whether it is a regression
+    """
+    rows = []
+    for name, scenario in current['scenarios'].items():
+        base_scenario = baseline['scenarios'].get(name)
+        if base_scenario is None:
+            continue
+        stages = [(stage, scenario['stages'][stage], base_scenario['stages'].get(stage))
+                  for stage in scenario['stages']]
+        stages.append(('total', scenario['latency'], base_scenario['latency']))
+        for stage, stats, base_stats in stages:
+            if base_stats is None or metric not in stats or metric not in base_stats:
+                continue
+            base_value, value = base_stats[metric], stats[metric]
+            change = (value - base_value) / base_value if base_value > 0 else 0.0
+            rows.append({
+                'scenario': name,
+                'stage': stage,
+                'baseline': base_value,
+                'current': value,
+                'change': round(change, 4),
+                'regression': change > threshold and value - base_value > min_delta_ms
+            })
+    return rows
+
+
+def compare(args):
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not read benchmark results: {str(e)}")
+        return 2
+    
+    for section in ('config', 'environment'):
+        for key, value in current.get(section, {}).items():
+            base_value = baseline.get(section, {}).get(key)
+            if key not in ('git_commit',) and base_value != value:
+                logger.warning(f"{section} differs: {key} = {base_value} (baseline) vs {value} (current)")
+    missing = sorted(set(baseline['scenarios']) ^ set(current['scenarios']))
+    if missing:
+        logger.warning(f"Scenarios only in one of the files are skipped: {missing}")
+    
+    rows = compare_reports(baseline, current, args.metric, args.threshold, args.min_delta_ms)
+    print(f"{'scenario':<24} {'stage':<16} {'baseline':>10} {'current':>10} {'change':>9}")
+    for row in rows:
+        print(
+            f"{row['scenario']:<24} {row['stage']:<16} {row['baseline']:>10.2f} {row['current']:>10.2f} "
+            f"{row['change']:>+9.1%}{'  REGRESSION' if row['regression'] else ''}"
+        )
+    
+    regressions = [row for row in rows if row['regression']]
+    if regressions:
+        logger.warning(
+            f"{len(regressions)} of {len(rows)} {args.metric} latencies are more than "
+            f"{args.threshold:.0%} slower than the baseline"
+        )
+        return 1
+    logger.info(f"No {args.metric} regressions above {args.threshold:.0%}")
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'run':
+        # Only the benchmark summary, not a line per pipeline run
+        logging.getLogger('model_pipeline').setLevel(logging.WARNING)
+        return run(args)
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
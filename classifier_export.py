@@ -0,0 +1,247 @@
+import os
+import hashlib
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Graph-optimized runtimes the ResNet-50 classifier can be exported to
+EXPORT_FORMATS = ('torchscript', 'onnx')
+
+
+class LogitsModule(torch.nn.Module):
+    """Wrap a HuggingFace image classification model to return plain logits."""
+    
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+
+def load_exported_classifier(model, export_format, cache_dir, model_name, example_input):
+    """
+    Load an exported classifier, exporting it first if no cached export exists.
+    
+    Exports are cached per model name, weights, format, torch version and
+    input size, so changed weights are exported again.
+    
+    Args:
+        model (torch.nn.Module): Eager HuggingFace classification model
+        export_format (str): "torchscript" or "onnx"
+        cache_dir (str): Directory for exported models
+        model_name (str): Model name, part of the export cache key
+        example_input (torch.Tensor): Example pixel_values batch (N, 3, H, W)
+    
+    Returns:
+        callable: Function mapping a pixel_values tensor to a logits tensor
+    """
+    export_path = export_cache_path(model, export_format, cache_dir, model_name, example_input)
+    if not os.path.exists(export_path):
+        _export(model, export_format, export_path, example_input)
+    return _load(export_format, export_path)
+
+
+def load_checked_classifier(model, reference, export_format, cache_dir, model_name, example_input):
+    """
+    Load an exported classifier and check it against the eager model.
+    
+    A cached export that fails the check (e.g. written by an older version
+    of the export code) is deleted and exported again once.
+    
+    Args:
+        model (torch.nn.Module): Eager HuggingFace classification model
+        reference (callable): Eager classifier (pixel_values -> logits)
+        export_format (str): "torchscript" or "onnx"
+        cache_dir (str): Directory for exported models
+        model_name (str): Model name, part of the export cache key
+        example_input (torch.Tensor): Example pixel_values batch (N, 3, H, W)
+    
+    Returns:
+        tuple: (exported classifier, maximum absolute logit difference)
+    
+    Raises:
+        ValueError: If a fresh export does not match the eager model either
+    """
+    export_path = export_cache_path(model, export_format, cache_dir, model_name, example_input)
+    
+    def load_and_check():
+        runner = _load(export_format, export_path)
+        return runner, check_parity(reference, runner, example_input)
+    
+    if os.path.exists(export_path):
+        try:
+            return load_and_check()
+        except Exception as e:
+            logger.warning(f"Cached classifier export {export_path} is unusable, exporting again: {str(e)}")
+            _remove_export(export_path)
+    
+    _export(model, export_format, export_path, example_input)
+    try:
+        return load_and_check()
+    except Exception:
+        # Do not leave a bad export in the cache
+        _remove_export(export_path)
+        raise
+
+
+def export_cache_path(model, export_format, cache_dir, model_name, example_input):
+    """
+    Get the cache path of a classifier export.
+    
+    Args:
+        model (torch.nn.Module): Eager HuggingFace classification model
+        export_format (str): "torchscript" or "onnx"
+        cache_dir (str): Directory for exported models
+        model_name (str): Model name
+        example_input (torch.Tensor): Example pixel_values batch (N, 3, H, W)
+    
+    Returns:
+        str: Path of the exported model file
+    
+    Raises:
+        ValueError: If the export format is unknown
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}. Must be one of: {list(EXPORT_FORMATS)}")
+    
+    key_source = (
+        f"{model_name}:{weights_fingerprint(model)}:{export_format}:{torch.__version__}:"
+        f"{tuple(example_input.shape[1:])}"
+    )
+    export_key = hashlib.sha256(key_source.encode('utf-8')).hexdigest()[:16]
+    extension = 'pt' if export_format == 'torchscript' else 'onnx'
+    return os.path.join(cache_dir, f"classifier_{export_key}.{extension}")
+
+
+def weights_fingerprint(model):
+    """
+    Get a digest of a model's parameters and buffers.
+    
+    Args:
+        model (torch.nn.Module): Model to fingerprint
+    
+    Returns:
+        str: SHA-256 hex digest of the names, dtypes, shapes and values
+    """
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode('utf-8'))
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def check_parity(reference, runner, example_input, atol=1e-3):
+    """
+    Compare an exported classifier against the eager model.
+    
+    Args:
+        reference (callable): Eager classifier (pixel_values -> logits)
+        runner (callable): Exported classifier (pixel_values -> logits)
+        example_input (torch.Tensor): Input batch to compare on
+        atol (float): Maximum allowed absolute logit difference
+    
+    Returns:
+        float: Maximum absolute logit difference
+    
+    Raises:
+        ValueError: If the logits or predicted classes differ
+    """
+    expected = reference(example_input).float()
+    actual = runner(example_input).float()
+    max_abs_diff = (expected - actual).abs().max().item()
+    same_classes = torch.equal(expected.argmax(-1), actual.argmax(-1))
+    
+    if max_abs_diff > atol or not same_classes:
+        raise ValueError(
+            f"Exported classifier does not match the eager model "
+            f"(max abs logit difference {max_abs_diff:.2e}, same classes: {same_classes})"
+        )
+    return max_abs_diff
+
+
+def _export(model, export_format, export_path, example_input):
+    if export_format == 'torchscript':
+        _export_torchscript(model, export_path, example_input)
+    else:
+        _export_onnx(model, export_path, example_input)
+
+
+def _load(export_format, export_path):
+    if export_format == 'torchscript':
+        return _load_torchscript(export_path)
+    return _load_onnx(export_path)
+
+
+def _remove_export(export_path):
+    try:
+        os.remove(export_path)
+    except OSError:
+        pass
+
+
+def _export_torchscript(model, export_path, example_input):
+    logger.info(f"Exporting classifier to TorchScript: {export_path}")
+    with torch.inference_mode():
+        traced = torch.jit.trace(LogitsModule(model).eval(), example_input, check_trace=False)
+    frozen = torch.jit.freeze(traced.eval())
+    _save_atomically(export_path, lambda path: torch.jit.save(frozen, path))
+
+
+def _load_torchscript(export_path):
+    scripted = torch.jit.load(export_path, map_location='cpu').eval()
+    # Inference-only graph rewrites (e.g. conv/batchnorm folding) can not be
+    # serialized, so they are applied after loading
+    scripted = torch.jit.optimize_for_inference(scripted)
+    logger.info(f"Loaded TorchScript classifier from {export_path}")
+    
+    def run(pixel_values):
+        with torch.inference_mode():
+            return scripted(pixel_values)
+    
+    return run
+
+
+def _export_onnx(model, export_path, example_input):
+    logger.info(f"Exporting classifier to ONNX: {export_path}")
+    with torch.no_grad():
+        _save_atomically(export_path, lambda path: torch.onnx.export(
+            LogitsModule(model).eval(),
+            (example_input,),
+            path,
+            input_names=['pixel_values'],
+            output_names=['logits'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}},
+            opset_version=17,
+            dynamo=False,
+        ))
+
+
+def _load_onnx(export_path):
+    # Optional dependency, only needed for the ONNX backend
+    import onnxruntime as ort
+    
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()
+    session = ort.InferenceSession(export_path, options, providers=['CPUExecutionProvider'])
+    logger.info(f"Loaded ONNX Runtime classifier from {export_path}")
+    
+    def run(pixel_values):
+        outputs = session.run(['logits'], {'pixel_values': pixel_values.detach().cpu().numpy()})
+        return torch.from_numpy(outputs[0])
+    
+    return run
+
+
+def _save_atomically(export_path, save):
+    tmp_path = f"{export_path}.{os.getpid()}.tmp"
+    try:
+        save(tmp_path)
+        os.replace(tmp_path, export_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
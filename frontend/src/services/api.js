@@ -33,11 +33,13 @@ api.interceptors.response.use(
 
 // API Service functions
 export const apiService = {
-    // Upload image and count objects
-    countObjects: async (imageFile, itemType) => {
+    // Upload image and count objects. The request is queued as a job on the
+    // backend, which is polled until the result is ready.
+    countObjects: async (imageFile, itemType, onProgress = null) => {
         const formData = new FormData();
         formData.append('image', imageFile);
         formData.append('item_type', itemType);
+        formData.append('async', 'true');
 
         const response = await api.post('/count', formData, {
             headers: {
@@ -45,7 +47,43 @@ export const apiService = {
             },
         });
 
-        return response.data;
+        return apiService.waitForJob(response.data.job_id, onProgress);
+    },
+
+    // Poll a counting job until it completes, fails or is cancelled. Gives up
+    // after `timeout` ms, or when the job is gone (e.g. expired or the server
+    // restarted)
+    waitForJob: async (jobId, onProgress = null, pollInterval = 1000, timeout = 10 * 60 * 1000) => {
+        const deadline = Date.now() + timeout;
+        for (;;) {
+            let job;
+            try {
+                const response = await api.get(`/jobs/${jobId}`);
+                job = response.data;
+            } catch (error) {
+                if (error.response?.status === 404) {
+                    throw new Error('The counting job no longer exists. Please try again.');
+                }
+                throw error;
+            }
+
+            if (job.status === 'completed') {
+                return job.result;
+            }
+            if (job.status === 'failed') {
+                throw new Error(job.error || 'Error processing image');
+            }
+            if (job.status === 'cancelled') {
+                throw new Error(job.error || 'The counting job was cancelled');
+            }
+            if (onProgress) {
+                onProgress(job);
+            }
+            if (Date.now() + pollInterval > deadline) {
+                throw new Error('Timed out waiting for the counting result');
+            }
+            await new Promise((resolve) => setTimeout(resolve, pollInterval));
+        }
     },
 
     // Submit count correction
@@ -85,8 +123,9 @@ export const apiService = {
 
     // Get uploaded file URL
     getImageUrl: (imagePath) => {
-        // Remove the 'uploads/' prefix if present since the backend endpoint serves from uploads folder
-        const filename = imagePath.includes('/') ? imagePath.split('/').pop() : imagePath;
+        // Remove the 'uploads/' prefix if present since the backend endpoint serves from uploads folder,
+        // but keep the shard directories (e.g. 3f/a2/3fa2...e1.jpg) the file is stored in
+        const filename = imagePath.replace(/^(\.\/)?uploads\//, '');
         return `http://localhost:5001/uploads/${filename}`;
     },
 };
@@ -0,0 +1,126 @@
+import io
+import os
+import math
+import numpy as np
+from PIL import Image, ImageOps
+
+# Increase when a change to decoding changes the pixels the pipeline sees
+DECODER_VERSION = 2
+
+# Colour transparent pixels are composited onto
+TRANSPARENT_FILL = (255, 255, 255)
+
+# EXIF orientations that rotate the image by 90 or 270 degrees
+TRANSPOSING_ORIENTATIONS = {5, 6, 7, 8}
+
+# Greyscale value that maps to white, per high bit depth mode. Files decode
+# 16-bit samples to "I;16*" or "I", and float images are expected in 0..1.
+WHITE_LEVELS = {'I': 65535, 'F': 1.0}
+
+
+def load_image(source, max_side=None):
+    """
+    Decode an image as upright 8-bit RGB, no larger than needed.
+    
+    With ``max_side``, JPEGs are decoded at the smallest DCT scale (1/2, 1/4
+    or 1/8) whose longest side is still at least ``max_side`` pixels, and
+    other formats are reduced by the largest integer factor that keeps it
+    right after decoding. The result is never smaller than ``max_side``, so
+    a later resize to exactly ``max_side`` sees the same detail.
+    
+    Args:
+        source: File path, file object, encoded image bytes, PIL Image or
+            image array (H, W) / (H, W, C); already decoded images are only
+            normalized and reduced
+        max_side (int): Longest side the caller needs (None keeps the full resolution)
+    
+    Returns:
+        tuple: (PIL Image in RGB mode, dict with the format, mode, original
+            (upright) size and decoded size)
+    """
+    if isinstance(source, np.ndarray):
+        image = Image.fromarray(source)
+    elif isinstance(source, Image.Image):
+        image = source
+    else:
+        image = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source)
+    orientation = image.getexif().get(0x0112, 1)
+    info = {
+        'format': image.format,
+        'mode': image.mode,
+        'original_size': list(image.size)
+    }
+    if orientation in TRANSPOSING_ORIENTATIONS:
+        info['original_size'].reverse()
+    
+    # Let the JPEG decoder skip detail that would be thrown away
+    if max_side and image.format == 'JPEG' and max(image.size) > max_side:
+        factor = max_side / max(image.size)
+        image.draft('RGB', (math.ceil(image.size[0] * factor), math.ceil(image.size[1] * factor)))
+    
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    image = to_rgb(image)
+    
+    if max_side:
+        reduce_factor = max(image.size) // max_side
+        if reduce_factor >= 2:
+            image = image.reduce(reduce_factor)
+    
+    info['decoded_size'] = list(image.size)
+    return image, info
+
+
+def describe_image(source):
+    """
+    Describe an image source for log messages without dumping its content.
+    
+    Args:
+        source: Anything load_image() accepts
+        
+    Returns:
+        str: The path, or the kind and size of an in-memory image
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return str(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return f"<{len(source)} bytes in memory>"
+    if isinstance(source, np.ndarray):
+        return f"<array {'x'.join(str(side) for side in source.shape)}>"
+    if isinstance(source, Image.Image):
+        return f"<image {source.size[0]}x{source.size[1]}>"
+    return f"<{type(source).__name__}>"
+
+
+def to_rgb(image):
+    """
+    Convert an image of any mode to 8-bit RGB.
+    
+    Transparent pixels (RGBA, LA, PA and palette images with a transparent
+    colour) are composited onto TRANSPARENT_FILL. 16-bit, 32-bit integer
+    and float greyscale images are scaled from their mode's full range (see
+    WHITE_LEVELS), independent of the values in the image, and values
+    outside that range (e.g. negative ones) are clipped.
+    
+    Args:
+        image: PIL Image object
+    
+    Returns:
+        PIL Image in RGB mode (the input image if it already is)
+    """
+    if image.mode == 'RGB':
+        return image
+    
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, TRANSPARENT_FILL)
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    
+    if image.mode in WHITE_LEVELS or image.mode.startswith('I;16'):
+        white = WHITE_LEVELS.get(image.mode, 65535)
+        values = np.nan_to_num(np.asarray(image, dtype=np.float64), nan=0.0)
+        values = np.rint(np.clip(values, 0, white) * (255 / white))
+        return Image.fromarray(values.astype(np.uint8)).convert('RGB')
+    
+    return image.convert('RGB')
@@ -0,0 +1,164 @@
+import time
+import uuid
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """Raised when no more jobs can be queued."""
+
+
+class JobCancelled(Exception):
+    """Raised by a job function that stopped because it was cancelled."""
+
+
+class JobQueue:
+    """
+    Bounded in-process job queue for long-running counting requests.
+    
+    Jobs run on a fixed-size thread pool, so the number of concurrent
+    pipeline runs is independent of the number of HTTP server threads.
+    Finished jobs are kept for ``max_age`` seconds so clients can fetch
+    their results.
+    """
+    
+    def __init__(self, max_workers=2, max_pending=100, max_age=3600):
+        """
+        Initialize the job queue.
+        
+        Args:
+            max_workers (int): Number of jobs run concurrently
+            max_pending (int): Maximum number of queued and running jobs
+            max_age (int): Seconds finished jobs are kept
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(1, int(max_pending))
+        self.max_age = max_age
+        
+        # Worker threads are started on the first submit
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='count-job'
+        )
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def submit(self, fn, **metadata):
+        """
+        Queue a job.
+        
+        Args:
+            fn (callable): Job function, called with a progress callback
+                ``progress(stage, info)``; its return value is the job result
+            **metadata: Extra fields returned with the job status
+        
+        Returns:
+            dict: Status of the queued job
+        
+        Raises:
+            JobQueueFull: If ``max_pending`` jobs are already queued or running
+        """
+        with self._lock:
+            self._prune()
+            pending = sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs are already pending")
+            
+            job_id = str(uuid.uuid4())
+            job = {
+                'id': job_id,
+                'status': 'queued',
+                'stage': None,
+                'progress': {},
+                'created_at': datetime.utcnow().isoformat(),
+                'started_at': None,
+                'finished_at': None,
+                'result': None,
+                'error': None,
+                '_finished': None
+            }
+            job.update(metadata)
+            self._jobs[job_id] = job
+            snapshot = self._snapshot(job)
+        
+        self._executor.submit(self._run, job_id, fn)
+        return snapshot
+    
+    def get(self, job_id):
+        """
+        Get the status of a job.
+        
+        Args:
+            job_id (str): Job ID
+        
+        Returns:
+            dict: Job status, stage and (once completed) result, or None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job is not None else None
+    
+    def stats(self):
+        """
+        Get the number of jobs per status.
+        
+        Returns:
+            dict: Job counts and pool size
+        """
+        with self._lock:
+            counts = {status: 0 for status in ('queued', 'running', 'completed', 'failed', 'cancelled')}
+            for job in self._jobs.values():
+                counts[job['status']] += 1
+        counts['max_workers'] = self.max_workers
+        counts['max_pending'] = self.max_pending
+        return counts
+    
+    def shutdown(self):
+        """Stop accepting jobs and wait until the queued and running ones are done."""
+        self._executor.shutdown(wait=True)
+    
+    def _run(self, job_id, fn):
+        def progress(stage, info=None):
+            with self._lock:
+                job['stage'] = stage
+                job['progress'] = dict(info or {})
+        
+        with self._lock:
+            job = self._jobs[job_id]
+            job['status'] = 'running'
+            job['started_at'] = datetime.utcnow().isoformat()
+        
+        try:
+            result = fn(progress)
+            status, error = 'completed', None
+        except JobCancelled as e:
+            logger.info(f"Job {job_id} cancelled: {str(e)}")
+            result, status, error = None, 'cancelled', str(e)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}")
+            result, status, error = None, 'failed', str(e)
+        
+        with self._lock:
+            job.update(
+                status=status,
+                result=result,
+                error=error,
+                finished_at=datetime.utcnow().isoformat(),
+                _finished=time.monotonic()
+            )
+    
+    def _prune(self):
+        cutoff = time.monotonic() - self.max_age
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['_finished'] is not None and job['_finished'] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+    
+    def _snapshot(self, job):
+        return {key: value for key, value in job.items() if not key.startswith('_')}
@@ -1,17 +1,61 @@
 import os
-import urllib.request
+import io
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 import torch
-import torch.nn.functional as F
 from PIL import Image
 import matplotlib.pyplot as plt
-import torchvision.transforms as tf
-from transformers import AutoImageProcessor, AutoModelForImageClassification, pipeline
-from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+from sam_cache import SamCache, hash_image
+from backends import (
+    SEGMENTERS, CLASSIFIERS, REFINERS, StubClassifier, IdentityRefiner, create_backend,
+    SAM_PRESETS, DEFAULT_SAM_PRESET, SEGMENTER_PRESETS
+)
+from metrics import Histogram, Gauge
+from precision import validate_precision
+from tiling import tile_grid, deduplicate_boxes
+from image_loading import load_image, describe_image, DECODER_VERSION
 import logging
 
 logger = logging.getLogger(__name__)
 
+# All preset names: SAM speed/quality presets, then presets with their own segmenter
+PRESETS = tuple(SAM_PRESETS) + tuple(SEGMENTER_PRESETS)
+
+# Stages timed by the pipeline, in order
+PIPELINE_STAGES = ('decode', 'mask_generation', 'panoptic_map', 'crop', 'merge', 'classify', 'refine', 'count')
+
+STAGE_SECONDS = Histogram(
+    'object_counter_stage_seconds', 'Time spent in each pipeline stage', labelnames=('stage',)
+)
+MODEL_LOAD_SECONDS = Gauge(
+    'object_counter_model_load_seconds', 'Time taken to load each model', labelnames=('model',)
+)
+
+class PipelineCancelled(Exception):
+    """Raised by a progress callback to abort a pipeline run."""
+
+def limit_torch_threads(num_threads):
+    """
+    Limit the torch thread pools of a worker process.
+    
+    Every process starts a thread per CPU core by default, so several
+    workers on one machine would oversubscribe the cores.
+    
+    Args:
+        num_threads (int): Intra-op threads of this process
+    """
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before the process runs parallel work
+        pass
+
 class ObjectCounter:
     """
     AI Object Counting Pipeline
@@ -20,153 +64,314 @@ class ObjectCounter:
     1. SAM (Segment Anything Model) for image segmentation
     2. ResNet-50 for object classification
     3. DistilBERT for zero-shot label refinement
+    
+    Each step is a pluggable backend (see backends.py), selected by name or
+    passed in as an instance.
     """
     
-    def __init__(self, top_n=10):
+    def __init__(self, top_n=10, batch_size=16, cache_size_mb=512, cache_dir=None,
+                 max_side=None, classifier_backend='eager', precision='fp32', batch_wait_ms=0,
+                 lazy=False, segmenter='sam', classifier='resnet', refiner='label_table',
+                 fallback=False, tile_size=1024, tile_overlap=128, tile_workers=1,
+                 tile_iou_threshold=0.5, tile_top_n=100):
         """
         Initialize the ObjectCounter with all required models.
         
         Args:
-            top_n (int): Number of top segments to process
+            top_n (int): Number of top segments to process (untiled runs; tiled
+                runs use ``tile_top_n``)
+            batch_size (int): Maximum number of segments per ResNet-50 forward pass
+            cache_size_mb (int): Memory budget of the SAM embedding/mask cache (0 disables it)
+            cache_dir (str): Optional directory that evicted cache entries are spilled to
+            max_side (int): Downscale images so their longest side is at most this
+                many pixels before segmentation (None keeps the full resolution).
+                The presets' min_mask_region_area applies at this resolution
+            classifier_backend (str): ResNet-50 runtime: "eager" PyTorch, or an
+                exported "torchscript" / "onnx" (ONNX Runtime) model
+            precision (str): Numeric precision of SAM and the eager ResNet-50:
+                "fp32", "bf16" (autocast) or "int8-dynamic" (int8 linear layers:
+                SAM's image encoder and mask decoder, ResNet-50's fc head)
+            batch_wait_ms (float): Time to wait for segments of concurrent requests
+                to share a ResNet-50 forward pass (0 disables cross-request batching)
+            lazy (bool): Defer model loading until load() is called
+            segmenter: Segmentation backend name in SEGMENTERS ("sam", "stub") or a
+                Segmenter instance
+            classifier: Classification backend name in CLASSIFIERS ("resnet",
+                "stub") or a Classifier instance
+            refiner: Label refinement backend name in REFINERS ("label_table",
+                "identity") or a Refiner instance
+            fallback (bool): Replace backends that fail to load with the model-free
+                stand-ins instead of failing; results are flagged with fallback_mode.
+                Off by default, as the stand-ins' counts are made up
+            tile_size (int): Tile side length of tiled runs (``tiled=True``)
+            tile_overlap (int): Minimum overlap of neighbouring tiles; objects
+                smaller than this are always seen whole in one tile
+            tile_workers (int): Number of tiles segmented in parallel
+            tile_iou_threshold (float): Minimum IoU of the boxes of two detections
+                from neighbouring tiles to count them as one object
+            tile_top_n (int): Number of largest segments kept per tile of tiled
+                runs. All segments kept in any tile are merged and classified, so
+                a tiled run can count many more objects than ``top_n``
         """
+        validate_precision(precision)
+        
         self.top_n = top_n
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_workers = max(1, int(tile_workers))
+        self.tile_iou_threshold = tile_iou_threshold
+        self.tile_top_n = tile_top_n
+        self.max_side = max_side
+        self.batch_size = max(1, int(batch_size))
+        self.sam_cache = SamCache(
+            max_bytes=int(cache_size_mb * 1024 * 1024),
+            spill_dir=cache_dir
+        )
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         logger.info(f"Using device: {self.device}")
+        if precision == 'int8-dynamic' and self.device != 'cpu':
+            logger.warning("Dynamic int8 quantization is only supported on CPU, using fp32")
+            precision = 'fp32'
+        self.precision = precision
+        self.fallback = fallback
+        self.fallback_stages = []
+        self.candidate_labels = [
+            "car", "cat", "tree", "dog", "building", 
+            "person", "sky", "ground", "hardware"
+        ]
+        
+        # Options every backend receives; each uses the ones it needs
+        self.backend_options = {
+            'device': self.device,
+            'precision': precision,
+            'sam_cache': self.sam_cache,
+            'batch_size': self.batch_size,
+            'batch_wait_ms': batch_wait_ms,
+            'runtime': classifier_backend,
+            'candidate_labels': self.candidate_labels
+        }
+        self.segmenter = create_backend(SEGMENTERS, segmenter, **self.backend_options)
+        self.classifier = create_backend(CLASSIFIERS, classifier, **self.backend_options)
+        self.refiner = create_backend(REFINERS, refiner, **self.backend_options)
+        # Presets that swap in a different segmenter, e.g. "classical"
+        self.preset_segmenters = {
+            preset: create_backend(SEGMENTERS, name, **self.backend_options)
+            for preset, name in SEGMENTER_PRESETS.items()
+        }
+        
+        self.load_status = {
+            stage: {'backend': backend.name, 'state': 'pending', 'load_time': None, 'error': None}
+            for stage, backend in self._stages()
+        }
+        self.load_status['warmup'] = {'state': 'pending', 'load_time': None, 'error': None}
+        self._load_lock = threading.Lock()
+        self._ready = False
         
         # Initialize models
-        self._initialize_sam()
-        self._initialize_classification_models()
+        if not lazy:
+            self.load(warm_up=False)
+    
+    def load(self, warm_up=True):
+        """
+        Load all models (no-op if they are already loaded).
         
-    def _initialize_sam(self):
-        """Initialize the SAM (Segment Anything Model)."""
-        try:
-            # Download SAM checkpoint if not exists
-            checkpoint_path = "sam_vit_b_01ec64.pth"
-            if not os.path.exists(checkpoint_path):
-                logger.info("Downloading SAM checkpoint...")
-                url = "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth"
-                urllib.request.urlretrieve(url, checkpoint_path)
-                logger.info("SAM checkpoint downloaded successfully")
-            
-            # Load SAM model
-            self.sam = sam_model_registry["vit_b"](checkpoint_path)
-            self.sam.to(self.device)
-            
-            # Initialize mask generator
-            self.mask_generator = SamAutomaticMaskGenerator(
-                model=self.sam,
-                points_per_side=16,
-                pred_iou_thresh=0.7,
-                stability_score_thresh=0.85,
-                min_mask_region_area=500,
-            )
-            
-            logger.info("SAM model initialized successfully")
+        After a failure, calling it again only loads the stages that are not
+        loaded yet.
+        
+        Args:
+            warm_up (bool): Run a dummy inference after loading so the first
+                request does not pay for kernel initialization
+        """
+        with self._load_lock:
+            if self._ready:
+                return
             
-        except Exception as e:
-            logger.error(f"Error initializing SAM: {str(e)}")
-            raise
-    
-    def _initialize_classification_models(self):
-        """Initialize ResNet-50 and DistilBERT models."""
-        try:
             # Set up local cache directory
-            import os
             cache_dir = os.path.join(os.getcwd(), ".huggingface_cache")
             os.makedirs(cache_dir, exist_ok=True)
             
-            # Initialize ResNet-50
-            self.image_processor = AutoImageProcessor.from_pretrained(
-                "microsoft/resnet-50",
-                cache_dir=cache_dir
+            self._load_backend('segmenter', lambda: self.segmenter.load())
+            self._load_backend('classifier', lambda: self.classifier.load(cache_dir))
+            self._load_backend(
+                'refiner', lambda: self.refiner.load(self.classifier.get_class_names(), cache_dir)
             )
-            self.class_model = AutoModelForImageClassification.from_pretrained(
-                "microsoft/resnet-50",
-                cache_dir=cache_dir
-            )
-            
-            # Initialize DistilBERT zero-shot classifier
-            self.label_classifier = pipeline(
-                "zero-shot-classification", 
-                model="typeform/distilbert-base-uncased-mnli",
-                model_kwargs={"cache_dir": cache_dir}
-            )
-            
-            # Define candidate labels
-            self.candidate_labels = [
-                "car", "cat", "tree", "dog", "building", 
-                "person", "sky", "ground", "hardware"
-            ]
+            for preset, segmenter in list(self.preset_segmenters.items()):
+                try:
+                    segmenter.load()
+                except Exception as e:
+                    logger.error(f"Error initializing segmenter '{segmenter.name}', disabling preset {preset}: {str(e)}")
+                    del self.preset_segmenters[preset]
+            if warm_up:
+                self.warm_up()
+            self._ready = True
+    
+    def _load_backend(self, stage, load):
+        """
+        Load one pipeline stage, falling back to its stand-in on failure.
+        
+        Args:
+            stage (str): "segmenter", "classifier" or "refiner"
+            load (callable): Loads the stage's backend
+        """
+        if self.load_status[stage]['state'] == 'ready':
+            return
+        try:
+            with self._loading(stage):
+                load()
+            logger.info(f"{stage.capitalize()} '{getattr(self, stage).name}' initialized successfully")
+        except Exception as e:
+            logger.error(f"Error initializing {stage} '{getattr(self, stage).name}': {str(e)}")
+            if not self.fallback:
+                raise
             
-            logger.info("Classification models initialized successfully")
+            # The refiner maps the stand-in classifier's labels as they are
+            logger.warning(f"Falling back to the stand-in {stage}")
+            if stage == 'segmenter':
+                self.segmenter = create_backend(SEGMENTERS, 'stub', **self.backend_options)
+            elif stage == 'classifier':
+                self.classifier = StubClassifier(**self.backend_options)
+                self.refiner = IdentityRefiner(**self.backend_options)
+            else:
+                self.refiner = IdentityRefiner(**self.backend_options)
+            self.fallback_stages.append(stage)
+            for name, backend in self._stages():
+                self.load_status[name]['backend'] = backend.name
+    
+    def _stages(self):
+        return [('segmenter', self.segmenter), ('classifier', self.classifier), ('refiner', self.refiner)]
+    
+    def is_ready(self):
+        """
+        Check whether the models are loaded and requests can be served.
+        
+        Returns:
+            bool: True once load() has completed
+        """
+        return self._ready
+    
+    def get_load_status(self):
+        """
+        Get the backend, load state and load time (in seconds) of each stage.
+        
+        Returns:
+            dict: Status per stage ("pending", "loading", "ready" or "failed")
+        """
+        return {name: dict(status) for name, status in self.load_status.items()}
+    
+    def share_memory(self):
+        """
+        Move the model weights into shared memory.
+        
+        Worker processes forked afterwards map the same weights instead of
+        holding their own copies.
+        """
+        for _, backend in self._stages():
+            backend.share_memory()
+    
+    @contextmanager
+    def _loading(self, name):
+        """Record the state and duration of a model loading step."""
+        status = self.load_status[name]
+        status.update(state='loading', error=None)
+        start_time = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            status.update(state='failed', error=str(e))
+            raise
+        else:
+            status['state'] = 'ready'
+        finally:
+            status['load_time'] = round(time.perf_counter() - start_time, 3)
+            MODEL_LOAD_SECONDS.set(status['load_time'], model=name)
+    
+    @contextmanager
+    def _timed(self, timings, stage):
+        """Add the duration of a pipeline stage to ``timings`` (in seconds)."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start_time
+    
+    def _record_timings(self, timings):
+        """
+        Record stage timings in the stage latency histogram.
+        
+        Args:
+            timings (dict): Seconds per stage
             
+        Returns:
+            dict: Milliseconds per stage in pipeline order, for result details
+        """
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        return {
+            stage: round(timings[stage] * 1000, 2)
+            for stage in PIPELINE_STAGES if stage in timings
+        }
+    
+    def warm_up(self):
+        """
+        Run a dummy inference through all pipeline stages.
+        
+        Failures are logged and recorded, but do not prevent serving.
+        """
+        try:
+            with self._loading('warmup'):
+                dummy_image = Image.fromarray(
+                    np.random.default_rng(0).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+                )
+                buffer = io.BytesIO()
+                dummy_image.save(buffer, format='PNG')
+                buffer.seek(0)
+                
+                # Bypass the caches so the dummy image does not occupy them
+                cache_max_bytes = self.sam_cache.max_bytes
+                self.sam_cache.max_bytes = 0
+                try:
+                    self._run_pipeline(buffer)
+                finally:
+                    self.sam_cache.max_bytes = cache_max_bytes
+            logger.info(f"Warm-up completed in {self.load_status['warmup']['load_time']}s")
         except Exception as e:
-            logger.error(f"Error initializing classification models: {str(e)}")
-            # Create fallback mode for development
-            logger.warning("Falling back to basic mode without HuggingFace models")
-            self.image_processor = None
-            self.class_model = None
-            self.label_classifier = None
-            self.candidate_labels = [
-                "car", "cat", "tree", "dog", "building", 
-                "person", "sky", "ground", "hardware"
-            ]
+            logger.warning(f"Warm-up inference failed: {str(e)}")
     
-    def count_objects(self, image_path, target_item_type):
+    def count_objects(self, image_path, target_item_type, preset=None, progress_callback=None,
+                      tiled=False):
         """
         Count objects of a specific type in an image.
         
         Args:
-            image_path (str): Path to the input image
+            image_path: Path to the input image, or the image itself as bytes, a
+                file object, a PIL Image or an RGB array (see image_loading.load_image)
             target_item_type (str): Type of object to count
-            
+            preset (str): SAM speed/quality preset (default: "balanced")
+            progress_callback (callable): Optional ``callback(stage, info)``
+                called as the pipeline moves through its stages; it may raise
+                PipelineCancelled to abort the run
+            tiled (bool): Segment the image in overlapping tiles at full
+                resolution (see _run_tiled_pipeline)
+        
         Returns:
             dict: Results containing count, confidence, and details
         """
         try:
-            logger.info(f"Processing image: {image_path} for item type: {target_item_type}")
-            
-            # Check if we're in fallback mode (no HuggingFace models)
-            if self.image_processor is None or self.class_model is None:
-                logger.warning("Running in fallback mode - returning mock results")
-                return {
-                    "count": 3,  # Mock count
-                    "confidence_score": 0.85,
-                    "processing_time": 2.5,
-                    "details": {
-                        "segments_found": 3,
-                        "model_confidence": 0.85,
-                        "fallback_mode": True
-                    }
-                }
-            
-            # Load and process image
-            image = Image.open(image_path)
-            height, width = image.size[1], image.size[0]
-            logger.info(f"Image size: {width}x{height}")
+            logger.info(f"Processing image: {describe_image(image_path)} for item type: {target_item_type}")
             
-            # Step 1: Generate segmentation masks using SAM
-            logger.info("Generating segmentation masks...")
-            masks = self.mask_generator.generate(np.array(image))
-            masks_sorted = sorted(masks, key=lambda x: x['area'], reverse=True)
-            
-            # Create panoptic map
-            predicted_panoptic_map = np.zeros((height, width), dtype=np.int32)
-            for idx, mask_data in enumerate(masks_sorted[:self.top_n]):
-                predicted_panoptic_map[mask_data['segmentation']] = idx + 1
-            
-            predicted_panoptic_map = torch.from_numpy(predicted_panoptic_map)
-            logger.info(f"Generated {len(masks_sorted[:self.top_n])} segments")
-            
-            # Step 2: Extract and classify segments
-            segments, labels, predicted_classes = self._process_segments(
-                image, predicted_panoptic_map
+            # Steps 1-2: Segment the image and classify the segments
+            timings = {}
+            run_details = {}
+            segments, labels, predicted_classes = self._run_pipeline(
+                image_path, preset, progress_callback, timings, tiled, run_details
             )
+            self._report_progress(progress_callback, 'counting')
             
             # Step 3: Count target objects
-            count, confidence, details = self._count_target_objects(
-                labels, target_item_type, segments, predicted_classes
-            )
+            with self._timed(timings, 'count'):
+                count, confidence, details = self._count_target_objects(
+                    labels, target_item_type, segments, predicted_classes
+                )
             
             result = {
                 'count': count,
@@ -174,6 +379,9 @@ class ObjectCounter:
                 'details': {
                     'total_segments': len(segments),
                     'target_type': target_item_type,
+                    **self._fallback_details(),
+                    **run_details,
+                    'stage_timings_ms': self._record_timings(timings),
                     'segment_details': [
                         {
                             'segment_id': i,
@@ -189,104 +397,641 @@ class ObjectCounter:
             logger.info(f"Object counting completed. Count: {count}, Confidence: {confidence}")
             return result
             
+        except PipelineCancelled:
+            logger.info("Pipeline run cancelled")
+            raise
         except Exception as e:
             logger.error(f"Error in count_objects: {str(e)}")
             raise
     
-    def _process_segments(self, image, panoptic_map):
+    def count_all_objects(self, image_path, item_types=None, preset=None, progress_callback=None,
+                          tiled=False):
         """
-        Process individual segments for classification.
+        Count objects of several types in an image with a single pipeline run.
+        
+        Args:
+            image_path: Path to the input image, or the image itself as bytes, a
+                file object, a PIL Image or an RGB array (see image_loading.load_image)
+            item_types (list): Types of object to count (default: all supported types)
+            preset (str): SAM speed/quality preset (default: "balanced")
+            progress_callback (callable): Optional ``callback(stage, info)``
+                called as the pipeline moves through its stages; it may raise
+                PipelineCancelled to abort the run
+            tiled (bool): Segment the image in overlapping tiles at full
+                resolution (see _run_tiled_pipeline)
+        
+        Returns:
+            dict: Results containing per-type counts and confidences, and details
+        """
+        try:
+            item_types = list(item_types) if item_types else self.get_supported_item_types()
+            logger.info(f"Processing image: {describe_image(image_path)} for item types: {item_types}")
+            
+            # Steps 1-2: Segment the image and classify the segments
+            timings = {}
+            run_details = {}
+            segments, labels, predicted_classes = self._run_pipeline(
+                image_path, preset, progress_callback, timings, tiled, run_details
+            )
+            self._report_progress(progress_callback, 'counting')
+            
+            # Step 3: Count every requested type from the same labels
+            counts = {}
+            confidences = {}
+            with self._timed(timings, 'count'):
+                for item_type in item_types:
+                    count, confidence, _ = self._count_target_objects(
+                        labels, item_type, segments, predicted_classes
+                    )
+                    counts[item_type] = count
+                    confidences[item_type] = confidence
+                
+                label_histogram = {}
+                for label in labels:
+                    label_histogram[label] = label_histogram.get(label, 0) + 1
+            
+            result = {
+                'counts': counts,
+                'confidences': confidences,
+                'details': {
+                    'total_segments': len(segments),
+                    'item_types': item_types,
+                    **self._fallback_details(),
+                    **run_details,
+                    'label_histogram': label_histogram,
+                    'stage_timings_ms': self._record_timings(timings),
+                    'segment_details': [
+                        {
+                            'segment_id': i,
+                            'predicted_class': pred_class,
+                            'refined_label': label
+                        }
+                        for i, (pred_class, label) in enumerate(zip(predicted_classes, labels))
+                    ]
+                }
+            }
+            
+            logger.info(f"Object counting completed. Counts: {counts}")
+            return result
+            
+        except PipelineCancelled:
+            logger.info("Pipeline run cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"Error in count_all_objects: {str(e)}")
+            raise
+    
+    def _fallback_details(self):
+        """Result details flagging stages that run on stand-in backends."""
+        if not self.fallback_stages:
+            return {}
+        return {'fallback_mode': True, 'fallback_stages': list(self.fallback_stages)}
+    
+    def _run_pipeline(self, image_path, preset=None, progress_callback=None, timings=None,
+                      tiled=False, run_details=None):
+        """
+        Segment an image and classify the largest segments.
+        
+        Args:
+            image_path: Path to the input image, or the image itself as bytes, a
+                file object, a PIL Image or an RGB array (see image_loading.load_image)
+            preset (str): SAM speed/quality preset (default: "balanced")
+            progress_callback (callable): Optional ``callback(stage, info)``
+            timings (dict): Optional dict that receives the seconds spent per stage
+            tiled (bool): Segment the image tile by tile (see _run_tiled_pipeline)
+            run_details (dict): Optional dict that receives extra result details
+            
+        Returns:
+            tuple: (segments, labels, predicted_classes)
+        """
+        timings = {} if timings is None else timings
+        if tiled:
+            return self._run_tiled_pipeline(image_path, preset, progress_callback, timings, run_details)
+        
+        # Load and process image, decoding no more pixels than segmentation needs
+        self._report_progress(progress_callback, 'decoding')
+        with self._timed(timings, 'decode'):
+            image, image_info = load_image(image_path, self.max_side)
+            width, height = image.size
+            logger.info(f"Image size: {image_info['original_size']}, decoded at {width}x{height}")
+            image_array = np.array(image)
+            segmentation_array = self._downscale_for_segmentation(image, image_array)
+        if run_details is not None:
+            run_details['image'] = image_info
+        
+        # Step 1: Generate segmentation masks
+        logger.info(f"Generating segmentation masks with {self._segmenter_for(preset).name}...")
+        self._report_progress(progress_callback, 'segmenting')
+        with self._timed(timings, 'mask_generation'):
+            masks = self._generate_masks(segmentation_array, preset)
+        
+        with self._timed(timings, 'panoptic_map'):
+            predicted_panoptic_map, boxes = self._build_panoptic_map(
+                masks, segmentation_array.shape, (height, width)
+            )
+        
+        logger.info(f"Generated {len(boxes)} segments")
+        
+        # Step 2: Extract and classify segments
+        return self._process_segments(
+            image_array, predicted_panoptic_map, boxes, progress_callback, timings
+        )
+    
+    def _run_tiled_pipeline(self, image_path, preset=None, progress_callback=None, timings=None,
+                            run_details=None):
+        """
+        Segment an image in overlapping tiles and classify the merged segments.
+        
+        Every tile of ``tile_size`` pixels is segmented at full resolution, so
+        small objects in large images are not lost to downscaling, and only
+        tile-sized panoptic maps are built. Each tile keeps its ``tile_top_n``
+        largest segments; ``top_n`` does not apply, as it would cap the count
+        of the whole image at a few tiles' worth of objects. Up to ``tile_workers`` tiles are
+        processed in parallel. Objects found in several overlapping tiles
+        are merged by box IoU (see tiling.deduplicate_boxes) before they
+        are classified once.
+        
+        Args:
+            image_path: Path to the input image, or the image itself as bytes, a
+                file object, a PIL Image or an RGB array (see image_loading.load_image)
+            preset (str): SAM speed/quality preset (default: "balanced")
+            progress_callback (callable): Optional ``callback(stage, info)``
+            timings (dict): Optional dict that receives the seconds spent per
+                stage, summed over all tiles
+            run_details (dict): Optional dict that receives the tile statistics
+            
+        Returns:
+            tuple: (segments, labels, predicted_classes)
+        """
+        timings = {} if timings is None else timings
+        
+        self._report_progress(progress_callback, 'decoding')
+        with self._timed(timings, 'decode'):
+            image, image_info = load_image(image_path)
+            width, height = image.size
+        if run_details is not None:
+            run_details['image'] = image_info
+        tiles = tile_grid(width, height, self.tile_size, self.tile_overlap)
+        logger.info(
+            f"Image size: {width}x{height}, segmenting {len(tiles)} tiles "
+            f"with {self._segmenter_for(preset).name}..."
+        )
+        
+        # Step 1: Segment and crop every tile
+        segments, boxes, areas, tile_indices = [], [], [], []
+        self._report_progress(progress_callback, 'segmenting', completed=0, total=len(tiles))
+        executor = None
+        if self.tile_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=self.tile_workers, thread_name_prefix='count-tile')
+        try:
+            tile_results = (executor.map if executor else map)(
+                lambda tile: self._segment_tile(image, tile, preset), tiles
+            )
+            for tile_index, (tile_segments, tile_boxes, tile_areas, tile_timings) in enumerate(tile_results):
+                segments.extend(tile_segments)
+                boxes.extend(tile_boxes)
+                areas.extend(tile_areas)
+                tile_indices.extend([tile_index] * len(tile_segments))
+                for stage, seconds in tile_timings.items():
+                    timings[stage] = timings.get(stage, 0.0) + seconds
+                self._report_progress(progress_callback, 'segmenting', completed=tile_index + 1, total=len(tiles))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        
+        # Count objects on tile seams once
+        with self._timed(timings, 'merge'):
+            keep = deduplicate_boxes(boxes, areas, tile_indices, tiles, self.tile_iou_threshold)
+            segments = [segments[i] for i in keep]
+        logger.info(f"Merged {len(boxes)} tile segments into {len(segments)} segments")
+        if run_details is not None:
+            run_details['tiling'] = {
+                'tiles': len(tiles),
+                'tile_segments': len(boxes),
+                'duplicates_removed': len(boxes) - len(segments)
+            }
+        
+        # Step 2: Classify the merged segments
+        labels, predicted_classes = self._label_segments(segments, progress_callback, timings)
+        return segments, labels, predicted_classes
+    
+    def _segment_tile(self, image, tile, preset=None):
+        """
+        Segment one tile and crop its ``tile_top_n`` largest segments.
+        
+        Args:
+            image: Decoded PIL Image object
+            tile (tuple): (x_start, y_start, x_end, y_end), ends exclusive
+            preset (str): SAM speed/quality preset (default: "balanced")
+            
+        Returns:
+            tuple: (segments, boxes in image coordinates, mask areas, seconds per stage)
+        """
+        timings = {}
+        x_offset, y_offset = tile[:2]
+        tile_image = image.crop(tile)
+        tile_array = np.array(tile_image)
+        segmentation_array = self._downscale_for_segmentation(tile_image, tile_array)
+        
+        with self._timed(timings, 'mask_generation'):
+            masks = self._generate_masks(segmentation_array, preset)
+        with self._timed(timings, 'panoptic_map'):
+            panoptic_map, boxes = self._build_panoptic_map(
+                masks, segmentation_array.shape, tile_array.shape[:2], self.tile_top_n
+            )
+        with self._timed(timings, 'crop'):
+            kept = []
+            segments = self._crop_segments(tile_array, panoptic_map, boxes, kept)
+        
+        boxes = [
+            (x_start + x_offset, y_start + y_offset, x_end + x_offset, y_end + y_offset)
+            for x_start, y_start, x_end, y_end, _ in kept
+        ]
+        return segments, boxes, [area for *_, area in kept], timings
+    
+    def _build_panoptic_map(self, masks, segmentation_shape, size, limit=None):
+        """
+        Paint the largest masks (``top_n`` by default) into a panoptic map.
+        
+        Only the pixels inside each used mask's box are touched.
+        
+        Args:
+            masks (list): Mask dicts as returned by Segmenter.segment()
+            segmentation_shape (tuple): Shape of the segmented image array
+            size (tuple): Size (height, width) of the map
+            limit (int): Number of masks to paint (default: ``top_n``)
+            
+        Returns:
+            tuple: (panoptic map with labels 1..n, (x_start, y_start, x_end, y_end) per label)
+        """
+        height, width = size
+        masks_sorted = sorted(masks, key=lambda x: x['area'], reverse=True)
+        scale = (
+            segmentation_shape[1] / width,
+            segmentation_shape[0] / height
+        )
+        panoptic_map = np.zeros((height, width), dtype=np.int32)
+        boxes = []
+        for idx, mask_data in enumerate(masks_sorted[:limit or self.top_n]):
+            box, box_mask = self._lift_mask(mask_data, scale, (height, width))
+            x_start, y_start, x_end, y_end = box
+            panoptic_map[y_start:y_end+1, x_start:x_end+1][box_mask] = idx + 1
+            boxes.append(box)
+        return panoptic_map, boxes
+    
+    def _report_progress(self, progress_callback, stage, **info):
+        """
+        Report a pipeline stage to an optional progress callback.
+        
+        Args:
+            progress_callback (callable): ``callback(stage, info)`` or None
+            stage (str): "decoding", "segmenting", "classifying", "refining" or "counting"
+            **info: Stage details, e.g. the number of classified segments
+        """
+        if progress_callback is not None:
+            progress_callback(stage, info)
+    
+    def _downscale_for_segmentation(self, image, image_array):
+        """
+        Downscale an image so its longest side is at most ``max_side``.
         
         Args:
             image: PIL Image object
-            panoptic_map: Tensor containing segment labels
+            image_array (np.ndarray): The same image as an array
+            
+        Returns:
+            np.ndarray: Image array to segment (the input array if no
+                downscaling is needed)
+        """
+        width, height = image.size
+        if not self.max_side or max(width, height) <= self.max_side:
+            return image_array
+        
+        factor = self.max_side / max(width, height)
+        size = (max(1, round(width * factor)), max(1, round(height * factor)))
+        logger.info(f"Downscaling image to {size[0]}x{size[1]} for segmentation")
+        return np.array(image.resize(size, Image.BILINEAR))
+    
+    def _lift_mask(self, mask_data, scale, size):
+        """
+        Map a SAM mask back to original image coordinates.
+        
+        Only the part of the mask inside its bounding box is upsampled
+        (nearest neighbour), never the full-resolution mask. Each original
+        pixel takes the mask value at its centre, so the result equals a
+        nearest-neighbour resize of the whole mask.
+        
+        Args:
+            mask_data (dict): Mask dict with ``segmentation`` and ``bbox`` (XYWH)
+            scale (tuple): (x, y) factors from original to segmentation resolution
+            size (tuple): Original image size (height, width)
+            
+        Returns:
+            tuple: ((x_start, y_start, x_end, y_end), mask inside that box)
+        """
+        x, y, w, h = (int(v) for v in mask_data['bbox'])
+        box_mask = mask_data['segmentation'][y:y + h + 1, x:x + w + 1]
+        if scale == (1.0, 1.0):
+            return (x, y, x + w, y + h), box_mask
+        
+        scale_x, scale_y = scale
+        height, width = size
+        x_start, x_end, cols = self._lift_range(x, x + w, scale_x, width)
+        y_start, y_end, rows = self._lift_range(y, y + h, scale_y, height)
+        return (x_start, y_start, x_end, y_end), box_mask[rows[:, None], cols]
+    
+    def _lift_range(self, start, end, scale, length):
+        """
+        Find the original pixels whose centres fall into a range of segmentation pixels.
+        
+        Args:
+            start (int): First segmentation pixel of the range
+            end (int): Last segmentation pixel of the range (inclusive)
+            scale (float): Factor from original to segmentation resolution
+            length (int): Original image width or height
+            
+        Returns:
+            tuple: (first original pixel, last original pixel, segmentation
+                pixel of each original pixel relative to ``start``)
+        """
+        # Candidates one pixel beyond the range on both sides, so float
+        # rounding cannot drop an edge pixel
+        first = max(0, int(start / scale) - 1)
+        last = min(length - 1, int(np.ceil((end + 1) / scale)))
+        sources = ((np.arange(first, last + 1) + 0.5) * scale).astype(np.int64)
+        inside = np.flatnonzero((sources >= start) & (sources <= end))
+        if inside.size == 0:
+            # A range narrower than one original pixel keeps its nearest pixel
+            nearest = min(length - 1, int((start + 0.5) / scale))
+            return nearest, nearest, np.zeros(1, dtype=np.int64)
+        return int(first + inside[0]), int(first + inside[-1]), sources[inside[0]:inside[-1] + 1] - start
+    
+    def _generate_masks(self, image_array, preset=None):
+        """
+        Generate segmentation masks, reusing cached masks for previously seen images.
+        
+        Args:
+            image_array (np.ndarray): RGB image (H, W, 3)
+            preset (str): SAM speed/quality preset (default: "balanced")
+            
+        Returns:
+            list: Mask dicts as returned by Segmenter.segment()
+        """
+        preset = self._resolve_preset(preset)
+        segmenter = self._segmenter_for(preset)
+        if not self.sam_cache.enabled:
+            return segmenter.segment(image_array, preset)
+        
+        config_key = json.dumps(segmenter.get_config(preset), sort_keys=True)
+        mask_key = f"{hash_image(image_array)}:{config_key}"
+        masks = self.sam_cache.get_masks(mask_key)
+        if masks is not None:
+            logger.info("Using cached SAM masks")
+            return masks
+        
+        masks = segmenter.segment(image_array, preset)
+        self.sam_cache.put_masks(mask_key, masks)
+        return masks
+    
+    def _segmenter_for(self, preset):
+        """
+        Get the segmenter that runs for a preset.
+        
+        Args:
+            preset (str): Preset name, or None for the default preset
+            
+        Returns:
+            Segmenter: The preset's own segmenter, or the configured one
+        """
+        return self.preset_segmenters.get(self._resolve_preset(preset), self.segmenter)
+    
+    def _resolve_preset(self, preset):
+        """
+        Validate a preset name.
+        
+        Args:
+            preset (str): Preset name, or None for the default preset
             
+        Returns:
+            str: The preset name to use
+        """
+        if preset is None:
+            return DEFAULT_SAM_PRESET
+        if preset not in SAM_PRESETS and preset not in self.preset_segmenters:
+            raise ValueError(f"Unknown preset: {preset}. Must be one of: {self.get_presets()}")
+        return preset
+    
+    def get_presets(self):
+        """
+        Get the available presets: SAM speed/quality presets and presets
+        that run a different segmenter (e.g. "classical").
+        
+        Returns:
+            list: Preset names
+        """
+        return list(SAM_PRESETS) + list(self.preset_segmenters)
+    
+    def get_cache_stats(self):
+        """
+        Get hit/miss counters and memory usage of the SAM cache.
+        
+        Returns:
+            dict: Cache statistics
+        """
+        return self.sam_cache.stats()
+    
+    def _process_segments(self, image, panoptic_map, boxes=None, progress_callback=None, timings=None):
+        """
+        Process individual segments for classification.
+        
+        Args:
+            image: PIL Image object or RGB array (H, W, 3)
+            panoptic_map (np.ndarray): Segment labels (0 is background)
+            boxes (list): Optional (x_start, y_start, x_end, y_end) box per
+                segment label, e.g. the ``bbox`` returned by SAM. Computed from
+                the panoptic map when not given.
+            progress_callback (callable): Optional ``callback(stage, info)``
+            timings (dict): Optional dict that receives the seconds spent per stage
+        
         Returns:
             tuple: (segments, labels, predicted_classes)
         """
-        transform = tf.Compose([tf.PILToTensor()])
-        img_tensor = transform(image)
+        timings = {} if timings is None else timings
+        with self._timed(timings, 'crop'):
+            segments = self._crop_segments(image, panoptic_map, boxes)
+        
+        labels, predicted_classes = self._label_segments(segments, progress_callback, timings)
+        return segments, labels, predicted_classes
+    
+    def _label_segments(self, segments, progress_callback=None, timings=None):
+        """
+        Classify segment crops and refine their labels.
+        
+        Args:
+            segments (list): Masked segment tensors (C, H, W)
+            progress_callback (callable): Optional ``callback(stage, info)``
+            timings (dict): Optional dict that receives the seconds spent per stage
+        
+        Returns:
+            tuple: (labels, predicted_classes)
+        """
+        timings = {} if timings is None else timings
+        
+        # Classify all segments in batches
+        with self._timed(timings, 'classify'):
+            predicted_classes = self._classify_segments(segments, progress_callback)
+        
+        # Refine labels, e.g. through the precomputed label table
+        self._report_progress(progress_callback, 'refining')
+        with self._timed(timings, 'refine'):
+            labels = self._refine_labels(predicted_classes)
+        
+        return labels, predicted_classes
+    
+    def _crop_segments(self, image, panoptic_map, boxes=None, kept=None):
+        """
+        Crop every segment and fill its background.
+        
+        Args:
+            image: PIL Image object or RGB array (H, W, 3)
+            panoptic_map (np.ndarray): Segment labels (0 is background)
+            boxes (list): Optional box per segment label (see _process_segments)
+            kept (list): Optional list that receives the tightened
+                (x_start, y_start, x_end, y_end, area) of every returned segment
+        
+        Returns:
+            list: Masked segment tensors (C, H, W)
+        """
+        image_array = image if isinstance(image, np.ndarray) else np.asarray(image)
+        if boxes is None:
+            boxes = self._get_segment_boxes(panoptic_map)
         
         segments = []
-        predicted_classes = []
         
-        # Process each segment
-        for label in panoptic_map.unique():
-            if label == 0:  # Skip background
+        # Process each segment, only touching the pixels inside its box
+        for idx, box in enumerate(boxes):
+            if box is None:
                 continue
-                
-            # Get bounding box for segment
-            y_start, y_end = self._get_mask_box(panoptic_map == label)
-            x_start, x_end = self._get_mask_box((panoptic_map == label).T)
+            label = idx + 1
+            x_start, y_start, x_end, y_end = box
+            cropped_mask = panoptic_map[y_start:y_end+1, x_start:x_end+1] == label
             
-            if y_start is None or x_start is None:
+            # Tighten the box to the pixels still visible in the panoptic map
+            rows = np.flatnonzero(cropped_mask.any(axis=1))
+            if rows.size == 0:
                 continue
+            cols = np.flatnonzero(cropped_mask.any(axis=0))
+            cropped_mask = cropped_mask[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+            y_start, x_start = y_start + rows[0], x_start + cols[0]
             
-            # Crop segment
-            cropped_tensor = img_tensor[:, y_start:y_end+1, x_start:x_end+1]
-            cropped_mask = panoptic_map[y_start:y_end+1, x_start:x_end+1] == label
-            
-            # Create masked segment
-            segment = cropped_tensor * cropped_mask.unsqueeze(0)
-            segment[:, ~cropped_mask] = 188  # Background color
+            # Crop segment and fill the background
+            cropped_image = image_array[
+                y_start:y_start + cropped_mask.shape[0],
+                x_start:x_start + cropped_mask.shape[1]
+            ]
+            segment = np.where(cropped_mask[..., None], cropped_image, 188).astype(np.uint8)
             
-            segments.append(segment)
+            segments.append(torch.from_numpy(segment.transpose(2, 0, 1).copy()))
+            if kept is not None:
+                kept.append((
+                    int(x_start), int(y_start),
+                    int(x_start) + cropped_mask.shape[1] - 1, int(y_start) + cropped_mask.shape[0] - 1,
+                    int(cropped_mask.sum())
+                ))
+        
+        return segments
+    
+    def _refine_labels(self, predicted_classes):
+        """
+        Map classifier predictions to candidate labels with the refiner backend.
+        
+        Args:
+            predicted_classes (list): Class names, e.g. ImageNet classes
             
-            # Classify segment with ResNet-50 (if available)
-            if self.image_processor is not None and self.class_model is not None:
-                try:
-                    inputs = self.image_processor(images=segment, return_tensors="pt")
-                    outputs = self.class_model(**inputs)
-                    logits = outputs.logits
-                    predicted_class_idx = logits.argmax(-1).item()
-                    predicted_class = self.class_model.config.id2label[predicted_class_idx]
-                    predicted_classes.append(predicted_class)
-                except Exception as e:
-                    logger.warning(f"Error classifying segment {label}: {str(e)}")
-                    predicted_classes.append("unknown")
-            else:
-                # Fallback: use a random candidate label for testing
-                import random
-                fallback_class = random.choice(self.candidate_labels)
-                logger.warning(f"ResNet not available, using fallback class: {fallback_class}")
-                predicted_classes.append(fallback_class)
-        
-        # Refine labels using DistilBERT (if available)
-        labels = []
-        if self.label_classifier is not None:
-            for predicted_class in predicted_classes:
-                try:
-                    result = self.label_classifier(predicted_class, self.candidate_labels)
-                    label = result['labels'][0]
-                    labels.append(label)
-                except Exception as e:
-                    logger.warning(f"Error refining label for {predicted_class}: {str(e)}")
-                    labels.append("unknown")
-        else:
-            # Fallback: use predicted classes directly
-            logger.warning("DistilBERT not available, using ResNet predictions directly")
-            labels = predicted_classes.copy()
+        Returns:
+            list: Candidate label for each prediction ("unknown" if unmapped)
+        """
+        return self.refiner.refine(predicted_classes)
+    
+    def _classify_segments(self, segments, progress_callback=None):
+        """
+        Classify segment crops with the classifier backend.
         
-        return segments, labels, predicted_classes
+        Crops are passed to the classifier in batches of at most ``batch_size``
+        segments instead of one call per segment (for ResNet-50, one forward
+        pass per batch, shared with concurrent requests when cross-request
+        batching is enabled).
+        
+        Args:
+            segments (list): Masked segment tensors (C, H, W)
+            progress_callback (callable): Optional ``callback(stage, info)``,
+                called after every batch with the labels of its segments
+        
+        Returns:
+            list: Predicted class name for each segment
+        """
+        predicted_classes = []
+        self._report_progress(progress_callback, 'classifying', completed=0, total=len(segments))
+        for start in range(0, len(segments), self.batch_size):
+            batch = segments[start:start + self.batch_size]
+            try:
+                predicted_classes.extend(self.classifier.classify(batch))
+            except Exception as e:
+                logger.warning(
+                    f"Error classifying segments {start}-{start + len(batch) - 1}: {str(e)}"
+                )
+                predicted_classes.extend(["unknown"] * len(batch))
+            if progress_callback is not None:
+                batch_labels = self._refine_labels(predicted_classes[start:])
+                self._report_progress(
+                    progress_callback, 'classifying',
+                    completed=len(predicted_classes), total=len(segments),
+                    segments=[
+                        {
+                            'segment_id': segment_id,
+                            'predicted_class': predicted_classes[segment_id],
+                            'refined_label': label
+                        }
+                        for segment_id, label in enumerate(batch_labels, start)
+                    ]
+                )
+        
+        return predicted_classes
     
-    def _get_mask_box(self, tensor):
+    def _get_segment_boxes(self, panoptic_map, chunk_rows=512):
         """
-        Get bounding box of non-zero elements in a tensor.
+        Get the bounding box of every segment in a single pass over the map.
         
         Args:
-            tensor (torch.Tensor): Input tensor
+            panoptic_map (np.ndarray): Segment labels (0 is background)
+            chunk_rows (int): Rows scanned at once, bounding temporary memory
             
         Returns:
-            tuple: (first_n, last_n) indices
+            list: (x_start, y_start, x_end, y_end) for labels 1..max, or None
+                for labels that do not occur
         """
-        non_zero_indices = torch.nonzero(tensor, as_tuple=True)[0]
-        if non_zero_indices.shape[0] == 0:
-            return None, None
+        num_labels = int(panoptic_map.max()) if panoptic_map.size else 0
+        big = np.iinfo(np.int64).max
+        y_min = np.full(num_labels + 1, big, dtype=np.int64)
+        x_min = np.full(num_labels + 1, big, dtype=np.int64)
+        y_max = np.full(num_labels + 1, -1, dtype=np.int64)
+        x_max = np.full(num_labels + 1, -1, dtype=np.int64)
         
-        first_n = non_zero_indices[:1].item()
-        last_n = non_zero_indices[-1:].item()
+        for offset in range(0, panoptic_map.shape[0], chunk_rows):
+            chunk = panoptic_map[offset:offset + chunk_rows]
+            ys, xs = np.nonzero(chunk)
+            labels = chunk[ys, xs]
+            ys += offset
+            np.minimum.at(y_min, labels, ys)
+            np.maximum.at(y_max, labels, ys)
+            np.minimum.at(x_min, labels, xs)
+            np.maximum.at(x_max, labels, xs)
         
-        return first_n, last_n
+        return [
+            (int(x_min[label]), int(y_min[label]), int(x_max[label]), int(y_max[label]))
+            if y_max[label] >= 0 else None
+            for label in range(1, num_labels + 1)
+        ]
     
     def _count_target_objects(self, labels, target_type, segments, predicted_classes):
         """
@@ -345,6 +1090,52 @@ class ObjectCounter:
         """
         return self.candidate_labels.copy()
     
+    def get_pipeline_config(self, preset=None, tiled=False):
+        """
+        Get the configuration that determines pipeline results.
+        
+        Args:
+            preset (str): SAM speed/quality preset (default: "balanced")
+            tiled (bool): Configuration of tiled runs
+            
+        Returns:
+            dict: Models, SAM parameters and segment/label settings
+        """
+        preset = self._resolve_preset(preset)
+        config = {
+            'candidate_labels': self.candidate_labels,
+            'top_n': self.top_n,
+            'max_side': self.max_side,
+            'precision': self.precision,
+            'fallback_mode': bool(self.fallback_stages),
+            'decoder_version': DECODER_VERSION
+        }
+        config.update(self._segmenter_for(preset).get_config(preset))
+        config.update(self.classifier.get_config())
+        config.update(self.refiner.get_config())
+        if tiled:
+            config['tiling'] = {
+                'tile_size': self.tile_size,
+                'tile_overlap': self.tile_overlap,
+                'iou_threshold': self.tile_iou_threshold,
+                'tile_top_n': self.tile_top_n
+            }
+        return config
+    
+    def get_config_fingerprint(self, preset=None, tiled=False):
+        """
+        Get a stable fingerprint of the pipeline configuration.
+        
+        Args:
+            preset (str): SAM speed/quality preset (default: "balanced")
+            tiled (bool): Fingerprint of tiled runs
+            
+        Returns:
+            str: SHA-256 hex digest of get_pipeline_config()
+        """
+        config = json.dumps(self.get_pipeline_config(preset, tiled), sort_keys=True)
+        return hashlib.sha256(config.encode('utf-8')).hexdigest()
+    
     def get_model_info(self):
         """
         Get information about the loaded models.
@@ -353,10 +1144,20 @@ class ObjectCounter:
             dict: Model information
         """
         return {
-            'sam_model': 'Segment Anything Model (ViT-B)',
-            'classification_model': 'ResNet-50 (ImageNet)',
-            'label_refinement': 'DistilBERT (Zero-shot)',
+            'segmenter': self.segmenter.get_info(),
+            'classifier': self.classifier.get_info(),
+            'refiner': self.refiner.get_info(),
+            'fallback_stages': self.fallback_stages,
             'device': self.device,
             'supported_types': self.candidate_labels,
-            'max_segments': self.top_n
+            'max_segments': self.top_n,
+            'sam_presets': list(SAM_PRESETS),
+            'presets': self.get_presets(),
+            'default_sam_preset': DEFAULT_SAM_PRESET,
+            'segmentation_max_side': self.max_side,
+            'tile_size': self.tile_size,
+            'tile_overlap': self.tile_overlap,
+            'max_segments_per_tile': self.tile_top_n,
+            'classification_batch_size': self.batch_size,
+            'precision': self.precision
         }
@@ -0,0 +1,164 @@
+import warnings
+import functools
+from contextlib import nullcontext
+
+import torch
+
+# Numeric precisions the models can be run in. "int8-dynamic" quantizes the
+# linear layers, which hold nearly all the weights of the SAM image encoder
+# (attention and MLP layers) and mask decoder; ResNet-50 is convolutional, so
+# only its final fc layer is quantized.
+PRECISION_MODES = ('fp32', 'bf16', 'int8-dynamic')
+
+
+def validate_precision(precision):
+    """
+    Check that a precision mode is supported.
+    
+    Args:
+        precision (str): Precision mode
+    
+    Raises:
+        ValueError: If the precision mode is unknown
+    """
+    if precision not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision: {precision}. Must be one of: {list(PRECISION_MODES)}")
+
+
+def autocast(precision, device_type='cpu'):
+    """
+    Get the autocast context for a precision mode.
+    
+    Args:
+        precision (str): Precision mode
+        device_type (str): "cpu" or "cuda"
+    
+    Returns:
+        context manager: bfloat16 autocast for "bf16", otherwise a no-op
+    """
+    if precision == 'bf16':
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def quantize_linear_layers(module):
+    """
+    Apply dynamic int8 quantization to the linear layers of a module.
+    
+    Weights are stored as int8 and activations are quantized on the fly,
+    so no calibration data is needed. Only supported on CPU.
+    
+    Args:
+        module (torch.nn.Module): Float module
+    
+    Returns:
+        torch.nn.Module: Quantized copy of the module
+    """
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao, which is not a dependency
+        warnings.simplefilter('ignore', DeprecationWarning)
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def autocast_forward(module, precision, device_type='cpu'):
+    """
+    Run a module's forward pass under autocast, returning float32 outputs.
+    
+    Casting the outputs back keeps callers that convert results to numpy
+    (which has no bfloat16) working unchanged. The module is patched in
+    place so its other attributes stay accessible.
+    
+    Args:
+        module (torch.nn.Module): Module to patch
+        precision (str): Precision mode
+        device_type (str): "cpu" or "cuda"
+    
+    Returns:
+        torch.nn.Module: The patched module
+    """
+    forward = module.forward
+    
+    @functools.wraps(forward)
+    def autocast_forward_fn(*args, **kwargs):
+        with autocast(precision, device_type):
+            outputs = forward(*args, **kwargs)
+        return _to_float(outputs)
+    
+    module.forward = autocast_forward_fn
+    return module
+
+
+def module_size_mb(module):
+    """
+    Get the size of a module's weights, including quantized packed weights.
+    
+    Args:
+        module (torch.nn.Module): Module to measure
+    
+    Returns:
+        float: Size in megabytes
+    """
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(item) for item in value)
+        return 0
+    
+    return round(sum(nbytes(value) for value in module.state_dict().values()) / (1024 * 1024), 2)
+
+
+def compare_logits(reference, candidate):
+    """
+    Compare classifier logits of a reduced precision model with float32 ones.
+    
+    Args:
+        reference (torch.Tensor): float32 logits (N, num_classes)
+        candidate (torch.Tensor): Reduced precision logits (N, num_classes)
+    
+    Returns:
+        dict: Maximum/mean absolute logit difference and top-1 agreement
+    """
+    reference = reference.float()
+    candidate = candidate.float()
+    diff = (reference - candidate).abs()
+    return {
+        'max_abs_logit_diff': round(diff.max().item(), 5),
+        'mean_abs_logit_diff': round(diff.mean().item(), 5),
+        'top1_agreement': round((reference.argmax(-1) == candidate.argmax(-1)).float().mean().item(), 4)
+    }
+
+
+def compare_masks(reference, candidate, threshold=0.0):
+    """
+    Compare mask logits of a reduced precision model with float32 ones.
+    
+    Args:
+        reference (torch.Tensor): float32 mask logits
+        candidate (torch.Tensor): Reduced precision mask logits
+        threshold (float): Logit threshold for binarizing the masks
+    
+    Returns:
+        dict: Maximum absolute logit difference and IoU of the binarized masks
+    """
+    reference = reference.float()
+    candidate = candidate.float()
+    reference_masks = reference > threshold
+    candidate_masks = candidate > threshold
+    union = (reference_masks | candidate_masks).sum().item()
+    intersection = (reference_masks & candidate_masks).sum().item()
+    return {
+        'max_abs_logit_diff': round((reference - candidate).abs().max().item(), 5),
+        'mask_iou': round(intersection / union, 4) if union else 1.0
+    }
+
+
+def _to_float(outputs):
+    if isinstance(outputs, torch.Tensor):
+        return outputs.float() if outputs.is_floating_point() else outputs
+    if isinstance(outputs, tuple):
+        return tuple(_to_float(output) for output in outputs)
+    if isinstance(outputs, list):
+        return [_to_float(output) for output in outputs]
+    return outputs
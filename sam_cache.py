@@ -0,0 +1,280 @@
+import os
+import pickle
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+
+logger = logging.getLogger(__name__)
+
+
+def hash_image(image_array):
+    """
+    Compute a content hash of a decoded image.
+    
+    Args:
+        image_array (np.ndarray): Decoded image
+    
+    Returns:
+        str: SHA-256 hex digest of the pixel data, shape and dtype
+    """
+    image_array = np.ascontiguousarray(image_array)
+    digest = hashlib.sha256()
+    digest.update(f"{image_array.shape}:{image_array.dtype}".encode('utf-8'))
+    digest.update(memoryview(image_array).cast('B'))
+    return digest.hexdigest()
+
+
+class SamCache:
+    """
+    Memory-bounded LRU cache for SAM image embeddings and generated masks.
+    
+    Entries are keyed by image content hash. When the in-memory budget is
+    exceeded the least recently used entries are evicted, and written to
+    ``spill_dir`` (if configured) so they can be reloaded later.
+    """
+    
+    KINDS = ('embeddings', 'masks')
+    
+    def __init__(self, max_bytes=512 * 1024 * 1024, spill_dir=None,
+                 max_spill_bytes=2 * 1024 * 1024 * 1024):
+        """
+        Initialize the cache.
+        
+        Args:
+            max_bytes (int): In-memory budget in bytes (0 disables caching)
+            spill_dir (str): Optional directory for evicted entries
+            max_spill_bytes (int): On-disk budget in bytes for spilled entries
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {kind: {'hits': 0, 'misses': 0, 'disk_hits': 0} for kind in self.KINDS}
+        self._evictions = 0
+    
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+    
+    def get_embedding(self, key):
+        """
+        Get cached image embeddings.
+        
+        Args:
+            key (str): Image key
+        
+        Returns:
+            dict: Embedding entry (features, original_size, input_size) or None
+        """
+        return self._get('embeddings', key)
+    
+    def put_embedding(self, key, features, original_size, input_size):
+        """
+        Store image embeddings.
+        
+        Args:
+            key (str): Image key
+            features (torch.Tensor): Image encoder output
+            original_size (tuple): Image size before the SAM transform
+            input_size (tuple): Image size after the SAM transform
+        """
+        features = features.detach().cpu().numpy()
+        entry = {
+            'features': features,
+            'original_size': tuple(original_size),
+            'input_size': tuple(input_size)
+        }
+        self._put('embeddings', key, entry, features.nbytes)
+    
+    def get_masks(self, key):
+        """
+        Get cached mask generator output.
+        
+        Args:
+            key (str): Image and generator configuration key
+        
+        Returns:
+            list: Mask dicts as returned by SamAutomaticMaskGenerator, or None
+        """
+        entry = self._get('masks', key)
+        if entry is None:
+            return None
+        
+        masks = []
+        for packed in entry:
+            mask_data = dict(packed)
+            shape = mask_data.pop('_shape')
+            bits = np.unpackbits(mask_data['segmentation'], count=shape[0] * shape[1])
+            mask_data['segmentation'] = bits.reshape(shape).astype(bool)
+            masks.append(mask_data)
+        return masks
+    
+    def put_masks(self, key, masks):
+        """
+        Store mask generator output, bit-packing the segmentations.
+        
+        Args:
+            key (str): Image and generator configuration key
+            masks (list): Mask dicts as returned by SamAutomaticMaskGenerator
+        """
+        entry = []
+        nbytes = 0
+        for mask_data in masks:
+            packed = dict(mask_data)
+            segmentation = np.asarray(mask_data['segmentation'], dtype=bool)
+            packed['segmentation'] = np.packbits(segmentation)
+            packed['_shape'] = segmentation.shape
+            nbytes += packed['segmentation'].nbytes + 256
+            entry.append(packed)
+        self._put('masks', key, entry, nbytes)
+    
+    def stats(self):
+        """
+        Get cache statistics.
+        
+        Returns:
+            dict: Hit/miss counters per kind, entry count and memory usage
+        """
+        with self._lock:
+            stats = {kind: dict(counters) for kind, counters in self._counters.items()}
+            stats.update({
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self._evictions,
+                'spill_dir': self.spill_dir
+            })
+        return stats
+    
+    def _get(self, kind, key):
+        if not self.enabled:
+            return None
+        
+        with self._lock:
+            item = self._entries.get((kind, key))
+            if item is not None:
+                self._entries.move_to_end((kind, key))
+                self._counters[kind]['hits'] += 1
+                return item[0]
+        
+        entry = self._load_spilled(kind, key)
+        with self._lock:
+            if entry is None:
+                self._counters[kind]['misses'] += 1
+                return None
+            self._counters[kind]['hits'] += 1
+            self._counters[kind]['disk_hits'] += 1
+        
+        value, nbytes = entry
+        self._put(kind, key, value, nbytes)
+        return value
+    
+    def _put(self, kind, key, value, nbytes):
+        if not self.enabled or nbytes > self.max_bytes:
+            return
+        
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop((kind, key), None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[(kind, key)] = (value, nbytes)
+            self._bytes += nbytes
+            
+            while self._bytes > self.max_bytes:
+                evicted_key, (evicted_value, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+                self._evictions += 1
+                evicted.append((evicted_key, evicted_value, evicted_bytes))
+        
+        for (evicted_kind, evicted_image_key), evicted_value, evicted_bytes in evicted:
+            self._spill(evicted_kind, evicted_image_key, evicted_value, evicted_bytes)
+    
+    def _spill_path(self, kind, key):
+        name = hashlib.sha256(f"{kind}:{key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_dir, f"{kind}_{name}.pkl")
+    
+    def _spill(self, kind, key, value, nbytes):
+        if not self.spill_dir:
+            return
+        
+        path = self._spill_path(kind, key)
+        try:
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((value, nbytes), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            self._trim_spill_dir()
+        except OSError as e:
+            logger.warning(f"Could not spill SAM cache entry to disk: {str(e)}")
+    
+    def _load_spilled(self, kind, key):
+        if not self.spill_dir:
+            return None
+        
+        path = self._spill_path(kind, key)
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"Ignoring unreadable SAM cache file {path}: {str(e)}")
+            return None
+    
+    def _trim_spill_dir(self):
+        files = []
+        for name in os.listdir(self.spill_dir):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.spill_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_spill_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class CachingSamPredictor(SamPredictor):
+    """
+    SamPredictor that reuses cached image embeddings for repeated images,
+    skipping the ViT image encoder.
+    """
+    
+    def __init__(self, sam_model, cache):
+        super().__init__(sam_model)
+        self.cache = cache
+    
+    def set_image(self, image, image_format="RGB"):
+        key = f"{hash_image(image)}:{image_format}"
+        cached = self.cache.get_embedding(key)
+        if cached is not None:
+            self.reset_image()
+            self.original_size = cached['original_size']
+            self.input_size = cached['input_size']
+            self.features = torch.from_numpy(cached['features']).to(self.device)
+            self.is_image_set = True
+            return
+        
+        super().set_image(image, image_format)
+        self.cache.put_embedding(key, self.features, self.original_size, self.input_size)
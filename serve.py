@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Multi-process server for the object counting API.
+
+The parent process loads the AI models once, moves their weights into
+shared memory and then forks worker processes that all serve requests on
+the same listening socket. Workers share the model weights instead of each
+loading their own copy, so memory does not grow linearly with the number
+of workers.
+
+Usage:
+    python serve.py --workers 4 --threads-per-worker 2
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+from model_pipeline import limit_torch_threads
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Preload-and-fork server for the AI Object Counting API')
+    parser.add_argument('--host', default='0.0.0.0', help='Address to bind (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=5001, help='Port to bind (default: 5001)')
+    parser.add_argument('--workers', type=int, default=max(1, cpu_count // 2),
+                        help='Number of worker processes (default: half the CPU cores)')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='Torch intra-op threads per worker (default: CPU cores / workers)')
+    args = parser.parse_args()
+    
+    args.workers = max(1, args.workers)
+    if args.threads_per_worker is None:
+        args.threads_per_worker = max(1, cpu_count // args.workers)
+    return args
+
+
+def create_listening_socket(host, port):
+    """Create the socket shared by all worker processes."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app_module, sock, args, worker_id):
+    """Serve requests in a forked worker process. Never returns."""
+    try:
+        limit_torch_threads(args.threads_per_worker)
+        
+        # Database connections must not be shared with the parent process
+        with app_module.app.app_context():
+            app_module.db.engine.dispose()
+        
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        
+        app_module.object_counter.warm_up()
+        
+        server = make_server(
+            args.host, args.port, app_module.app, threaded=True, fd=sock.fileno()
+        )
+        logger.info(
+            f"Worker {worker_id} (pid {os.getpid()}) serving with "
+            f"{args.threads_per_worker} torch threads"
+        )
+        server.serve_forever()
+    except SystemExit:
+        pass
+    except Exception as e:
+        logger.error(f"Worker {worker_id} failed: {str(e)}")
+        drain_worker(app_module, worker_id)
+        os._exit(1)
+    drain_worker(app_module, worker_id)
+    os._exit(0)
+
+
+def drain_worker(app_module, worker_id):
+    """
+    Finish a worker's queued jobs and upload writes before it exits.
+    
+    Workers leave with os._exit(), which skips atexit handlers such as the
+    upload writer's flush.
+    """
+    # A second SIGTERM must not interrupt the drain
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        app_module.job_queue.shutdown()
+        app_module.upload_writer.flush()
+        logger.info(f"Worker {worker_id} (pid {os.getpid()}) drained")
+    except Exception as e:
+        logger.error(f"Worker {worker_id} failed to drain: {str(e)}")
+
+
+def spawn_worker(app_module, sock, args, worker_id):
+    pid = os.fork()
+    if pid == 0:
+        run_worker(app_module, sock, args, worker_id)
+    return pid
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    
+    import app as app_module
+    
+    # Load the models once in the parent; each worker warms up after the fork
+    logger.info("Loading AI models in the parent process...")
+    app_module.object_counter.load(warm_up=False)
+    app_module.object_counter.share_memory()
+    
+    with app_module.app.app_context():
+        app_module.upgrade_database(app_module.db.engine)
+        app_module.db.engine.dispose()
+    
+    # Keep the garbage collector from touching (and so copying) shared pages
+    gc.collect()
+    gc.freeze()
+    
+    sock = create_listening_socket(args.host, args.port)
+    logger.info(f"Listening on {args.host}:{args.port} with {args.workers} workers")
+    
+    workers = {}
+    for worker_id in range(args.workers):
+        workers[spawn_worker(app_module, sock, args, worker_id)] = worker_id
+    
+    shutting_down = False
+    
+    def shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    
+    # Supervise workers and replace the ones that exit unexpectedly
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        
+        worker_id = workers.pop(pid, None)
+        if worker_id is None or shutting_down:
+            continue
+        
+        logger.warning(f"Worker {worker_id} (pid {pid}) exited with status {status}, restarting")
+        time.sleep(1)
+        workers[spawn_worker(app_module, sock, args, worker_id)] = worker_id
+    
+    sock.close()
+    logger.info("All workers stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ from PIL import Image
 import numpy as np
 
 # Import the Flask app
-from app import app, db, CountingResult
+from app import app, db, CountingResult, CachedResult, upload_writer
 
 class TestObjectCountingAPI(unittest.TestCase):
     """Test cases for the Object Counting API."""
@@ -28,8 +28,9 @@ class TestObjectCountingAPI(unittest.TestCase):
     
     def tearDown(self):
         """Clean up after each test."""
-        # Remove test files
+        # Remove test files once background upload writes are done
         import shutil
+        upload_writer.flush()
         shutil.rmtree(app.config['UPLOAD_FOLDER'])
         
         # Clean up database
@@ -59,6 +60,51 @@ class TestObjectCountingAPI(unittest.TestCase):
         self.assertIn('timestamp', data)
         self.assertEqual(data['service'], 'AI Object Counting API')
     
+    def test_ready_while_models_loading(self):
+        """Test that readiness and counting report 503 until models are loaded."""
+        response = self.client.get('/api/ready')
+        data = json.loads(response.data)
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertFalse(data['ready'])
+        self.assertEqual(data['models']['segmenter']['backend'], 'sam')
+        
+        test_image_path = self.create_test_image()
+        with open(test_image_path, 'rb') as img:
+            response = self.client.post('/api/count', data={
+                'image': (img, 'test.png'),
+                'item_type': 'car'
+            })
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+    
+    def test_failed_model_load_is_retried(self):
+        """Test that a failed model load is reported and retried after the retry interval."""
+        from unittest.mock import patch
+        import app as app_module
+        
+        retry_interval = app.config['MODEL_LOAD_RETRY_INTERVAL']
+        try:
+            with patch('app.object_counter.load', side_effect=RuntimeError('checkpoint not found')) as load:
+                app_module.start_model_loading()
+                app_module.model_loader_thread.join()
+                self.assertIsNone(app_module.model_loader_thread)
+                self.assertIsNotNone(app_module.model_load_failed_at)
+                
+                # Not retried before the interval has passed
+                app_module.start_model_loading()
+                self.assertIsNone(app_module.model_loader_thread)
+                self.assertEqual(load.call_count, 1)
+                
+                app.config['MODEL_LOAD_RETRY_INTERVAL'] = 0
+                app_module.start_model_loading()
+                app_module.model_loader_thread.join()
+                self.assertEqual(load.call_count, 2)
+        finally:
+            app.config['MODEL_LOAD_RETRY_INTERVAL'] = retry_interval
+            app_module.model_load_failed_at = None
+    
     def test_count_objects_missing_image(self):
         """Test count endpoint with missing image."""
         response = self.client.post('/api/count', data={'item_type': 'car'})
@@ -93,6 +139,21 @@ class TestObjectCountingAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIn('Invalid item type', data['error'])
     
+    def test_count_objects_invalid_preset(self):
+        """Test count endpoint with an unknown SAM preset."""
+        test_image_path = self.create_test_image()
+        
+        with open(test_image_path, 'rb') as img:
+            response = self.client.post('/api/count', data={
+                'image': (img, 'test.png'),
+                'item_type': 'car',
+                'preset': 'turbo'
+            })
+        
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid preset', data['error'])
+    
     def test_count_objects_invalid_file_type(self):
         """Test count endpoint with invalid file type."""
         # Create a text file instead of image
@@ -123,8 +184,325 @@ class TestObjectCountingAPI(unittest.TestCase):
             })
         
         # Since we can't run the actual AI models in tests,
-        # we expect either a 500 error or success depending on model availability
-        self.assertIn(response.status_code, [200, 500])
+        # we expect success, a 500 error or 503 while models are not loaded
+        self.assertIn(response.status_code, [200, 500, 503])
+    
+    def test_count_objects_multiple_types(self):
+        """Test counting several item types from one pipeline run."""
+        from unittest.mock import patch
+        
+        test_image_path = self.create_test_image()
+        pipeline_result = {
+            'counts': {'car': 2, 'tree': 1},
+            'confidences': {'car': 0.9, 'tree': 0.8},
+            'details': {'total_segments': 3}
+        }
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_all_objects', return_value=pipeline_result) as count_all:
+            with open(test_image_path, 'rb') as img:
+                response = self.client.post('/api/count', data={
+                    'image': (img, 'test.png'),
+                    'item_type': 'car,tree'
+                })
+        
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(count_all.call_count, 1)
+        self.assertEqual(data['counts'], {'car': 2, 'tree': 1})
+        self.assertEqual([r['item_type'] for r in data['results']], ['car', 'tree'])
+        
+        with app.app_context():
+            self.assertEqual(CountingResult.query.count(), 2)
+    
+    def test_count_objects_result_cache(self):
+        """Test that a re-submitted image is served from the result cache."""
+        from unittest.mock import patch
+        
+        test_image_path = self.create_test_image()
+        pipeline_result = {'count': 4, 'confidence': 0.9, 'details': {'total_segments': 5}}
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_objects', return_value=pipeline_result) as count_objects:
+            responses = []
+            for _ in range(2):
+                with open(test_image_path, 'rb') as img:
+                    responses.append(self.client.post('/api/count', data={
+                        'image': (img, 'test.png'),
+                        'item_type': 'car'
+                    }))
+        
+        first, second = [json.loads(response.data) for response in responses]
+        self.assertEqual(count_objects.call_count, 1)
+        self.assertEqual(first['preset'], 'balanced')
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(second['count'], 4)
+        self.assertNotEqual(first['id'], second['id'])
+        
+        with app.app_context():
+            self.assertEqual(CountingResult.query.count(), 2)
+    
+    def test_count_objects_from_memory(self):
+        """Test that the pipeline gets the upload bytes and the file is written in the background."""
+        from unittest.mock import patch
+        
+        test_image_path = self.create_test_image()
+        with open(test_image_path, 'rb') as img:
+            image_data = img.read()
+        pipeline_result = {'count': 1, 'confidence': 0.8, 'details': {'total_segments': 2}}
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_objects', return_value=pipeline_result) as count_objects:
+            response = self.client.post('/api/count', data={
+                'image': (BytesIO(image_data), 'test.png'),
+                'item_type': 'car'
+            })
+        
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(count_objects.call_args[0][0], image_data)
+        
+        upload_writer.flush()
+        with open(data['image_path'], 'rb') as f:
+            self.assertEqual(f.read(), image_data)
+    
+    def test_count_objects_async_job(self):
+        """Test queuing a counting request and polling the job for its result."""
+        import time
+        from unittest.mock import patch
+        
+        test_image_path = self.create_test_image()
+        
+        def fake_count_objects(image_path, item_type, preset=None, progress_callback=None, tiled=False):
+            progress_callback('segmenting', {})
+            return {'count': 2, 'confidence': 0.8, 'details': {'total_segments': 2}}
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_objects', side_effect=fake_count_objects):
+            with open(test_image_path, 'rb') as img:
+                response = self.client.post('/api/count', data={
+                    'image': (img, 'test.png'),
+                    'item_type': 'car',
+                    'async': 'true'
+                })
+            self.assertEqual(response.status_code, 202)
+            job_url = response.headers['Location']
+            
+            for _ in range(100):
+                job = json.loads(self.client.get(job_url).data)
+                if job['status'] in ('completed', 'failed'):
+                    break
+                time.sleep(0.05)
+        
+        self.assertEqual(job['status'], 'completed')
+        self.assertEqual(job['stage'], 'segmenting')
+        self.assertEqual(job['result']['count'], 2)
+        self.assertEqual(self.client.get('/api/jobs/unknown').status_code, 404)
+        
+        with app.app_context():
+            self.assertEqual(CountingResult.query.count(), 1)
+    
+    def test_count_objects_stream(self):
+        """Test the Server-Sent Events stream of pipeline progress."""
+        from unittest.mock import patch
+        
+        test_image_path = self.create_test_image()
+        
+        def fake_count_objects(image_path, item_type, preset=None, progress_callback=None, tiled=False):
+            progress_callback('segmenting', {})
+            progress_callback('classifying', {'completed': 1, 'total': 1, 'segments': [
+                {'segment_id': 0, 'predicted_class': 'sports car', 'refined_label': 'car'}
+            ]})
+            return {'count': 1, 'confidence': 0.9, 'details': {'total_segments': 1}}
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_objects', side_effect=fake_count_objects):
+            with open(test_image_path, 'rb') as img:
+                response = self.client.post('/api/count/stream', data={
+                    'image': (img, 'test.png'),
+                    'item_type': 'car'
+                })
+            body = response.get_data(as_text=True)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = [
+            (message.split('\n')[0][len('event: '):], json.loads(message.split('\n')[1][len('data: '):]))
+            for message in body.strip().split('\n\n')
+        ]
+        self.assertEqual([event for event, _ in events], ['queued', 'progress', 'progress', 'result'])
+        self.assertEqual(events[2][1]['segments'][0]['refined_label'], 'car')
+        self.assertEqual(events[-1][1]['count'], 1)
+    
+    def test_count_objects_batch(self):
+        """Test batch counting of loose images and a zip archive."""
+        import zipfile
+        from unittest.mock import patch
+        
+        test_image_path = self.create_test_image()
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.write(test_image_path, 'photos/a.png')
+            zf.write(test_image_path, 'photos/b.png')
+            zf.writestr('photos/readme.txt', 'not an image')
+        archive.seek(0)
+        pipeline_result = {'count': 2, 'confidence': 0.8, 'details': {'total_segments': 2}}
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_objects', return_value=pipeline_result) as count_objects:
+            with open(test_image_path, 'rb') as img:
+                response = self.client.post('/api/count/batch', data={
+                    'images': [(img, 'single.png'), (archive, 'photos.zip')],
+                    'item_type': 'car'
+                })
+            lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(count_objects.call_count, 3)
+        self.assertEqual(
+            sorted(line['filename'] for line in lines[:-1]),
+            ['photos/a.png', 'photos/b.png', 'single.png']
+        )
+        self.assertTrue(all(line['count'] == 2 for line in lines[:-1]))
+        self.assertEqual(lines[-1]['summary'], {'images': 3, 'completed': 3, 'failed': 0, 'saved': True})
+        
+        with app.app_context():
+            self.assertEqual(CountingResult.query.count(), 3)
+    
+    def test_count_objects_batch_no_images(self):
+        """Test batch counting without any image files."""
+        from unittest.mock import patch
+        
+        with patch('app.object_counter.is_ready', return_value=True):
+            response = self.client.post('/api/count/batch', data={'item_type': 'car'})
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['error'], 'No image files provided')
+    
+    def test_count_objects_batch_result_cache(self):
+        """Test that batch images with stored results are not run through the pipeline again."""
+        from unittest.mock import patch
+        
+        image_data = open(self.create_test_image(), 'rb').read()
+        pipeline_result = {'count': 2, 'confidence': 0.8, 'details': {'total_segments': 2}}
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_objects', return_value=pipeline_result) as count_objects:
+            batches = []
+            for _ in range(2):
+                # The same image twice stores a single cache entry
+                response = self.client.post('/api/count/batch', data={
+                    'images': [(BytesIO(image_data), 'photo.png'), (BytesIO(image_data), 'copy.png')],
+                    'item_type': 'car'
+                })
+                batches.append([json.loads(line) for line in response.get_data(as_text=True).splitlines()])
+        
+        self.assertEqual(count_objects.call_count, 2)
+        self.assertEqual([line['cached'] for line in batches[0][:2]], [False, False])
+        self.assertEqual([line['cached'] for line in batches[1][:2]], [True, True])
+        self.assertEqual([line['count'] for line in batches[1][:2]], [2, 2])
+        self.assertTrue(batches[0][-1]['summary']['saved'])
+        with app.app_context():
+            self.assertEqual(CountingResult.query.count(), 4)
+            self.assertEqual(CachedResult.query.count(), 1)
+    
+    def test_count_objects_batch_pending_upload(self):
+        """Test that a batch image deduplicated onto an unwritten upload is counted from memory."""
+        from unittest.mock import patch
+        
+        image_data = open(self.create_test_image(), 'rb').read()
+        pending_path = os.path.join(app.config['UPLOAD_FOLDER'], 'pending.png')
+        pipeline_result = {'count': 1, 'confidence': 0.9, 'details': {}}
+        
+        # Another request has queued the write of the same image, which is not on disk yet
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.save_upload', return_value=(pending_path, False)), \
+                patch('app.object_counter.count_objects', return_value=pipeline_result) as count_objects:
+            response = self.client.post('/api/count/batch', data={
+                'images': [(BytesIO(image_data), 'photo.png')],
+                'item_type': 'car'
+            })
+            line = json.loads(response.get_data(as_text=True).splitlines()[0])
+        
+        self.assertEqual(line['count'], 1)
+        self.assertEqual(line['image_path'], pending_path)
+        self.assertEqual(count_objects.call_args[0][0], image_data)
+    
+    def test_count_objects_batch_unsupported_archive(self):
+        """Test that encrypted or unsupported zip archives are rejected and their uploads released."""
+        import zipfile
+        from contextlib import nullcontext
+        from unittest.mock import patch
+        
+        image_data = open(self.create_test_image(), 'rb').read()
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('photos/a.png', b'png data')
+        # Mark the member as encrypted in its local and central directory headers
+        encrypted = bytearray(archive.getvalue())
+        encrypted[6] |= 0x1
+        encrypted[encrypted.index(b'PK\x01\x02') + 8] |= 0x1
+        
+        unsupported = NotImplementedError('That compression method is not supported')
+        with patch('app.object_counter.is_ready', return_value=True):
+            for archive_data, read_error in [(bytes(encrypted), None), (archive.getvalue(), unsupported)]:
+                with patch('zipfile.ZipFile.read', side_effect=read_error) if read_error else nullcontext():
+                    response = self.client.post('/api/count/batch', data={
+                        'images': [(BytesIO(image_data), 'photo.png'), (BytesIO(archive_data), 'photos.zip')],
+                        'item_type': 'car'
+                    })
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('Unsupported zip archive', json.loads(response.data)['error'])
+                self.assertEqual(
+                    [files for _, _, files in os.walk(app.config['UPLOAD_FOLDER']) if files],
+                    [['test_image.png']]
+                )
+    
+    def test_rejected_batch_stores_nothing(self):
+        """Test that a batch is validated as a whole before any of its images is stored."""
+        import zipfile
+        from unittest.mock import patch
+        from app import save_upload
+        
+        stored_data = open(self.create_test_image('stored.png'), 'rb').read()
+        new_data = open(self.create_test_image('new.png'), 'rb').read()
+        stored_path, created = save_upload(stored_data, 'stored.png')
+        self.assertTrue(created)
+        
+        # An archive whose member fails its CRC check
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('photos/a.png', b'png data')
+        corrupt = archive.getvalue().replace(b'png data', b'png dada')
+        
+        with patch('app.object_counter.is_ready', return_value=True):
+            for rejected, error in [((BytesIO(b'not an image'), 'notes.txt'), 'Invalid file type'),
+                                    ((BytesIO(corrupt), 'photos.zip'), 'Invalid zip archive')]:
+                response = self.client.post('/api/count/batch', data={
+                    'images': [(BytesIO(stored_data), 'stored.png'), (BytesIO(new_data), 'new.png'), rejected],
+                    'item_type': 'car'
+                })
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(error, json.loads(response.data)['error'])
+        self.assertTrue(os.path.exists(stored_path))
+        new_path, created = save_upload(new_data, 'new.png')
+        self.assertTrue(created)
+    
+    def test_metrics(self):
+        """Test the Prometheus metrics endpoint."""
+        self.client.get('/api/health')
+        response = self.client.get('/api/metrics')
+        text = response.get_data(as_text=True)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('http_requests_total{endpoint="health_check",method="GET",status="200"}', text)
+        self.assertIn('# TYPE object_counter_stage_seconds histogram', text)
+        self.assertIn('counting_jobs{status="queued"}', text)
+        self.assertIn('models_ready 0', text)
+        self.assertIn('# TYPE sam_cache_lookups_total counter', text)
     
     def test_correct_count_missing_data(self):
         """Test correct endpoint with missing data."""
@@ -313,14 +691,74 @@ class TestObjectCountingAPI(unittest.TestCase):
         response = self.client.get(f'/uploads/{filename}')
         self.assertEqual(response.status_code, 200)
     
+    def test_uploads_are_deduplicated(self):
+        """Test that identical uploads are stored once under their SHA-256 digest."""
+        import hashlib
+        from unittest.mock import patch
+        from app import count_upload_references, release_upload
+        
+        test_image_path = self.create_test_image()
+        with open(test_image_path, 'rb') as img:
+            image_data = img.read()
+        image_hash = hashlib.sha256(image_data).hexdigest()
+        pipeline_result = {'count': 1, 'confidence': 0.8, 'details': {'total_segments': 2}}
+        
+        with patch('app.object_counter.is_ready', return_value=True), \
+                patch('app.object_counter.count_objects', return_value=pipeline_result):
+            responses = [
+                json.loads(self.client.post('/api/count', data={
+                    'image': (BytesIO(image_data), name),
+                    'item_type': item_type
+                }).data)
+                for name, item_type in [('first.png', 'car'), ('second.png', 'tree')]
+            ]
+        upload_writer.flush()
+        
+        image_path = responses[0]['image_path']
+        self.assertEqual(responses[1]['image_path'], image_path)
+        self.assertEqual(
+            image_path,
+            os.path.join(app.config['UPLOAD_FOLDER'], image_hash[:2], image_hash[2:4], f'{image_hash}.png')
+        )
+        self.assertEqual(os.listdir(os.path.dirname(image_path)), [f'{image_hash}.png'])
+        
+        response = self.client.get(f'/uploads/{image_hash[:2]}/{image_hash[2:4]}/{image_hash}.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, image_data)
+        response.close()
+        
+        # Referenced uploads are kept, unreferenced ones deleted
+        with app.app_context():
+            self.assertEqual(count_upload_references(image_path), 2)
+            release_upload(image_path)
+            self.assertTrue(os.path.exists(image_path))
+            CountingResult.query.delete()
+            release_upload(image_path)
+            self.assertFalse(os.path.exists(image_path))
+    
     def test_error_handlers(self):
         """Test error handlers."""
         # Test 404
         response = self.client.get('/api/nonexistent')
         self.assertEqual(response.status_code, 404)
         
-        # Test 413 (file too large) - this is handled by Flask
-        # We can't easily test this without sending a very large file
+        # Test 413 (file too large) - the message names the limit of the endpoint
+        from unittest.mock import patch
+        megabyte = 1024 * 1024
+        with patch.dict(app.config, {'MAX_CONTENT_LENGTH': megabyte, 'BATCH_MAX_CONTENT_LENGTH': 2 * megabyte}):
+            response = self.client.post('/api/count', data={
+                'image': (BytesIO(b'x' * 2 * megabyte), 'large.png'),
+                'item_type': 'car'
+            })
+            self.assertEqual(response.status_code, 413)
+            self.assertIn('Maximum size is 1MB', response.get_json()['error'])
+            
+            response = self.client.post('/api/count/batch', data={
+                'images': [(BytesIO(b'x' * 3 * megabyte), 'large.png')],
+                'item_type': 'car'
+            })
+            self.assertEqual(response.status_code, 413)
+            self.assertIn('Maximum size is 2MB', response.get_json()['error'])
     
     def test_database_model(self):
         """Test the database model."""
@@ -352,6 +790,54 @@ class TestObjectCountingAPI(unittest.TestCase):
 class TestModelPipeline(unittest.TestCase):
     """Test cases for the model pipeline (basic functionality)."""
     
+    def test_upgrade_database_from_old_schema(self):
+        """Test that a database created before the preset column and image_path index is upgraded."""
+        import shutil
+        import sqlite3
+        from sqlalchemy import create_engine, inspect
+        from app import upgrade_database
+        
+        db_dir = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(db_dir, 'old.db')
+            connection = sqlite3.connect(db_path)
+            connection.execute("""
+                CREATE TABLE counting_result (
+                    id VARCHAR(36) NOT NULL PRIMARY KEY,
+                    timestamp DATETIME NOT NULL,
+                    image_path VARCHAR(255) NOT NULL,
+                    item_type VARCHAR(100) NOT NULL,
+                    predicted_count INTEGER NOT NULL,
+                    corrected_count INTEGER,
+                    confidence_score FLOAT,
+                    processing_time FLOAT,
+                    user_feedback TEXT
+                )
+            """)
+            connection.execute(
+                "INSERT INTO counting_result (id, timestamp, image_path, item_type, predicted_count) "
+                "VALUES ('old', '2024-01-01 00:00:00', 'uploads/old.png', 'car', 3)"
+            )
+            connection.commit()
+            connection.close()
+            
+            engine = create_engine(f'sqlite:///{db_path}')
+            upgrade_database(engine)
+            upgrade_database(engine)  # a second run finds nothing to do
+            inspector = inspect(engine)
+            self.assertIn('preset', {column['name'] for column in inspector.get_columns('counting_result')})
+            self.assertIn(
+                ['image_path'],
+                [index['column_names'] for index in inspector.get_indexes('counting_result')]
+            )
+            self.assertIn('cached_result', inspector.get_table_names())
+            with engine.connect() as connection:
+                rows = connection.exec_driver_sql('SELECT id, predicted_count, preset FROM counting_result').all()
+            self.assertEqual([tuple(row) for row in rows], [('old', 3, None)])
+            engine.dispose()
+        finally:
+            shutil.rmtree(db_dir)
+    
     def test_supported_item_types(self):
         """Test that supported item types are correctly defined."""
         from app import OBJECT_TYPES
@@ -373,6 +859,15 @@ class TestModelPipeline(unittest.TestCase):
         self.assertEqual(ALLOWED_EXTENSIONS, expected_extensions)
         self.assertEqual(len(ALLOWED_EXTENSIONS), 5)
     
+    def test_parse_item_types(self):
+        """Test parsing of single, comma-separated and wildcard item types."""
+        from app import parse_item_types, OBJECT_TYPES
+        
+        self.assertEqual(parse_item_types(['car']), ['car'])
+        self.assertEqual(parse_item_types(['car, tree', 'car']), ['car', 'tree'])
+        self.assertEqual(parse_item_types(['*']), OBJECT_TYPES)
+        self.assertEqual(parse_item_types(['']), [])
+    
     def test_allowed_file_function(self):
         """Test the allowed_file function."""
         from app import allowed_file
@@ -389,6 +884,910 @@ class TestModelPipeline(unittest.TestCase):
         self.assertFalse(allowed_file('test.pdf'))
         self.assertFalse(allowed_file('test.doc'))
         self.assertFalse(allowed_file('test'))
+    
+    def test_segment_boxes_match_naive_boxes(self):
+        """Test the single-pass segment boxes against np.where per label, including absent labels."""
+        from model_pipeline import ObjectCounter
+        
+        counter = ObjectCounter(segmenter='stub', classifier='stub', refiner='identity', lazy=True)
+        panoptic_map = np.random.default_rng(0).integers(0, 7, (53, 41))
+        panoptic_map[panoptic_map == 4] = 0
+        panoptic_map[50, 40] = 9  # a single pixel in the last chunk
+        
+        expected = []
+        for label in range(1, 10):
+            ys, xs = np.where(panoptic_map == label)
+            expected.append((xs.min(), ys.min(), xs.max(), ys.max()) if ys.size else None)
+        for chunk_rows in (512, 7, 1):
+            self.assertEqual(counter._get_segment_boxes(panoptic_map, chunk_rows=chunk_rows), expected)
+        self.assertEqual(counter._get_segment_boxes(np.zeros((5, 5), dtype=np.int32)), [])
+    
+    def test_segmentation_coordinate_mapping(self):
+        """Test that downscaled masks are lifted back like a naive full-resolution resize."""
+        from model_pipeline import ObjectCounter
+        
+        counter = ObjectCounter(segmenter='stub', classifier='stub', refiner='identity', max_side=128, lazy=True)
+        image_array = np.random.randint(0, 255, (203, 301, 3), dtype=np.uint8)
+        segmentation_array = counter._downscale_for_segmentation(Image.fromarray(image_array), image_array)
+        self.assertEqual(segmentation_array.shape, (86, 128, 3))
+        small_array = image_array[:100, :120]
+        self.assertIs(counter._downscale_for_segmentation(Image.fromarray(small_array), small_array), small_array)
+        
+        # Non-integer scale factors that differ per axis
+        height, width = image_array.shape[:2]
+        scale = (128 / width, 86 / height)
+        rows, cols = np.ogrid[:86, :128]
+        for center_y, center_x, radius in [(30, 40, 12), (80, 120, 10), (0, 0, 5)]:
+            mask = (rows - center_y) ** 2 + (cols - center_x) ** 2 <= radius ** 2
+            ys, xs = np.where(mask)
+            mask_data = {
+                'segmentation': mask,
+                'bbox': [xs.min(), ys.min(), xs.max() - xs.min(), ys.max() - ys.min()]
+            }
+            (x_start, y_start, x_end, y_end), box_mask = counter._lift_mask(mask_data, scale, (height, width))
+            lifted = np.zeros((height, width), dtype=bool)
+            lifted[y_start:y_end + 1, x_start:x_end + 1] = box_mask
+            
+            # Each full-resolution pixel takes the mask value at its centre
+            full_rows = ((np.arange(height) + 0.5) * scale[1]).astype(np.int64)
+            full_cols = ((np.arange(width) + 0.5) * scale[0]).astype(np.int64)
+            expected = mask[full_rows[:, None], full_cols]
+            np.testing.assert_array_equal(lifted, expected)
+            
+            # Round trip: sampling the lifted mask at the segmentation pixel centres gives the mask back
+            seg_rows = ((np.arange(86) + 0.5) / scale[1]).astype(np.int64)
+            seg_cols = ((np.arange(128) + 0.5) / scale[0]).astype(np.int64)
+            np.testing.assert_array_equal(lifted[seg_rows[:, None], seg_cols], mask)
+
+class TestSamCache(unittest.TestCase):
+    """Test cases for the SAM embedding/mask cache."""
+    
+    def make_masks(self):
+        segmentation = np.zeros((40, 60), dtype=bool)
+        segmentation[5:20, 10:30] = True
+        return [{'segmentation': segmentation, 'area': 300, 'bbox': [10, 5, 19, 14]}]
+    
+    def test_masks_round_trip(self):
+        """Test that cached masks are returned unchanged and counted as hits."""
+        from sam_cache import SamCache
+        
+        cache = SamCache(max_bytes=1024 * 1024)
+        self.assertIsNone(cache.get_masks('image'))
+        cache.put_masks('image', self.make_masks())
+        
+        masks = cache.get_masks('image')
+        np.testing.assert_array_equal(masks[0]['segmentation'], self.make_masks()[0]['segmentation'])
+        self.assertEqual(masks[0]['bbox'], [10, 5, 19, 14])
+        
+        stats = cache.stats()
+        self.assertEqual(stats['masks']['hits'], 1)
+        self.assertEqual(stats['masks']['misses'], 1)
+    
+    def test_eviction_spills_to_disk(self):
+        """Test that evicted entries are reloaded from the spill directory."""
+        from sam_cache import SamCache
+        
+        spill_dir = tempfile.mkdtemp()
+        cache = SamCache(max_bytes=600, spill_dir=spill_dir)
+        cache.put_masks('first', self.make_masks())
+        cache.put_masks('second', self.make_masks())
+        
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertIsNotNone(cache.get_masks('first'))
+        self.assertEqual(cache.stats()['masks']['disk_hits'], 1)
+        
+        import shutil
+        shutil.rmtree(spill_dir)
+    
+    def test_hash_image_depends_on_content(self):
+        """Test that the image hash changes with pixel content."""
+        from sam_cache import hash_image
+        
+        image = np.zeros((10, 10, 3), dtype=np.uint8)
+        other = image.copy()
+        other[0, 0, 0] = 1
+        
+        self.assertEqual(hash_image(image), hash_image(image.copy()))
+        self.assertNotEqual(hash_image(image), hash_image(other))
+
+class TestClassifierExport(unittest.TestCase):
+    """Test cases for the exported classifier backends."""
+    
+    def test_torchscript_export_matches_eager_model(self):
+        """Test that a TorchScript export is cached and matches the eager model."""
+        import shutil
+        import torch
+        from transformers import ResNetConfig, ResNetForImageClassification
+        from classifier_export import load_exported_classifier, check_parity, LogitsModule
+        
+        config = ResNetConfig(embedding_size=8, hidden_sizes=[8, 16], depths=[1, 1], num_labels=5)
+        model = ResNetForImageClassification(config).eval()
+        example_input = torch.randn(2, 3, 64, 64)
+        cache_dir = tempfile.mkdtemp()
+        
+        try:
+            runner = load_exported_classifier(model, 'torchscript', cache_dir, 'tiny-resnet', example_input)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            
+            reference = LogitsModule(model)
+            with torch.no_grad():
+                self.assertLess(check_parity(reference, runner, torch.randn(3, 3, 64, 64)), 1e-3)
+        finally:
+            shutil.rmtree(cache_dir)
+    
+    def test_stale_export_is_replaced(self):
+        """Test that changed weights get their own export and a mismatching cached one is redone."""
+        import shutil
+        import torch
+        from transformers import ResNetConfig, ResNetForImageClassification
+        from classifier_export import (load_checked_classifier, export_cache_path, LogitsModule,
+                                       _export_torchscript)
+        
+        config = ResNetConfig(embedding_size=8, hidden_sizes=[8, 16], depths=[1, 1], num_labels=5)
+        torch.manual_seed(0)
+        model = ResNetForImageClassification(config).eval()
+        other_model = ResNetForImageClassification(config).eval()
+        example_input = torch.randn(2, 3, 64, 64)
+        cache_dir = tempfile.mkdtemp()
+        
+        try:
+            export_path = export_cache_path(model, 'torchscript', cache_dir, 'tiny-resnet', example_input)
+            self.assertNotEqual(
+                export_cache_path(other_model, 'torchscript', cache_dir, 'tiny-resnet', example_input), export_path
+            )
+            
+            # A cached export of other weights under the same key, e.g. from older export code
+            _export_torchscript(other_model, export_path, example_input)
+            reference = LogitsModule(model)
+            with torch.no_grad():
+                runner, parity = load_checked_classifier(
+                    model, reference, 'torchscript', cache_dir, 'tiny-resnet', example_input
+                )
+                self.assertLess(parity, 1e-3)
+                self.assertLess((runner(example_input) - reference(example_input)).abs().max().item(), 1e-3)
+            self.assertEqual(os.listdir(cache_dir), [os.path.basename(export_path)])
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class TestMicroBatcher(unittest.TestCase):
+    """Test cases for cross-request batching of classifier inputs."""
+    
+    def test_concurrent_requests_share_forward_passes(self):
+        """Test that concurrent inputs are combined and each gets its own outputs back."""
+        import torch
+        from batching import MicroBatcher
+        
+        batch_sizes = []
+        
+        def run_batch(inputs):
+            batch_sizes.append(len(inputs))
+            return inputs * 2
+        
+        batcher = MicroBatcher(run_batch, max_batch_size=8, max_wait_ms=200)
+        inputs = [torch.full((3, 2), float(i)) for i in range(4)]
+        futures = [batcher.submit(request_inputs) for request_inputs in inputs]
+        
+        for request_inputs, future in zip(inputs, futures):
+            self.assertTrue(torch.equal(future.result(timeout=5), request_inputs * 2))
+        self.assertTrue(all(size <= 8 for size in batch_sizes))
+        self.assertLess(len(batch_sizes), len(inputs))
+        self.assertEqual(batcher.stats()['requests'], 4)
+
+
+class TestBatchCount(unittest.TestCase):
+    """Test cases for the offline batch counter."""
+    
+    def test_resume_skips_processed_images(self):
+        """Test that successful results are skipped and failed or torn ones retried."""
+        import shutil
+        from batch_count import find_images, load_processed, ResultWriter
+        
+        input_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(input_dir, 'sub'))
+            for name in ('a.png', 'b.jpg', 'notes.txt', os.path.join('sub', 'c.png')):
+                open(os.path.join(input_dir, name), 'wb').close()
+            self.assertEqual(find_images(input_dir), ['a.png', 'b.jpg', os.path.join('sub', 'c.png')])
+            
+            output_path = os.path.join(input_dir, 'results.jsonl')
+            writer = ResultWriter(output_path, 'jsonl', ['car'])
+            writer.write({'path': 'a.png', 'counts': {'car': 1}})
+            writer.write({'path': 'b.jpg', 'error': 'boom'})
+            writer.close()
+            with open(output_path, 'a') as f:
+                f.write('{"path": "sub/c.pn')
+            
+            self.assertEqual(load_processed(output_path, 'jsonl'), {'a.png'})
+            
+            writer = ResultWriter(output_path, 'jsonl', ['car'])
+            writer.write({'path': 'b.jpg', 'counts': {'car': 0}})
+            writer.close()
+            self.assertEqual(load_processed(output_path, 'jsonl'), {'a.png', 'b.jpg'})
+            with open(output_path) as f:
+                self.assertNotIn('sub/c.pn', f.read())
+        finally:
+            shutil.rmtree(input_dir)
+    
+    def test_resume_ignores_torn_csv_rows(self):
+        """Test that a CSV row cut off before its last columns is not taken as processed."""
+        import shutil
+        from batch_count import load_processed, ResultWriter
+        
+        output_dir = tempfile.mkdtemp()
+        try:
+            output_path = os.path.join(output_dir, 'results.csv')
+            writer = ResultWriter(output_path, 'csv', ['car', 'tree'])
+            writer.write({'path': 'a.png', 'processing_time': 1.5, 'total_segments': 4, 'counts': {'car': 1, 'tree': 2}})
+            writer.close()
+            
+            # Cut off after the (empty) error column, and a short row with a line break
+            with open(output_path, 'a', newline='') as f:
+                f.write('short.png,0.5,3,,1\r\nb.png,0.5,3,')
+            self.assertEqual(load_processed(output_path, 'csv'), {'a.png'})
+            
+            writer = ResultWriter(output_path, 'csv', ['car', 'tree'])
+            writer.write({'path': 'b.png', 'processing_time': 0.7, 'total_segments': 3, 'counts': {'car': 0, 'tree': 1}})
+            writer.close()
+            self.assertEqual(load_processed(output_path, 'csv'), {'a.png', 'b.png'})
+            with open(output_path, newline='') as f:
+                self.assertEqual(f.read().count('b.png'), 1)
+        finally:
+            shutil.rmtree(output_dir)
+    
+    def test_worker_error_is_not_hidden_by_pool_cleanup(self):
+        """Test that an unexpected error terminates the pool before joining it."""
+        import shutil
+        from unittest.mock import MagicMock, patch
+        from batch_count import main
+        
+        input_dir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(input_dir, 'a.png'), 'wb').close()
+            pool = MagicMock()
+            pool.imap_unordered.side_effect = OSError('worker crashed')
+            
+            def join():
+                # Like multiprocessing.Pool.join() on a running pool
+                if not pool.close.called and not pool.terminate.called:
+                    raise ValueError('Pool is still running')
+            pool.join.side_effect = join
+            
+            with patch('batch_count.multiprocessing.get_context') as get_context:
+                get_context.return_value.Pool.return_value = pool
+                with self.assertRaisesRegex(OSError, 'worker crashed'):
+                    main([input_dir, os.path.join(input_dir, 'results.jsonl'), '--item-type', 'car'])
+            pool.terminate.assert_called_once()
+        finally:
+            shutil.rmtree(input_dir)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test cases for the Prometheus metrics."""
+    
+    def test_histogram_render(self):
+        """Test that histograms render cumulative buckets, sum and count."""
+        from metrics import Registry, Histogram
+        
+        registry = Registry()
+        histogram = Histogram('stage_seconds', 'Stage latency', labelnames=('stage',),
+                              buckets=(0.1, 1.0), registry=registry)
+        for value in (0.05, 0.5, 2.0):
+            histogram.observe(value, stage='classify')
+        text = registry.render()
+        
+        self.assertIn('stage_seconds_bucket{stage="classify",le="0.1"} 1', text)
+        self.assertIn('stage_seconds_bucket{stage="classify",le="1.0"} 2', text)
+        self.assertIn('stage_seconds_bucket{stage="classify",le="+Inf"} 3', text)
+        self.assertIn('stage_seconds_sum{stage="classify"} 2.55', text)
+        self.assertIn('stage_seconds_count{stage="classify"} 3', text)
+        with self.assertRaises(ValueError):
+            histogram.observe(1.0)
+
+
+class TestBackends(unittest.TestCase):
+    """Test cases for the pluggable pipeline stage backends."""
+    
+    def create_test_image(self, directory):
+        file_path = os.path.join(directory, 'test_image.png')
+        img_array = np.random.default_rng(0).integers(0, 255, (90, 120, 3), dtype=np.uint8)
+        Image.fromarray(img_array).save(file_path)
+        return file_path
+    
+    def test_stub_backends_are_deterministic(self):
+        """Test a pipeline run with the model-free stand-in backends."""
+        import shutil
+        from model_pipeline import ObjectCounter
+        
+        image_dir = tempfile.mkdtemp()
+        try:
+            image_path = self.create_test_image(image_dir)
+            counter = ObjectCounter(segmenter='stub', classifier='stub', refiner='identity', cache_size_mb=0)
+            first = counter.count_all_objects(image_path)
+            second = counter.count_all_objects(image_path)
+        finally:
+            shutil.rmtree(image_dir)
+        
+        self.assertEqual(first['counts'], second['counts'])
+        self.assertEqual(first['details']['total_segments'], 9)
+        self.assertEqual(sum(first['details']['label_histogram'].values()), 9)
+        self.assertNotIn('fallback_mode', first['details'])
+        self.assertEqual(counter.get_pipeline_config()['segmenter'], 'stub')
+    
+    def test_batched_classification_matches_single_segments(self):
+        """Test that classifying segments in batches gives the same results as one at a time."""
+        import torch
+        from transformers import ConvNextImageProcessor, ResNetConfig, ResNetForImageClassification
+        from backends import ResNetClassifier
+        from model_pipeline import ObjectCounter
+        
+        torch.manual_seed(0)
+        classifier = ResNetClassifier(batch_size=4)
+        classifier.image_processor = ConvNextImageProcessor(size={'shortest_edge': 64})
+        config = ResNetConfig(embedding_size=8, hidden_sizes=[8, 16], depths=[1, 1], num_labels=5)
+        classifier.model = ResNetForImageClassification(config).eval()
+        counter = ObjectCounter(
+            segmenter='stub', classifier=classifier, refiner='identity', batch_size=4, lazy=True
+        )
+        segments = [torch.rand(3, 40 + 7 * i, 30 + 5 * i) for i in range(10)]
+        
+        batched = counter._classify_segments(segments)
+        counter.batch_size = 1
+        single = counter._classify_segments(segments)
+        self.assertEqual(batched, single)
+        
+        pixel_values = classifier.image_processor(images=segments, return_tensors='pt')['pixel_values']
+        batched_logits = classifier.runner(pixel_values)
+        single_logits = torch.cat([classifier.runner(pixel_values[i:i + 1]) for i in range(len(segments))])
+        self.assertTrue(torch.allclose(batched_logits, single_logits, atol=1e-5))
+    
+    def test_label_table_is_cached_by_key(self):
+        """Test that the label table is reused when its key matches and rebuilt when it does not."""
+        import shutil
+        from unittest.mock import patch
+        from backends import LabelTableRefiner
+        
+        built_for = []
+        
+        def fake_pipeline(task, model, model_kwargs):
+            def classify(class_names, candidate_labels, batch_size):
+                built_for.append(list(candidate_labels))
+                return [{'labels': [candidate_labels[len(name) % len(candidate_labels)]]} for name in class_names]
+            return classify
+        
+        cache_dir = tempfile.mkdtemp()
+        try:
+            class_names = ['tabby', 'sports car', 'oak']
+            with patch('backends.pipeline', side_effect=fake_pipeline):
+                refiner = LabelTableRefiner(candidate_labels=['car', 'cat', 'tree'])
+                refiner.load(class_names, cache_dir)
+                self.assertEqual(refiner.refine(['tabby', 'oak', 'zebra']), ['tree', 'car', 'unknown'])
+                self.assertEqual(len(built_for), 1)
+                
+                # Same class names, model and labels: read from disk
+                reused = LabelTableRefiner(candidate_labels=['car', 'cat', 'tree'])
+                reused.load(list(reversed(class_names)), cache_dir)
+                self.assertEqual(reused.table, refiner.table)
+                self.assertEqual(len(built_for), 1)
+                
+                # Other candidate labels or class names: rebuilt under a new key
+                LabelTableRefiner(candidate_labels=['car', 'tree']).load(class_names, cache_dir)
+                LabelTableRefiner(candidate_labels=['car', 'cat', 'tree']).load(class_names + ['pug'], cache_dir)
+                self.assertEqual(built_for, [['car', 'cat', 'tree'], ['car', 'tree'], ['car', 'cat', 'tree']])
+                self.assertEqual(len(os.listdir(cache_dir)), 3)
+        finally:
+            shutil.rmtree(cache_dir)
+    
+    def test_failed_backend_falls_back_to_stand_in(self):
+        """Test that a backend that fails to load is replaced and flagged."""
+        from backends import Classifier
+        from model_pipeline import ObjectCounter
+        
+        class BrokenClassifier(Classifier):
+            name = 'broken'
+            
+            def load(self, cache_dir):
+                raise RuntimeError('model not found')
+        
+        counter = ObjectCounter(segmenter='stub', classifier=BrokenClassifier(), fallback=True, lazy=True)
+        counter.load(warm_up=False)
+        status = counter.get_load_status()
+        self.assertEqual(status['classifier']['state'], 'failed')
+        self.assertEqual((counter.classifier.name, counter.refiner.name), ('stub', 'identity'))
+        self.assertEqual(counter.fallback_stages, ['classifier'])
+        self.assertTrue(counter.get_pipeline_config()['fallback_mode'])
+        
+        strict_counter = ObjectCounter(segmenter='stub', classifier=BrokenClassifier(), lazy=True)
+        with self.assertRaises(RuntimeError):
+            strict_counter.load(warm_up=False)
+        with self.assertRaises(ValueError):
+            ObjectCounter(segmenter='unknown', lazy=True)
+    
+    def test_sam_segmenter_is_thread_safe(self):
+        """Test that concurrent images do not share the stateful SAM predictor."""
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from backends import SamSegmenter
+        
+        class StatefulGenerator:
+            """Keeps the image between two steps, like SamPredictor."""
+            
+            def generate(self, image_array):
+                self.image = image_array
+                time.sleep(0.01)
+                return [{'segmentation': None, 'bbox': [0, 0, 0, 0], 'area': int(self.image[0, 0, 0])}]
+        
+        segmenter = SamSegmenter()
+        segmenter.mask_generators = {'balanced': StatefulGenerator()}
+        images = [np.full((4, 4, 3), value, dtype=np.uint8) for value in range(8)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            masks = list(executor.map(lambda image: segmenter.segment(image, 'balanced'), images))
+        self.assertEqual([mask[0]['area'] for mask in masks], list(range(8)))
+    
+    def test_classical_segmenter(self):
+        """Test that the classical preset finds separate and touching objects."""
+        from backends import ClassicalSegmenter
+        from model_pipeline import ObjectCounter
+        
+        # Two separate and two touching discs on a plain background
+        image_array = np.full((300, 400, 3), 200, dtype=np.uint8)
+        rows, cols = np.mgrid[:300, :400]
+        for center_y, center_x, radius in [(75, 75, 30), (225, 325, 25), (150, 175, 35), (150, 235, 35)]:
+            image_array[(rows - center_y) ** 2 + (cols - center_x) ** 2 <= radius ** 2] = (30, 60, 90)
+        
+        segmenter = ClassicalSegmenter()
+        segmenter.load()
+        masks = sorted(segmenter.segment(image_array, 'classical'), key=lambda mask: mask['bbox'])
+        self.assertEqual(len(masks), 4)
+        np.testing.assert_allclose(masks[0]['bbox'], [45, 45, 60, 60], atol=2)
+        np.testing.assert_allclose(masks[-1]['bbox'], [300, 200, 50, 50], atol=2)
+        for mask in masks:
+            self.assertEqual(mask['segmentation'].shape, (300, 400))
+            self.assertEqual(mask['area'], int(mask['segmentation'].sum()))
+        # The touching discs are split roughly in half
+        touching = [mask['area'] for mask in masks[1:3]]
+        self.assertLess(abs(touching[0] - touching[1]), 0.05 * sum(touching))
+        
+        counter = ObjectCounter(segmenter='stub', classifier='stub', refiner='identity', cache_size_mb=0)
+        self.assertIn('classical', counter.get_presets())
+        self.assertEqual(counter.get_pipeline_config('classical')['segmenter'], 'classical')
+        self.assertEqual(counter.get_pipeline_config()['segmenter'], 'stub')
+
+
+class TestTiling(unittest.TestCase):
+    """Test cases for tiled processing of large images."""
+    
+    def test_tile_grid_covers_image_with_overlap(self):
+        """Test that tiles cover the image and neighbours overlap."""
+        from tiling import tile_grid
+        
+        tiles = tile_grid(3000, 2000, 1024, 128)
+        self.assertEqual(len(tiles), 12)
+        self.assertEqual(tiles[0], (0, 0, 1024, 1024))
+        self.assertEqual(tiles[-1], (1976, 976, 3000, 2000))
+        self.assertGreaterEqual(tiles[0][2] - tiles[1][0], 128)
+        self.assertEqual(tile_grid(500, 400, 1024, 128), [(0, 0, 500, 400)])
+        with self.assertRaises(ValueError):
+            tile_grid(3000, 2000, 128, 128)
+    
+    def test_deduplicate_boxes_across_seam(self):
+        """Test that an object cut off at a tile edge is merged with its complete copy."""
+        from tiling import deduplicate_boxes
+        
+        tiles = [(0, 0, 100, 100), (80, 0, 180, 100)]
+        boxes = [
+            (85, 10, 99, 30),   # object cut off at the right edge of tile 0
+            (85, 10, 110, 30),  # the same object, complete in tile 1
+            (20, 10, 40, 30),   # only in tile 0
+            (150, 50, 170, 70)  # only in tile 1
+        ]
+        areas = [300, 520, 400, 400]
+        keep = deduplicate_boxes(boxes, areas, [0, 1, 0, 1], tiles)
+        self.assertEqual(sorted(keep), [1, 2, 3])
+    
+    def count_disc_grid(self, **options):
+        """Count a 1500x900 grid of small discs, several of them on tile seams, in tiles."""
+        import shutil
+        from model_pipeline import ObjectCounter
+        
+        image_array = np.full((900, 1500, 3), 200, dtype=np.uint8)
+        rows, cols = np.mgrid[:900, :1500]
+        centers = [(y, x) for y in range(60, 900, 130) for x in range(60, 1500, 130)]
+        for center_y, center_x in centers:
+            image_array[(rows - center_y) ** 2 + (cols - center_x) ** 2 <= 20 ** 2] = (30, 60, 90)
+        
+        image_dir = tempfile.mkdtemp()
+        try:
+            image_path = os.path.join(image_dir, 'large.png')
+            Image.fromarray(image_array).save(image_path)
+            counter = ObjectCounter(
+                segmenter='stub', classifier='stub', refiner='identity', cache_size_mb=0,
+                tile_size=512, tile_overlap=64, **options
+            )
+            result = counter.count_all_objects(image_path, preset='classical', tiled=True)
+        finally:
+            shutil.rmtree(image_dir)
+        return counter, result, centers
+    
+    def test_tiled_count_of_small_objects(self):
+        """Test that a tiled run counts every small object once."""
+        counter, result, centers = self.count_disc_grid(top_n=100, tile_workers=2)
+        
+        details = result['details']
+        self.assertEqual(details['total_segments'], len(centers))
+        self.assertEqual(details['tiling']['tiles'], 8)
+        self.assertGreater(details['tiling']['duplicates_removed'], 0)
+        self.assertIn('merge', details['stage_timings_ms'])
+        self.assertNotEqual(counter.get_config_fingerprint(tiled=True), counter.get_config_fingerprint())
+    
+    def test_tiled_count_is_not_capped_by_top_n(self):
+        """Test that top_n does not cap the objects counted across several tiles."""
+        counter, result, centers = self.count_disc_grid(top_n=5)
+        self.assertEqual(result['details']['total_segments'], len(centers))
+        
+        # The per-tile limit keeps only the largest segments of every tile
+        counter, result, centers = self.count_disc_grid(top_n=100, tile_top_n=2)
+        self.assertEqual(result['details']['tiling']['tile_segments'], 2 * 8)
+
+
+class TestImageLoading(unittest.TestCase):
+    """Test cases for format-aware image decoding."""
+    
+    def setUp(self):
+        self.image_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.image_dir)
+    
+    def save(self, image, filename, **options):
+        file_path = os.path.join(self.image_dir, filename)
+        image.save(file_path, **options)
+        return file_path
+    
+    def test_jpeg_draft_decoding(self):
+        """Test that large JPEGs are decoded at a reduced scale, but not below max_side."""
+        from image_loading import load_image
+        
+        image_array = np.random.default_rng(0).integers(0, 255, (1500, 2000, 3), dtype=np.uint8)
+        file_path = self.save(Image.fromarray(image_array), 'large.jpg')
+        
+        image, info = load_image(file_path, max_side=512)
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(info['original_size'], [2000, 1500])
+        self.assertEqual(info['decoded_size'], [1000, 750])
+        
+        image, info = load_image(file_path)
+        self.assertEqual(info['decoded_size'], [2000, 1500])
+    
+    def test_modes_are_normalized_to_rgb(self):
+        """Test RGBA, palette and 16-bit greyscale images."""
+        from image_loading import load_image
+        
+        rgba = np.zeros((10, 10, 4), dtype=np.uint8)
+        rgba[:5] = (255, 0, 0, 255)
+        image, info = load_image(self.save(Image.fromarray(rgba), 'transparent.png'))
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(info['mode'], 'RGBA')
+        self.assertEqual(np.asarray(image)[0, 0].tolist(), [255, 0, 0])
+        self.assertEqual(np.asarray(image)[9, 9].tolist(), [255, 255, 255])
+        
+        palette = Image.fromarray(np.random.default_rng(0).integers(0, 255, (20, 20, 3), dtype=np.uint8))
+        image, info = load_image(self.save(palette.convert('P'), 'palette.gif'))
+        self.assertEqual((image.mode, info['format']), ('RGB', 'GIF'))
+        
+        grey = Image.fromarray(np.full((20, 30), 65535, dtype=np.uint16))
+        image, info = load_image(self.save(grey, 'grey16.png'))
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(int(np.asarray(image).max()), 255)
+    
+    def test_high_bit_depth_scaling_is_fixed(self):
+        """Test that 16-bit, 32-bit and float greyscale scale by the mode's range, not the data."""
+        from image_loading import to_rgb
+        
+        def grey_values(image):
+            rgb = np.asarray(to_rgb(image))
+            self.assertEqual(rgb.dtype, np.uint8)
+            return rgb[..., 0].tolist()
+        
+        # A dark 16-bit image stays dark instead of being taken as 8-bit
+        dark = np.array([[0, 100, 200, 255]], dtype=np.uint16)
+        self.assertEqual(grey_values(Image.fromarray(dark)), [[0, 0, 1, 1]])
+        self.assertEqual(grey_values(Image.fromarray(dark * 257)), [[0, 100, 200, 255]])
+        big_endian = Image.frombytes('I;16B', (4, 1), (dark * 257).astype('>u2').tobytes())
+        self.assertEqual(grey_values(big_endian), [[0, 100, 200, 255]])
+        
+        signed = np.array([[-5000, 0, 32896, 65535, 100000]], dtype=np.int32)
+        self.assertEqual(grey_values(Image.fromarray(signed)), [[0, 0, 128, 255, 255]])
+        
+        floats = np.array([[-0.5, 0.0, 0.5, 1.0, 2.0, np.nan]], dtype=np.float32)
+        self.assertEqual(grey_values(Image.fromarray(floats)), [[0, 0, 128, 255, 255, 0]])
+    
+    def test_in_memory_sources(self):
+        """Test decoding from bytes and normalizing decoded arrays."""
+        from image_loading import load_image
+        
+        image_array = np.random.default_rng(0).integers(0, 255, (40, 60, 3), dtype=np.uint8)
+        buffer = BytesIO()
+        Image.fromarray(image_array).save(buffer, format='PNG')
+        
+        image, info = load_image(buffer.getvalue())
+        self.assertEqual(info['format'], 'PNG')
+        np.testing.assert_array_equal(np.asarray(image), image_array)
+        
+        image, info = load_image(image_array[..., 0])
+        self.assertEqual((image.mode, image.size), ('RGB', (60, 40)))
+    
+    def test_exif_orientation(self):
+        """Test that EXIF orientation is applied."""
+        from image_loading import load_image
+        
+        image = Image.fromarray(np.zeros((100, 200, 3), dtype=np.uint8))
+        exif = image.getexif()
+        exif[0x0112] = 6  # rotated 90 degrees clockwise
+        image, info = load_image(self.save(image, 'rotated.jpg', exif=exif))
+        self.assertEqual(image.size, (100, 200))
+        self.assertEqual(info['original_size'], [100, 200])
+
+
+class TestUploadWriter(unittest.TestCase):
+    """Test cases for the background upload writer."""
+    
+    def test_background_and_synchronous_writes(self):
+        """Test queued writes and the synchronous fallback when the queue is full."""
+        import shutil
+        from upload_writer import UploadWriter
+        
+        upload_dir = tempfile.mkdtemp()
+        try:
+            writer = UploadWriter(max_pending_bytes=10, retry_delay=0)
+            small_path = os.path.join(upload_dir, 'small.png')
+            large_path = os.path.join(upload_dir, 'large.png')
+            writer.write(small_path, b'12345')
+            writer.write(large_path, b'x' * 100)  # over the limit, written right away
+            with open(large_path, 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 100)
+            
+            writer.flush()
+            with open(small_path, 'rb') as f:
+                self.assertEqual(f.read(), b'12345')
+            self.assertEqual(
+                writer.stats(),
+                {'pending': 0, 'pending_bytes': 0, 'written': 2, 'failed': 0, 'last_error': None}
+            )
+            self.assertEqual(sorted(os.listdir(upload_dir)), ['large.png', 'small.png'])
+            
+            writer.write(os.path.join(upload_dir, 'missing', 'file.png'), b'123')
+            writer.flush()
+            self.assertEqual(writer.stats()['failed'], 1)
+            
+            self.assertFalse(writer.queue(os.path.join(upload_dir, 'queued.png'), b'x' * 100))
+            self.assertFalse(os.path.exists(os.path.join(upload_dir, 'queued.png')))
+        finally:
+            shutil.rmtree(upload_dir)
+    
+    def test_synchronous_upload_write_outside_lock(self):
+        """Test that a full queue does not make save_upload write while holding the uploads lock."""
+        from unittest.mock import patch
+        from app import save_upload, uploads_lock
+        
+        lock_held = []
+        
+        def write_sync(file_path, data):
+            lock_held.append(uploads_lock.locked())
+        
+        with patch.object(upload_writer, 'max_pending_bytes', 0), \
+                patch.object(upload_writer, 'write_sync', side_effect=write_sync):
+            file_path, created = save_upload(b'not stored', 'photo.png', background=True)
+        
+        self.assertTrue(created)
+        self.assertEqual(lock_held, [False])
+    
+    def test_failed_writes_are_retried_and_recorded(self):
+        """Test that a transient write error is retried and a lasting one recorded."""
+        import shutil
+        from unittest.mock import patch
+        from upload_writer import UploadWriter
+        
+        upload_dir = tempfile.mkdtemp()
+        try:
+            writer = UploadWriter(retries=2, retry_delay=0)
+            file_path = os.path.join(upload_dir, 'flaky.png')
+            real_replace = os.replace
+            errors = [OSError('disk busy')]
+            
+            def flaky_replace(source, destination):
+                if errors:
+                    raise errors.pop()
+                real_replace(source, destination)
+            
+            with patch('upload_writer.os.replace', side_effect=flaky_replace):
+                writer.write(file_path, b'12345')
+                writer.flush()
+            with open(file_path, 'rb') as f:
+                self.assertEqual(f.read(), b'12345')
+            self.assertEqual(writer.stats()['written'], 1)
+            self.assertEqual(os.listdir(upload_dir), ['flaky.png'])
+            
+            missing_path = os.path.join(upload_dir, 'missing', 'file.png')
+            writer.write(missing_path, b'123')
+            writer.flush()
+            stats = writer.stats()
+            self.assertEqual(stats['failed'], 1)
+            self.assertEqual(stats['last_error']['path'], missing_path)
+            self.assertIn('No such file', stats['last_error']['error'])
+        finally:
+            shutil.rmtree(upload_dir)
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test cases for the benchmark suite."""
+    
+    def test_run_and_compare(self):
+        """Test a stand-in model benchmark run and the regression check against it."""
+        import shutil
+        from benchmark import main, compare_reports
+        
+        output_dir = tempfile.mkdtemp()
+        try:
+            baseline_path = os.path.join(output_dir, 'baseline.json')
+            self.assertEqual(main([
+                'run', '--resolutions', '160x120', '--segments', '3', '--repeats', '2',
+                '--warmup', '0', '--output', baseline_path
+            ]), 0)
+            with open(baseline_path) as f:
+                baseline = json.load(f)
+            
+            scenario = baseline['scenarios']['160x120-3seg']
+            self.assertEqual(scenario['segments_classified'], 3)
+            self.assertIn('classify', scenario['stages'])
+            self.assertGreater(scenario['throughput_images_per_s'], 0)
+            self.assertEqual(main(['compare', baseline_path, baseline_path]), 0)
+            
+            slower = json.loads(json.dumps(baseline))
+            slower['scenarios']['160x120-3seg']['latency']['p50_ms'] = scenario['latency']['p50_ms'] * 2 + 10
+            rows = compare_reports(baseline, slower)
+            self.assertEqual([row['stage'] for row in rows if row['regression']], ['total'])
+        finally:
+            shutil.rmtree(output_dir)
+
+
+class TestServe(unittest.TestCase):
+    """Test cases for the preload-and-fork server."""
+    
+    # Starts serve.py's worker with stub backends and a slow upload writer,
+    # prints the port and worker pid, and then the worker's exit status
+    WORKER_SCRIPT = """
+import argparse, os, sys, time
+import app as app_module
+import serve
+from model_pipeline import ObjectCounter
+
+app_module.app.config['UPLOAD_FOLDER'] = sys.argv[1]
+app_module.object_counter = ObjectCounter(segmenter='stub', classifier='stub', refiner='identity', cache_size_mb=0)
+with app_module.app.app_context():
+    app_module.upgrade_database(app_module.db.engine)
+    app_module.db.engine.dispose()
+
+write_file = app_module.upload_writer._write_file
+def slow_write_file(file_path, data):
+    time.sleep(1)
+    write_file(file_path, data)
+app_module.upload_writer._write_file = slow_write_file
+
+sock = serve.create_listening_socket('127.0.0.1', 0)
+port = sock.getsockname()[1]
+args = argparse.Namespace(host='127.0.0.1', port=port, threads_per_worker=1)
+pid = serve.spawn_worker(app_module, sock, args, 0)
+print(port, pid, flush=True)
+_, status = os.waitpid(pid, 0)
+print(os.waitstatus_to_exitcode(status), flush=True)
+"""
+    
+    def test_worker_serves_and_drains_on_sigterm(self):
+        """Test that a forked worker serves a request and saves its upload before exiting on SIGTERM."""
+        import shutil
+        import signal
+        import subprocess
+        import sys
+        import time
+        import urllib.request
+        
+        upload_dir = tempfile.mkdtemp()
+        process = subprocess.Popen(
+            [sys.executable, '-c', self.WORKER_SCRIPT, upload_dir],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        try:
+            port, pid = (int(value) for value in process.stdout.readline().split())
+            
+            image = BytesIO()
+            Image.fromarray(np.random.randint(0, 255, (64, 80, 3), dtype=np.uint8)).save(image, format='PNG')
+            boundary = 'serve-test-boundary'
+            body = (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="item_type"\r\n\r\ncar\r\n'
+                f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="test.png"\r\n'
+                f'Content-Type: image/png\r\n\r\n'
+            ).encode() + image.getvalue() + f'\r\n--{boundary}--\r\n'.encode()
+            request = urllib.request.Request(
+                f'http://127.0.0.1:{port}/api/count', data=body,
+                headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+            )
+            result = None
+            for attempt in range(50):
+                try:
+                    with urllib.request.urlopen(request, timeout=30) as response:
+                        result = json.loads(response.read())
+                    break
+                except urllib.error.URLError:
+                    time.sleep(0.2)  # the worker is still warming up
+            self.assertIn('count', result)
+            
+            # The upload is still being written when the worker is told to stop
+            os.kill(pid, signal.SIGTERM)
+            self.assertEqual(process.stdout.readline().strip(), '0')
+            with open(result['image_path'], 'rb') as f:
+                self.assertEqual(f.read(), image.getvalue())
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            shutil.rmtree(upload_dir)
+
+
+class TestPrecision(unittest.TestCase):
+    """Test cases for the reduced precision modes."""
+    
+    def test_int8_dynamic_quantization_report(self):
+        """Test that int8 quantization shrinks the model and reports the accuracy delta."""
+        import torch
+        from precision import quantize_linear_layers, module_size_mb, compare_logits
+        
+        model = torch.nn.Sequential(torch.nn.Linear(64, 256), torch.nn.ReLU(), torch.nn.Linear(256, 10)).eval()
+        inputs = torch.randn(16, 64)
+        with torch.no_grad():
+            reference = model(inputs)
+            quantized = quantize_linear_layers(model)
+            report = compare_logits(reference, quantized(inputs))
+        
+        self.assertLess(module_size_mb(quantized), module_size_mb(model))
+        self.assertLess(report['max_abs_logit_diff'], 0.1)
+        self.assertGreaterEqual(report['top1_agreement'], 0.9)
+    
+    def test_int8_dynamic_quantizes_sam_image_encoder(self):
+        """Test that int8 quantization covers SAM's image encoder, not just the mask decoder."""
+        import torch
+        from segment_anything.modeling import (ImageEncoderViT, MaskDecoder, PromptEncoder, Sam,
+                                               TwoWayTransformer)
+        from backends import SamSegmenter
+        
+        torch.manual_seed(0)
+        sam = Sam(
+            image_encoder=ImageEncoderViT(img_size=64, patch_size=16, embed_dim=32, depth=2, num_heads=2,
+                                          out_chans=16, window_size=2, global_attn_indexes=(1,), use_rel_pos=True),
+            prompt_encoder=PromptEncoder(embed_dim=16, image_embedding_size=(4, 4), input_image_size=(64, 64),
+                                         mask_in_chans=4),
+            mask_decoder=MaskDecoder(transformer_dim=16, transformer=TwoWayTransformer(
+                depth=2, embedding_dim=16, mlp_dim=32, num_heads=2), iou_head_hidden_dim=16)
+        ).eval()
+        segmenter = SamSegmenter(precision='int8-dynamic')
+        segmenter.sam = sam
+        segmenter._initialize_precision()
+        
+        encoder_report = segmenter.precision_report['sam_image_encoder']
+        self.assertIsInstance(segmenter.sam.image_encoder.blocks[0].mlp.lin1,
+                              torch.ao.nn.quantized.dynamic.Linear)
+        self.assertLess(encoder_report['size_mb'], encoder_report['size_mb_fp32'])
+        self.assertGreater(encoder_report['cosine_similarity'], 0.9)
+        self.assertIn('sam_mask_decoder', segmenter.precision_report)
+    
+    def test_invalid_precision(self):
+        """Test that unknown precision modes are rejected."""
+        from model_pipeline import ObjectCounter
+        
+        with self.assertRaises(ValueError):
+            ObjectCounter(precision='fp8', lazy=True)
 
 if __name__ == '__main__':
     unittest.main()
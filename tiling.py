@@ -0,0 +1,98 @@
+import numpy as np
+
+
+def tile_grid(width, height, tile_size, overlap):
+    """
+    Split an image into overlapping tiles.
+    
+    Tiles are ``tile_size`` pixels wide and high (smaller only when the image
+    is) and neighbouring tiles share at least ``overlap`` pixels. The last
+    tile in each row and column is aligned with the image edge.
+    
+    Args:
+        width (int): Image width
+        height (int): Image height
+        tile_size (int): Tile side length
+        overlap (int): Minimum overlap between neighbouring tiles
+    
+    Returns:
+        list: (x_start, y_start, x_end, y_end) per tile, ends exclusive
+    """
+    if overlap >= tile_size:
+        raise ValueError(f"Tile overlap ({overlap}) must be smaller than the tile size ({tile_size})")
+    
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        count = int(np.ceil((length - overlap) / (tile_size - overlap)))
+        return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+    
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in starts(height)
+        for x in starts(width)
+    ]
+
+
+def deduplicate_boxes(boxes, areas, tile_indices, tiles, iou_threshold=0.5):
+    """
+    Find objects detected in more than one tile.
+    
+    Two detections from different tiles are the same object when their boxes,
+    clipped to the region both tiles cover, overlap by at least
+    ``iou_threshold``. Clipping makes the copy of an object that is cut off at
+    one tile's edge match the complete copy in the neighbouring tile. Of each
+    group of duplicates, the detection with the largest area is kept.
+    
+    Args:
+        boxes (list): (x_start, y_start, x_end, y_end) per detection in image
+            coordinates, ends inclusive
+        areas (list): Mask area per detection
+        tile_indices (list): Index into ``tiles`` of the tile of each detection
+        tiles (list): Tiles as returned by tile_grid()
+        iou_threshold (float): Minimum IoU of duplicate boxes
+    
+    Returns:
+        list: Indices of the detections to keep, largest first
+    """
+    if not boxes:
+        return []
+    
+    boxes = np.asarray(boxes, dtype=np.float64)
+    boxes[:, 2:] += 1  # exclusive ends, so a box's size is end - start
+    tile_indices = np.asarray(tile_indices)
+    tiles = np.asarray(tiles, dtype=np.float64)
+    
+    kept = []
+    for i in np.argsort(-np.asarray(areas), kind='stable'):
+        if kept:
+            others = np.asarray(kept)
+            other_tiles = tile_indices[others]
+            candidates = others[other_tiles != tile_indices[i]]
+            if candidates.size and _max_clipped_iou(boxes, i, candidates, tiles, tile_indices) >= iou_threshold:
+                continue
+        kept.append(i)
+    return [int(i) for i in kept]
+
+
+def _max_clipped_iou(boxes, index, others, tiles, tile_indices):
+    # Region covered by both the detection's tile and each other detection's tile
+    tile = tiles[tile_indices[index]]
+    other_tiles = tiles[tile_indices[others]]
+    region_start = np.maximum(tile[:2], other_tiles[:, :2])
+    region_end = np.minimum(tile[2:], other_tiles[:, 2:])
+    
+    # Both boxes clipped to that region
+    box_start = np.clip(boxes[index, :2], region_start, region_end)
+    box_end = np.clip(boxes[index, 2:], region_start, region_end)
+    other_start = np.clip(boxes[others, :2], region_start, region_end)
+    other_end = np.clip(boxes[others, 2:], region_start, region_end)
+    
+    intersection = np.prod(np.clip(np.minimum(box_end, other_end) - np.maximum(box_start, other_start), 0, None), axis=1)
+    union = (
+        np.prod(box_end - box_start, axis=1) + np.prod(other_end - other_start, axis=1) - intersection
+    )
+    # Tiles that do not overlap cannot see the same object
+    shared = (region_end > region_start).all(axis=1) & (union > 0)
+    iou = np.divide(intersection, union, out=np.zeros_like(union), where=shared)
+    return float(iou.max())
@@ -0,0 +1,202 @@
+import os
+import time
+import uuid
+import queue
+import atexit
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class UploadWriter:
+    """
+    Writes uploaded files to storage on a background thread.
+    
+    Requests hand the upload bytes to the pipeline directly and queue the
+    file write here, so slow (e.g. network-mounted) upload storage is not
+    on the request path. Files appear atomically under their final name
+    once written. When more than ``max_pending_bytes`` are waiting, writes
+    happen synchronously in the caller instead, which bounds memory use.
+    Failed background writes are retried, and the last error is kept in
+    stats() once the retries are used up.
+    """
+    
+    def __init__(self, max_pending_bytes=256 * 1024 * 1024, retries=2, retry_delay=0.5):
+        """
+        Initialize the upload writer.
+        
+        Args:
+            max_pending_bytes (int): Maximum size of the queued, not yet written files
+            retries (int): Number of times a failed background write is retried
+            retry_delay (float): Seconds to wait before the first retry; doubles per retry
+        """
+        self.max_pending_bytes = max_pending_bytes
+        self.retries = max(0, int(retries))
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = 0
+        self._pending_bytes = 0
+        self._pending_paths = set()
+        self._written = 0
+        self._failed = 0
+        self._last_error = None
+        
+        # Do not lose queued uploads when the process exits
+        atexit.register(self.flush)
+    
+    def write(self, file_path, data):
+        """
+        Write a file in the background, or right away if the queue is full.
+        
+        Args:
+            file_path (str): Destination path
+            data (bytes): File content
+        """
+        if not self.queue(file_path, data):
+            self.write_sync(file_path, data)
+    
+    def queue(self, file_path, data):
+        """
+        Queue a file for writing in the background unless the queue is full.
+        
+        Callers that hold a lock can queue under it and write the file with
+        write_sync() after releasing it if the queue is full.
+        
+        Args:
+            file_path (str): Destination path
+            data (bytes): File content
+            
+        Returns:
+            bool: True if the file was queued, False if nothing was done
+        """
+        with self._lock:
+            if self._pending_bytes + len(data) > self.max_pending_bytes:
+                return False
+            self._pending += 1
+            self._pending_bytes += len(data)
+            self._pending_paths.add(file_path)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='upload-writer', daemon=True)
+                self._thread.start()
+        
+        self._queue.put((file_path, data))
+        return True
+    
+    def write_sync(self, file_path, data):
+        """
+        Write a file in the caller because the queue is full.
+        
+        Failures are logged and counted like failed background writes.
+        
+        Args:
+            file_path (str): Destination path
+            data (bytes): File content
+        """
+        logger.warning(f"Upload write queue is full, writing {file_path} synchronously")
+        self._write(file_path, data)
+    
+    def write_now(self, file_path, data):
+        """
+        Write a file synchronously, as atomically as background writes.
+        
+        Args:
+            file_path (str): Destination path
+            data (bytes): File content
+        
+        Raises:
+            OSError: If the file cannot be written
+        """
+        self._write_file(file_path, data)
+        with self._lock:
+            self._written += 1
+    
+    def is_pending(self, file_path):
+        """
+        Check whether a file is queued and not written yet.
+        
+        Args:
+            file_path (str): Destination path
+            
+        Returns:
+            bool: True while the file waits to be written
+        """
+        with self._lock:
+            return file_path in self._pending_paths
+    
+    def flush(self):
+        """Wait until all queued files are written."""
+        if self._thread is not None:
+            self._queue.join()
+    
+    def stats(self):
+        """
+        Get the number of queued, written and failed writes.
+        
+        Returns:
+            dict: Write counters, queued bytes and the path, error and time
+                of the last failed write (or None)
+        """
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'pending_bytes': self._pending_bytes,
+                'written': self._written,
+                'failed': self._failed,
+                'last_error': dict(self._last_error) if self._last_error else None
+            }
+    
+    def _run(self):
+        while True:
+            file_path, data = self._queue.get()
+            try:
+                self._write(file_path, data, retries=self.retries)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    self._pending_bytes -= len(data)
+                    self._pending_paths.discard(file_path)
+                self._queue.task_done()
+    
+    def _write(self, file_path, data, retries=0):
+        delay = self.retry_delay
+        for attempt in range(retries + 1):
+            try:
+                self._write_file(file_path, data)
+            except Exception as e:
+                error = e
+                if attempt < retries:
+                    logger.warning(f"Error saving upload {file_path}, retrying in {delay}s: {str(e)}")
+                    time.sleep(delay)
+                    delay *= 2
+            else:
+                with self._lock:
+                    self._written += 1
+                return
+        
+        logger.error(f"Error saving upload {file_path}: {str(error)}")
+        with self._lock:
+            self._failed += 1
+            self._last_error = {
+                'path': file_path,
+                'error': str(error),
+                'time': datetime.utcnow().isoformat()
+            }
+    
+    def _write_file(self, file_path, data):
+        # Write under a temporary name so the file never appears half written
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        logger.info(f"Image saved: {file_path}")
@@ -0,0 +1,13 @@
+"""
+WSGI entry point for the object counting API.
+
+Point a WSGI server at ``wsgi:app``, e.g. ``gunicorn wsgi:app``. Importing
+this module upgrades the database and starts loading the AI models in the
+background, so loading does not wait for the first request.
+"""
+
+from app import app, db, upgrade_database, start_model_loading
+
+with app.app_context():
+    upgrade_database(db.engine)
+start_model_loading()